@@ -0,0 +1,312 @@
+"""API load test.
+
+Drives each endpoint scenario in turn at a fixed concurrency and reports
+p50/p95/p99 latency and throughput per scenario. Runs either against a
+live server (--url) or in-process through an ASGI transport against the
+configured MONGO_URL, in which case --seed-scale seeds the database first
+(see seed.py).
+
+List and dashboard responses are served from the API's response cache
+while their collection version is unchanged, so those scenarios add a
+unique query parameter to every request and time the query path; the
+*_cached scenarios repeat one URL and time cache hits. The create_*,
+update_stock and movement scenarios exercise the write paths on rows of
+their own (product LOADTEST_PRODUCT at LOADTEST_LOCATION), created before
+the run and deleted with everything derived from them afterwards, so the
+seeded data is the same for every run and --compare baselines stay
+comparable. Cleanup goes through the database, so a --url run needs
+MONGO_URL/DB_NAME pointing at that server's database.
+
+Results are written as JSON with --output. Passing a previous result file
+with --compare flags every scenario whose p95 grew by more than
+--threshold (default 20%) and exits with status 1 when any did.
+
+Usage:
+    python benchmarks/seed.py --scale 100000 --drop
+    python benchmarks/loadtest.py --requests 500 --concurrency 32 --output run.json
+    python benchmarks/loadtest.py --requests 500 --concurrency 32 --compare run.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+from login_storm import percentiles
+import seed as seeder
+
+LOADTEST_PRODUCT = 'Loadtest Product'
+LOADTEST_LOCATION = 'Loadtest Ward'
+LOADTEST_MANUFACTURER = 'Loadtest Manufacturer'
+WRITE_FIXTURE_BATCHES = 10
+
+
+def scenarios(sample: dict) -> list:
+    """(name, method, path factory, body factory) for every benchmarked endpoint"""
+    rng = random.Random(7)
+    counter = itertools.count()
+
+    def pick(key):
+        return rng.choice(sample[key])
+
+    def own(key):
+        # Rows created by create_write_fixtures; the seeded ones are never written
+        return rng.choice(sample['writes'][key])
+
+    def uncached(path: str) -> str:
+        # A URL the response cache has not seen, so the request runs the query
+        return f"{path}{'&' if '?' in path else '?'}nocache={next(counter)}"
+
+    def manufacturer():
+        n = next(counter)
+        return {'name': f"{LOADTEST_MANUFACTURER} {n}", 'contact_email': f"loadtest{n}@manufacturer.example.com",
+                'contact_phone': f"+1-555-{n:06d}", 'address': f"{n} Loadtest Road", 'license_number': f"LT-{n:08d}"}
+
+    def batch():
+        now = datetime.now(timezone.utc)
+        return {'batch_number': f"LT{next(counter):08d}", 'product_name': LOADTEST_PRODUCT, 'product_type': 'drug',
+                'manufacturer_id': own('manufacturer_ids'), 'production_date': now.isoformat(),
+                'expiry_date': (now + timedelta(days=365)).isoformat(), 'quantity': 1000}
+
+    return [
+        ('login', 'POST', lambda: '/api/auth/login', lambda: sample['credentials']),
+        ('auth_me', 'GET', lambda: '/api/auth/me', None),
+        ('dashboard_stats', 'GET', lambda: uncached('/api/dashboard/stats'), None),
+        ('dashboard_stats_cached', 'GET', lambda: '/api/dashboard/stats', None),
+        ('list_manufacturers', 'GET', lambda: uncached('/api/manufacturers?limit=100'), None),
+        ('list_batches', 'GET', lambda: uncached('/api/batches?limit=100'), None),
+        ('list_batches_cached', 'GET', lambda: '/api/batches?limit=100', None),
+        ('list_batches_by_status', 'GET', lambda: uncached('/api/batches?status=in_stock&limit=100'), None),
+        ('list_inventory', 'GET', lambda: uncached('/api/inventory'), None),
+        ('list_inventory_cached', 'GET', lambda: '/api/inventory', None),
+        ('list_inventory_fast', 'GET', lambda: uncached('/api/inventory?fast=true'), None),
+        ('list_inventory_by_location', 'GET', lambda: uncached(f"/api/inventory?location={pick('locations')}&limit=100"), None),
+        ('list_quality_reports', 'GET', lambda: uncached('/api/quality-reports?limit=100'), None),
+        ('list_alerts', 'GET', lambda: uncached('/api/alerts?limit=100'), None),
+        ('list_unread_alerts', 'GET', lambda: uncached('/api/alerts?is_read=false&limit=100'), None),
+        ('batch_traceability', 'GET', lambda: f"/api/dashboard/batch-traceability/{pick('batch_ids')}", None),
+        ('recall_trace', 'POST', lambda: '/api/recalls/trace',
+         lambda: {'batch_numbers': [pick('batch_numbers') for _ in range(20)]}),
+        ('stock_movements', 'GET', lambda: uncached(f"/api/inventory/{pick('inventory_ids')}/movements"), None),
+        ('allocation_plan', 'POST', lambda: '/api/allocations',
+         lambda: {'product_name': pick('products'), 'quantity': 50, 'allow_partial': True, 'dry_run': True}),
+        ('consumption_series', 'GET', lambda: f"/api/consumption?product={pick('products')}", None),
+        ('search_typeahead', 'GET', lambda: f"/api/search?q={pick('products')[:9]}", None),
+        ('search_batch_number', 'GET', lambda: f"/api/search?q={pick('batch_numbers')}&types=batches", None),
+        ('consumption_forecast', 'GET', lambda: '/api/consumption/forecast', None),
+        ('update_stock', 'PUT', lambda: f"/api/inventory/{own('inventory_ids')}/stock",
+         lambda: {'quantity_change': 1, 'reason': 'restock', 'reference': 'loadtest'}),
+        ('stock_movement_batch', 'POST', lambda: '/api/inventory/movements',
+         lambda: {'movements': [{'inventory_id': inventory_id, 'quantity_change': change, 'reference': 'loadtest'}
+                                for inventory_id in (own('inventory_ids'), own('inventory_ids')) for change in (1, -1)]}),
+        ('create_manufacturer', 'POST', lambda: '/api/manufacturers', manufacturer),
+        ('create_batch', 'POST', lambda: '/api/batches', batch),
+        ('create_inventory', 'POST', lambda: '/api/inventory',
+         lambda: {'batch_id': own('batch_ids'), 'location': LOADTEST_LOCATION, 'initial_stock': 100}),
+        ('create_quality_report', 'POST', lambda: '/api/quality-reports',
+         lambda: {'batch_id': own('batch_ids'), 'test_type': 'visual', 'result': 'passed', 'notes': '', 'tested_by': 'Loadtest'}),
+    ]
+
+
+async def drive(client: httpx.AsyncClient, headers: dict, method: str, path, body, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(method, path(), headers=headers, json=body() if body else None)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        'statuses': statuses,
+        'latency': percentiles(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_second': round(total / elapsed, 2),
+    }
+
+
+async def collect_sample(client: httpx.AsyncClient, headers: dict) -> dict:
+    """Real ids to aim the parameterized scenarios at"""
+    response = await client.get('/api/inventory?fields=id,batch_id,batch_number,product_name,location&fast=true', headers=headers)
+    response.raise_for_status()
+    rows = response.json()
+    if not rows:
+        raise SystemExit("The database is empty; run benchmarks/seed.py or pass --seed-scale")
+    response = await client.get('/api/manufacturers?fields=id&fast=true', headers=headers)
+    response.raise_for_status()
+    return {
+        'manufacturer_ids': [row['id'] for row in response.json()],
+        'inventory_ids': [row['id'] for row in rows],
+        'batch_ids': sorted({row['batch_id'] for row in rows}),
+        'batch_numbers': sorted({row['batch_number'] for row in rows}),
+        'locations': sorted({row['location'] for row in rows}),
+        'products': sorted({row['product_name'] for row in rows}),
+    }
+
+
+async def create_write_fixtures(client: httpx.AsyncClient, headers: dict) -> dict:
+    """A manufacturer, batches and inventory rows for the write scenarios to change instead of the seeded data"""
+    async def post(path: str, body: dict) -> dict:
+        response = await client.post(path, json=body, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    now = datetime.now(timezone.utc)
+    manufacturer = await post('/api/manufacturers', {
+        'name': LOADTEST_MANUFACTURER, 'contact_email': 'loadtest@manufacturer.example.com',
+        'contact_phone': '+1-555-000000', 'address': 'Loadtest Road', 'license_number': 'LT-FIXTURE'})
+    fixtures = {'manufacturer_ids': [manufacturer['id']], 'batch_ids': [], 'inventory_ids': []}
+    for i in range(WRITE_FIXTURE_BATCHES):
+        batch = await post('/api/batches', {
+            'batch_number': f"LTFIXTURE{i:03d}", 'product_name': LOADTEST_PRODUCT, 'product_type': 'drug',
+            'manufacturer_id': manufacturer['id'], 'production_date': now.isoformat(),
+            'expiry_date': (now + timedelta(days=365)).isoformat(), 'quantity': 1000})
+        # Enough stock that no -1 movement is ever rejected
+        inventory = await post('/api/inventory', {'batch_id': batch['id'], 'location': LOADTEST_LOCATION, 'initial_stock': 10 ** 9})
+        fixtures['batch_ids'].append(batch['id'])
+        fixtures['inventory_ids'].append(inventory['id'])
+    return fixtures
+
+
+async def remove_written_rows() -> dict:
+    """Delete everything the write scenarios and their fixtures created, then reconcile the counters"""
+    db = seeder.server.db
+    batch_ids = await db.batches.distinct('id', {'product_name': LOADTEST_PRODUCT})
+    removed = {
+        'stock_movements': (await db.stock_movements.delete_many({'product_name': LOADTEST_PRODUCT})).deleted_count,
+        'consumption_rollups': (await db.consumption_rollups.delete_many({'product_name': LOADTEST_PRODUCT})).deleted_count,
+        'quality_reports': (await db.quality_reports.delete_many({'batch_id': {'$in': batch_ids}})).deleted_count,
+        'alerts': (await db.alerts.delete_many({'batch_id': {'$in': batch_ids}})).deleted_count,
+        'inventory': (await db.inventory.delete_many({'product_name': LOADTEST_PRODUCT})).deleted_count,
+        'batches': (await db.batches.delete_many({'product_name': LOADTEST_PRODUCT})).deleted_count,
+        'manufacturers': (await db.manufacturers.delete_many(
+            {'name': {'$regex': f"^{LOADTEST_MANUFACTURER}"}})).deleted_count,
+    }
+    await seeder.server.bump_versions(*removed)
+    await seeder.server.rebuild_dashboard_stats()
+    return removed
+
+
+async def run(args) -> dict:
+    started_at = datetime.now(timezone.utc).isoformat()
+    # Opened in both modes for the cleanup of the write scenarios
+    seeder.server.connect_db()
+    if args.url:
+        transport = None
+        base_url = args.url
+    else:
+        # ASGITransport does not run the app lifespan: open the database only, without the background workers
+        transport = httpx.ASGITransport(app=seeder.server.app)
+        base_url = 'http://loadtest'
+        if args.seed_scale:
+            print(json.dumps(await seeder.seed(args.seed_scale, args.hospitals, True, email=args.email, password=args.password)), flush=True)
+
+    limits = httpx.Limits(max_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=base_url, transport=transport, timeout=120, limits=limits) as client:
+        credentials = {'email': args.email, 'password': args.password}
+        response = await client.post('/api/auth/login', json=credentials)
+        response.raise_for_status()
+        headers = {'Authorization': f"Bearer {response.json()['token']}"}
+        sample = await collect_sample(client, headers)
+        sample['credentials'] = credentials
+        sample['writes'] = await create_write_fixtures(client, headers)
+
+        results = {}
+        selected = set(args.only or [])
+        try:
+            for name, method, path, body in scenarios(sample):
+                if selected and name not in selected:
+                    continue
+                total = max(1, args.requests // 10) if name == 'login' else args.requests
+                results[name] = await drive(client, headers, method, path, body, total, args.concurrency)
+                print(f"{name:<28} p50 {results[name]['latency']['p50_ms']:>8} ms  p95 {results[name]['latency']['p95_ms']:>8} ms  "
+                      f"p99 {results[name]['latency']['p99_ms']:>8} ms  {results[name]['requests_per_second']:>8} req/s", flush=True)
+        finally:
+            print(json.dumps({'removed': await remove_written_rows()}), flush=True)
+
+        if not selected or 'alert_sweep' in selected:
+            results['alert_sweep'] = await drive(client, headers, 'POST', lambda: '/api/alerts/check?wait=true', None,
+                                                 args.sweeps, 1)
+            print(f"{'alert_sweep':<28} p50 {results['alert_sweep']['latency']['p50_ms']:>8} ms", flush=True)
+
+    seeder.server.close_db()
+    return {
+        'meta': {
+            'started_at': started_at,
+            'target': args.url or 'in-process',
+            'commit': git_commit(),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'scenarios': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Scenarios whose p95 latency grew by more than threshold relative to the baseline"""
+    regressions = []
+    for name, result in current['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or not before['latency'].get('count'):
+            continue
+        old, new = before['latency']['p95_ms'], result['latency']['p95_ms']
+        if old > 0 and (new - old) / old > threshold:
+            regressions.append({'scenario': name, 'baseline_p95_ms': old, 'p95_ms': new,
+                                'change': f"{(new - old) / old:+.0%}"})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Base URL of a running server; in-process when omitted")
+    parser.add_argument('--requests', type=int, default=200, help="Requests per scenario (login runs a tenth)")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sweeps', type=int, default=3, help="Alert sweeps to time")
+    parser.add_argument('--only', nargs='+', help="Run only these scenarios")
+    parser.add_argument('--seed-scale', type=int, help="In-process only: seed this many inventory rows first")
+    parser.add_argument('--hospitals', type=int, default=20)
+    parser.add_argument('--email', default=seeder.DEFAULT_EMAIL)
+    parser.add_argument('--password', default=seeder.DEFAULT_PASSWORD)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="Previous result file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed relative p95 growth")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression['scenario']}: p95 {regression['baseline_p95_ms']} ms -> "
+                  f"{regression['p95_ms']} ms ({regression['change']})")
+        if regressions:
+            sys.exit(1)
+        print("No p95 regressions")
+
+
+if __name__ == '__main__':
+    main()
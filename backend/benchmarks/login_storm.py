@@ -0,0 +1,127 @@
+"""Login-storm benchmark.
+
+Measures the latency of a cheap probe endpoint on its own, then again while
+a burst of concurrent logins is in flight. With password hashing off the
+event loop the two distributions should stay close; with hashing inline the
+probe latency climbs to a multiple of the bcrypt cost.
+
+Usage:
+    python benchmarks/login_storm.py --url http://localhost:8001 \\
+        --logins 200 --concurrency 50 --probe /api/auth/me
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 2),
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+async def probe(client: httpx.AsyncClient, path: str, headers: dict, stop: asyncio.Event, interval: float) -> list:
+    samples = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        response.raise_for_status()
+        samples.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    return samples
+
+
+async def login_storm(client: httpx.AsyncClient, credentials: dict, total: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post('/api/auth/login', json=credentials)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        'statuses': statuses,
+        'latency': percentiles(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'logins_per_second': round(total / elapsed, 2),
+    }
+
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limits) as client:
+        credentials = {'email': args.email, 'password': args.password}
+        if not args.email:
+            credentials = {'email': f"bench.{uuid.uuid4().hex[:10]}@example.com", 'password': 'bench-password'}
+            response = await client.post('/api/auth/register', json={**credentials, 'name': 'Benchmark', 'role': 'staff'})
+            response.raise_for_status()
+        response = await client.post('/api/auth/login', json=credentials)
+        response.raise_for_status()
+        headers = {'Authorization': f"Bearer {response.json()['token']}"}
+
+        stop = asyncio.Event()
+        baseline_task = asyncio.create_task(probe(client, args.probe, headers, stop, args.probe_interval))
+        await asyncio.sleep(args.baseline_seconds)
+        stop.set()
+        baseline = await baseline_task
+
+        stop = asyncio.Event()
+        storm_probe = asyncio.create_task(probe(client, args.probe, headers, stop, args.probe_interval))
+        storm = await login_storm(client, credentials, args.logins, args.concurrency)
+        stop.set()
+        during = await storm_probe
+
+    return {
+        'probe': args.probe,
+        'baseline': percentiles(baseline),
+        'during_storm': percentiles(during),
+        'storm': storm,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8001')
+    parser.add_argument('--email', help="Existing account; a throwaway staff user is registered when omitted")
+    parser.add_argument('--password')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--probe', default='/api/auth/me')
+    parser.add_argument('--probe-interval', type=float, default=0.01)
+    parser.add_argument('--baseline-seconds', type=float, default=3)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Synthetic data seeder for the benchmark suite.
+
+Fills the configured database with a reproducible hospital network: every
+hospital is an inventory location, and the collections are sized from
+--scale (the number of inventory rows):
+
+    manufacturers    scale / 1000 (at least 10)
+    batches          scale / 2
+    inventory        scale
+    quality_reports  scale / 4
+    alerts           scale / 10
+
+Documents are built from the API models; indexes are created, collection
+versions bumped and the dashboard counters rebuilt afterwards, so the API
+sees the same state it would after the equivalent writes. A benchmark admin
+account is created with --email/--password.
+
+Usage:
+    python benchmarks/seed.py --scale 100000 --hospitals 50 --drop
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'benchmark')
+
+import server  # noqa: E402
+
+# Dropped by --drop: the seeded data plus everything derived from it
+SEEDED_COLLECTIONS = ['users', 'manufacturers', 'batches', 'inventory', 'quality_reports', 'alerts', 'alerts_archive',
+                      'stock_movements', 'consumption_rollups', 'email_outbox', 'dashboard_stats', 'collection_versions']
+PRODUCTS = 500
+DEFAULT_EMAIL = 'bench.admin@example.com'
+DEFAULT_PASSWORD = 'bench-password'
+
+
+async def insert_chunks(collection: str, docs, chunk_size: int) -> int:
+    inserted = 0
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            await server.db[collection].insert_many(chunk, ordered=False)
+            inserted += len(chunk)
+            chunk = []
+    if chunk:
+        await server.db[collection].insert_many(chunk, ordered=False)
+        inserted += len(chunk)
+    return inserted
+
+
+async def seed(scale: int, hospitals: int, drop: bool = False, chunk_size: int = 5000, seed_value: int = 42,
+               email: str = DEFAULT_EMAIL, password: str = DEFAULT_PASSWORD) -> dict:
+    rng = random.Random(seed_value)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    started = time.perf_counter()
+    if drop:
+        for collection in SEEDED_COLLECTIONS:
+            await server.db[collection].drop()
+    await server.ensure_indexes()
+
+    await server.db.users.delete_many({'email': email})
+    admin = server.User(email=email, name='Benchmark Admin', role=server.UserRole.ADMIN,
+                        password_hash=await server.hash_password(password))
+    await server.db.users.insert_one(admin.model_dump())
+
+    manufacturers = [
+        server.add_search_keys('manufacturers', server.Manufacturer(
+            name=f"Manufacturer {i}",
+            contact_email=f"contact{i}@manufacturer.example.com",
+            contact_phone=f"+1-555-{i:04d}",
+            address=f"{i} Industrial Way",
+            license_number=f"LIC-{i:06d}",
+            created_at=now - timedelta(days=rng.randint(30, 1000))
+        ).model_dump())
+        for i in range(max(10, scale // 1000))
+    ]
+    counts = {'manufacturers': await insert_chunks('manufacturers', manufacturers, chunk_size)}
+
+    batches = []
+    for i in range(max(1, scale // 2)):
+        manufacturer = manufacturers[i % len(manufacturers)]
+        produced = now - timedelta(days=rng.randint(30, 700))
+        batches.append({
+            'id': str(uuid.uuid4()),
+            'batch_number': f"B{i:08d}",
+            'product_name': f"Product {rng.randrange(PRODUCTS)}",
+            'manufacturer_id': manufacturer['id'],
+            'manufacturer_name': manufacturer['name'],
+            'production_date': produced,
+            'expiry_date': now + timedelta(days=rng.randint(-30, 730)),
+            'quality_status': rng.choices(list(server.QualityStatus), weights=[10, 85, 5])[0],
+        })
+
+    def batch_docs():
+        for i, batch in enumerate(batches):
+            yield server.add_search_keys('batches', server.Batch(
+                product_type='drug' if i % 4 else 'consumable',
+                quantity=rng.randint(500, 5000),
+                status=server.BatchStatus.IN_STOCK,
+                created_at=batch['production_date'],
+                **batch
+            ).model_dump())
+    counts['batches'] = await insert_chunks('batches', batch_docs(), chunk_size)
+
+    def inventory_docs():
+        for i in range(scale):
+            batch = batches[i % len(batches)]
+            initial = rng.randint(100, 2000)
+            yield server.add_search_keys('inventory', server.Inventory(
+                batch_id=batch['id'],
+                batch_number=batch['batch_number'],
+                product_name=batch['product_name'],
+                current_stock=rng.randint(0, initial),
+                initial_stock=initial,
+                expiry_date=batch['expiry_date'],
+                location=f"Hospital {i % hospitals:04d}",
+                quality_status=batch['quality_status']
+            ).model_dump())
+    counts['inventory'] = await insert_chunks('inventory', inventory_docs(), chunk_size)
+
+    def quality_report_docs():
+        for i in range(scale // 4):
+            batch = batches[i % len(batches)]
+            yield server.QualityReport(
+                batch_id=batch['id'],
+                batch_number=batch['batch_number'],
+                product_name=batch['product_name'],
+                test_date=batch['production_date'] + timedelta(days=rng.randint(1, 20)),
+                test_type=rng.choice(['sterility', 'potency', 'dissolution', 'visual']),
+                result=batch['quality_status'],
+                notes='',
+                tested_by='Benchmark Lab'
+            ).model_dump()
+    counts['quality_reports'] = await insert_chunks('quality_reports', quality_report_docs(), chunk_size)
+
+    def alert_docs():
+        # At most one alert per batch, which keeps (batch_id, alert_type) unique
+        for i in range(min(scale // 10, len(batches))):
+            batch = batches[i]
+            yield server.Alert(
+                alert_type=server.AlertType.LOW_STOCK,
+                title="Low Stock Alert",
+                message=f"Low stock for {batch['product_name']}",
+                batch_id=batch['id'],
+                batch_number=batch['batch_number'],
+                severity='medium',
+                is_read=rng.random() < 0.7,
+                created_at=now - timedelta(minutes=rng.randint(0, 60 * 24 * 90))
+            ).model_dump()
+    counts['alerts'] = await insert_chunks('alerts', alert_docs(), chunk_size)
+
+    await server.bump_versions(*counts)
+    await server.rebuild_dashboard_stats()
+    return {
+        'scale': scale,
+        'hospitals': hospitals,
+        'counts': counts,
+        'admin': email,
+        'elapsed_s': round(time.perf_counter() - started, 2),
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--scale', type=int, default=10000, help="Inventory rows; other collections scale from it")
+    parser.add_argument('--hospitals', type=int, default=20, help="Number of inventory locations")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed for reproducible data")
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--email', default=DEFAULT_EMAIL)
+    parser.add_argument('--password', default=DEFAULT_PASSWORD)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--drop', action='store_true', help="Drop the seeded collections first")
+    args = parser.parse_args()
+
+    async def run():
+        server.connect_db()
+        try:
+            return await seed(args.scale, args.hospitals, args.drop, args.chunk_size, args.seed, args.email, args.password)
+        finally:
+            server.close_db()
+
+    print(json.dumps(asyncio.run(run()), indent=2))
+
+
+if __name__ == '__main__':
+    main()
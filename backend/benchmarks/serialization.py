@@ -0,0 +1,106 @@
+"""List-serialization benchmark.
+
+Encodes synthetic inventory documents, shaped as Motor returns them, through
+the two paths a list endpoint can take:
+
+    model  - the default path of list_response: validate every row with
+             TypeAdapter(List[Inventory]) and encode it with dump_json
+    fast   - server.dumps_json on the raw documents (?fast=true), orjson when installed
+    fields - the fast path on a ?fields= projection of four columns
+
+No database is needed; only the encoding cost is measured.
+
+Usage:
+    python benchmarks/serialization.py --rows 1000 10000 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'benchmark')
+
+from pydantic import TypeAdapter  # noqa: E402
+
+import server  # noqa: E402
+
+FIELDS = ['id', 'product_name', 'location', 'current_stock']
+
+
+def make_documents(count: int) -> list:
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    return [
+        {
+            'id': str(uuid.uuid4()),
+            'batch_id': str(uuid.uuid4()),
+            'batch_number': f"B{i:07d}",
+            'product_name': f"Product {i % 500}",
+            'location': f"Warehouse {i % 20}",
+            'current_stock': i % 1000,
+            'initial_stock': 1000,
+            'expiry_date': now + timedelta(days=i % 365),
+            'last_updated': now,
+        }
+        for i in range(count)
+    ]
+
+
+def encode_model(adapter: TypeAdapter, docs: list) -> bytes:
+    return adapter.dump_json(adapter.validate_python(docs))
+
+
+def encode_fast(docs: list) -> bytes:
+    return server.dumps_json(docs)
+
+
+def timed(func, repeat: int) -> dict:
+    samples = []
+    size = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(func())
+        samples.append(time.perf_counter() - started)
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 2),
+        'min_ms': round(min(samples) * 1000, 2),
+        'bytes': size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    adapter = server.LIST_ADAPTERS['inventory']
+    results = {'encoder': 'orjson' if server.orjson else 'json', 'runs': []}
+    for count in args.rows:
+        docs = make_documents(count)
+        projected = [{name: doc[name] for name in FIELDS} for doc in docs]
+        run = {
+            'rows': count,
+            'model': timed(lambda: encode_model(adapter, docs), args.repeat),
+            'fast': timed(lambda: encode_fast(docs), args.repeat),
+            'fields': timed(lambda: encode_fast(projected), args.repeat),
+        }
+        run['speedup'] = round(run['model']['median_ms'] / max(run['fast']['median_ms'], 0.01), 1)
+        results['runs'].append(run)
+        print(f"{count:>7} rows  model {run['model']['median_ms']:>9} ms  fast {run['fast']['median_ms']:>8} ms  "
+              f"fields {run['fields']['median_ms']:>8} ms  x{run['speedup']}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Operational commands for the inventory API.
+
+Usage:
+    python manage.py ensure-indexes
+    python manage.py check-indexes
+    python manage.py rebuild-stats
+    python manage.py migrate-dates [--batch-size N] [--restart]
+    python manage.py backfill-quality-status
+    python manage.py backfill-alert-resolution
+    python manage.py rebuild-rollups
+    python manage.py archive-alerts [--days N]
+    python manage.py backfill-search
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+import server
+
+
+async def ensure_indexes(args) -> int:
+    rebuilt = await server.ensure_indexes(rebuild=True)
+    for name in rebuilt:
+        print(f"{name} differed from its declaration and was rebuilt")
+    return 0
+
+
+async def check_indexes(args) -> int:
+    offenders = await server.check_query_plans()
+    for offender in offenders:
+        print(f"COLLSCAN: {offender['query']} on {offender['collection']} {json.dumps(offender['filter'], default=str)}")
+    if offenders:
+        print(f"{len(offenders)} queries scan a whole collection")
+        return 1
+    print("All endpoint and job queries are index-backed")
+    return 0
+
+
+async def rebuild_stats(args) -> int:
+    stats = await server.rebuild_dashboard_stats()
+    print(json.dumps({k: v for k, v in stats.items() if k != 'expiry_by_day'}, default=str))
+    return 0
+
+
+async def migrate_dates(args) -> int:
+    def progress(collection, processed, total):
+        print(f"{collection}: {processed}/{total}", flush=True)
+
+    summary = await server.migrate_dates_to_bson(args.batch_size, args.restart, progress)
+    for collection, counts in summary.items():
+        print(f"{collection}: {counts['converted']} converted, {counts['skipped']} skipped")
+    return 0
+
+
+async def backfill_quality_status(args) -> int:
+    updated = await server.backfill_inventory_quality_status()
+    print(f"{updated} inventory rows updated")
+    return 0
+
+
+async def backfill_alert_resolution(args) -> int:
+    updated = await server.backfill_alert_resolution()
+    print(f"{updated} alerts marked open")
+    return 0
+
+
+async def rebuild_rollups(args) -> int:
+    replayed = await server.rebuild_consumption_rollups()
+    print(f"{replayed} stock movements replayed")
+    return 0
+
+
+async def archive_alerts(args) -> int:
+    archived = await server.archive_resolved_alerts(args.days)
+    print(f"{archived} resolved alerts archived")
+    return 0
+
+
+async def backfill_search(args) -> int:
+    updated = await server.backfill_search_keys()
+    for collection, count in updated.items():
+        print(f"{collection}: {count} documents updated")
+    return 0
+
+
+COMMANDS = {
+    'ensure-indexes': (ensure_indexes, "Create every declared index and rebuild the ones whose options changed", []),
+    'check-indexes': (check_indexes, "Explain every endpoint query and fail on collection scans", []),
+    'rebuild-stats': (rebuild_stats, "Recompute the materialized dashboard counters", []),
+    'migrate-dates': (migrate_dates, "Convert ISO string dates to BSON datetimes", [
+        (['--batch-size'], {'type': int, 'default': 1000}),
+        (['--restart'], {'action': 'store_true', 'help': "Ignore saved checkpoints"}),
+    ]),
+    'backfill-quality-status': (backfill_quality_status, "Copy batch QC status onto inventory rows for allocation", []),
+    'backfill-alert-resolution': (backfill_alert_resolution, "Mark alerts written before resolution tracking as open", []),
+    'rebuild-rollups': (rebuild_rollups, "Recompute the consumption rollups from the stock movement ledger", []),
+    'archive-alerts': (archive_alerts, "Move resolved alerts past the retention window to alerts_archive", [
+        (['--days'], {'type': int, 'default': server.ALERT_RETENTION_DAYS, 'help': "Retention window in days"}),
+    ]),
+    'backfill-search': (backfill_search, "Compute the typeahead search keys of documents written before search existed", []),
+}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Inventory API maintenance commands")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, (_, help_text, arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        for flags, options in arguments:
+            subparser.add_argument(*flags, **options)
+    args = parser.parse_args()
+
+    async def run():
+        server.connect_db()
+        try:
+            return await COMMANDS[args.command][0](args)
+        finally:
+            server.close_db()
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""In-process metrics for the inventory API, rendered in the Prometheus text format.
+
+Request latency is recorded per route template by RequestMetricsMiddleware.
+Every MongoDB command is timed by a PyMongo command listener and attributed
+to the request or background task that issued it through a context
+variable; Motor runs PyMongo calls on its executor with a copy of the
+caller's context, so the listener sees the same query list.
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Queries issued by the current request or background task: (command, collection, seconds, documents)
+current_queries: ContextVar[Optional[list]] = ContextVar('current_queries', default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        # Called from Motor's executor threads as well as the event loop
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """Either set directly or computed at scrape time by a callback returning {labels: value}"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), callback: Optional[Callable] = None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.callback = callback
+        self.values = {}
+        REGISTRY.append(self)
+
+    def set(self, value: float, *labels) -> None:
+        self.values[labels] = value
+
+    def samples(self):
+        values = self.callback() if self.callback else self.values
+        for labels, value in list(values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels) -> None:
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labels, series in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(names, labels + (bound,)), cumulative
+            yield f"{self.name}_bucket", _labels(names, labels + ('+Inf',)), series['count']
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), round(series['sum'], 6)
+            yield f"{self.name}_count", _labels(self.labelnames, labels), series['count']
+
+
+REGISTRY = []
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('http_requests_total', "Requests by route template and status", ('method', 'route', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Request latency by route template", ('method', 'route'))
+REQUEST_DB_SECONDS = Histogram('http_request_db_seconds', "MongoDB time spent per request", ('method', 'route'))
+MONGO_COMMAND_SECONDS = Histogram('mongodb_command_duration_seconds', "MongoDB command latency", ('command', 'collection'))
+MONGO_DOCUMENTS = Counter('mongodb_documents_total', "Documents returned or affected by MongoDB commands", ('command', 'collection'))
+MONGO_FAILURES = Counter('mongodb_command_failures_total', "Failed MongoDB commands", ('command', 'collection'))
+TASK_SECONDS = Histogram('background_task_duration_seconds', "Background task latency", ('task',))
+TASK_DB_SECONDS = Histogram('background_task_db_seconds', "MongoDB time spent per background task run", ('task',))
+TASK_FAILURES = Counter('background_task_failures_total', "Background task runs that raised", ('task',))
+SCHEDULER_TICKS = Counter('scheduler_ticks_total', "Scheduled job ticks run or skipped by this process, by outcome", ('job', 'outcome'))
+SCHEDULER_TICK_SECONDS = Histogram('scheduler_tick_duration_seconds', "Duration of scheduled job runs", ('job',))
+LOOP_LAG_SECONDS = Histogram('event_loop_lag_seconds', "Delay of a scheduled wake-up on the event loop",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+
+def _reply_documents(reply: dict) -> int:
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+    return reply.get('n', 0)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command and appends it to the issuing request's query list"""
+    def __init__(self):
+        self.collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names the collection separately; admin commands have none
+            collection = event.command.get('collection', '')
+        self.collections[(event.request_id, event.connection_id)] = collection
+
+    def succeeded(self, event):
+        collection = self.collections.pop((event.request_id, event.connection_id), '')
+        seconds = event.duration_micros / 1e6
+        documents = _reply_documents(event.reply)
+        MONGO_COMMAND_SECONDS.observe(seconds, event.command_name, collection)
+        MONGO_DOCUMENTS.inc(event.command_name, collection, amount=documents)
+        queries = current_queries.get()
+        if queries is not None:
+            queries.append((event.command_name, collection, seconds, documents))
+
+    def failed(self, event):
+        collection = self.collections.pop((event.request_id, event.connection_id), '')
+        MONGO_FAILURES.inc(event.command_name, collection)
+        queries = current_queries.get()
+        if queries is not None:
+            queries.append((event.command_name, collection, event.duration_micros / 1e6, 0))
+
+
+command_timer = CommandTimer()
+
+
+def query_breakdown(queries: list) -> str:
+    """'find inventory x3 12.4ms 1000 docs, ...' ordered by time spent"""
+    grouped = {}
+    for command, collection, seconds, documents in queries:
+        entry = grouped.setdefault((command, collection), [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += documents
+    ordered = sorted(grouped.items(), key=lambda item: item[1][1], reverse=True)
+    return ', '.join(f"{command} {collection} x{count} {seconds * 1000:.1f}ms {documents} docs"
+                     for (command, collection), (count, seconds, documents) in ordered)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency per route template and, optionally, logging slow requests"""
+    def __init__(self, app, slow_request_ms: float = 0):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        queries = []
+        token = current_queries.set(queries)
+        response = {'status': 500, 'stream': False}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['stream'] = any(name == b'content-type' and value.startswith(b'text/event-stream')
+                                         for name, value in message.get('headers', ()))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_queries.reset(token)
+            elapsed = time.perf_counter() - started
+            route = scope.get('route')
+            template = route.path if route else 'unmatched'
+            REQUESTS.inc(scope['method'], template, response['status'])
+            # An event stream lasts as long as the client stays connected; its duration is not latency
+            if not response['stream']:
+                db_seconds = sum(query[2] for query in queries)
+                REQUEST_SECONDS.observe(elapsed, scope['method'], template)
+                REQUEST_DB_SECONDS.observe(db_seconds, scope['method'], template)
+                if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+                    logger.warning(
+                        f"Slow request {scope['method']} {template} {response['status']} "
+                        f"{elapsed * 1000:.1f}ms (db {db_seconds * 1000:.1f}ms in {len(queries)} commands): "
+                        f"{query_breakdown(queries)}"
+                    )
+
+
+@asynccontextmanager
+async def track_task(name: str):
+    """Time one background task run, including the MongoDB time it spends"""
+    queries = []
+    token = current_queries.set(queries)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        TASK_FAILURES.inc(name)
+        raise
+    finally:
+        current_queries.reset(token)
+        TASK_SECONDS.observe(time.perf_counter() - started, name)
+        TASK_DB_SECONDS.observe(sum(query[2] for query in queries), name)
+
+
+async def sample_event_loop_lag(interval: float = 0.5) -> None:
+    """Sleep for interval and record how late the loop woke us"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - interval))
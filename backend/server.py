@@ -1,34 +1,114 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
 import os
+import asyncio
+import socket
 import logging
+import time
+import json
+import base64
+import html
+import csv
+import gzip
+import io
+import re
+import unicodedata
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from urllib.parse import urlencode
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, TypeAdapter, ValidationError
 from typing import List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import httpx
 from enum import Enum
+import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection, opened by the app lifespan (scripts call connect_db themselves)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+DB_NAME = os.environ['DB_NAME']
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+# 0 leaves the driver default (no limit) for the idle, socket and wait-queue timeouts
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 0)) or None
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 10000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 0)) or None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', 0)) or None
+# Applies to list, search and traceability reads only, which tolerate replica lag;
+# everything that reads before it writes stays on the primary
+MONGO_READ_PREFERENCE = os.getenv('MONGO_READ_PREFERENCE', 'primary')
+
+client = None
+db = None
+read_db = None
+
+def connect_db():
+    """Create the shared client; a no-op when it is already open"""
+    global client, db, read_db
+    if client is None:
+        # tz_aware: dates are stored as BSON datetimes and read back as aware UTC values
+        client = AsyncIOMotorClient(
+            mongo_url,
+            tz_aware=True,
+            event_listeners=[metrics.command_timer],
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+            waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        )
+        db = client[DB_NAME]
+        read_db = client.get_database(
+            DB_NAME, read_preference=make_read_preference(read_pref_mode_from_name(MONGO_READ_PREFERENCE), None)
+        )
+    return db
+
+def close_db():
+    global client, db, read_db
+    if client is not None:
+        client.close()
+        client = db = read_db = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # startup() and shutdown() are defined at the end of the module
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
 
 # Create the main app
-app = FastAPI(title="Hospital Inventory Tracking System")
+app = FastAPI(title="Hospital Inventory Tracking System", lifespan=lifespan)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
+# Alert thresholds
+EXPIRY_WARNING_DAYS = int(os.environ.get('EXPIRY_WARNING_DAYS', 30))
+LOW_STOCK_RATIO = float(os.environ.get('LOW_STOCK_RATIO', 0.1))
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -57,6 +137,25 @@ class AlertType(str, Enum):
     QUALITY_ISSUE = "quality_issue"
     EXPIRED_BATCH = "expired_batch"
 
+class ImportKind(str, Enum):
+    MANUFACTURERS = "manufacturers"
+    BATCHES = "batches"
+    INVENTORY = "inventory"
+
+class MovementReason(str, Enum):
+    DISPENSE = "dispense"
+    RESTOCK = "restock"
+    ADJUSTMENT = "adjustment"
+    ALLOCATION = "allocation"
+
+class RollupGranularity(str, Enum):
+    HOUR = "hour"
+    DAY = "day"
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
 # ============= MODELS =============
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -110,6 +209,7 @@ class Inventory(BaseModel):
     initial_stock: int
     expiry_date: datetime
     location: str
+    quality_status: QualityStatus = QualityStatus.PENDING  # copied from the batch
     last_updated: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class QualityReport(BaseModel):
@@ -136,6 +236,25 @@ class Alert(BaseModel):
     severity: str  # low, medium, high
     is_read: bool = False
     email_sent: bool = False
+    acknowledged_by: Optional[str] = None
+    acknowledged_at: Optional[datetime] = None
+    resolved: bool = False  # set once the triggering condition clears
+    resolved_at: Optional[datetime] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class StockMovement(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    inventory_id: str
+    batch_id: str
+    batch_number: str
+    product_name: str
+    location: str
+    quantity_change: int
+    resulting_stock: int
+    reason: MovementReason
+    reference: Optional[str] = None
+    performed_by: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 # ============= INPUT MODELS =============
@@ -149,6 +268,9 @@ class LoginInput(BaseModel):
     email: EmailStr
     password: str
 
+class RefreshInput(BaseModel):
+    refresh_token: str
+
 class ManufacturerInput(BaseModel):
     name: str
     contact_email: EmailStr
@@ -179,106 +301,2532 @@ class QualityReportInput(BaseModel):
 
 class StockUpdateInput(BaseModel):
     quantity_change: int
+    reason: Optional[MovementReason] = None
+    reference: Optional[str] = None
+
+class StockMovementLine(BaseModel):
+    inventory_id: str
+    quantity_change: int
+    reason: Optional[MovementReason] = None
+    reference: Optional[str] = None
+
+class StockMovementBatchInput(BaseModel):
+    movements: List[StockMovementLine] = Field(..., min_length=1, max_length=1000)
+
+class AllocationInput(BaseModel):
+    product_name: str
+    quantity: int = Field(..., gt=0)
+    preferred_locations: List[str] = Field(default_factory=list)
+    only_preferred: bool = False
+    allow_partial: bool = False
+    dry_run: bool = False
+    reference: Optional[str] = None
+
+class AllocationBatchInput(BaseModel):
+    lines: List[AllocationInput] = Field(..., min_length=1, max_length=500)
+    reference: Optional[str] = None
+
+class AlertAcknowledgeInput(BaseModel):
+    ids: Optional[List[str]] = Field(None, max_length=5000)
+    batch_id: Optional[str] = None
+    alert_type: Optional[AlertType] = None
+
+class UserUpdateInput(BaseModel):
+    name: Optional[str] = None
+    role: Optional[UserRole] = None
+
+class PasswordResetInput(BaseModel):
+    password: str
+    current_password: Optional[str] = None  # required when changing your own password
+
+class RecallInput(BaseModel):
+    manufacturer_id: Optional[str] = None
+    product_name: Optional[str] = None
+    batch_numbers: Optional[List[str]] = Field(None, max_length=5000)
+
+class ExportInput(BaseModel):
+    report: Optional[str] = None  # a preset from EXPORT_REPORTS, or give collection
+    collection: Optional[str] = None
+    filters: dict = Field(default_factory=dict)  # field -> value, or list of values
+    date_field: Optional[str] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+    fields: Optional[List[str]] = None
+    format: ExportFormat = ExportFormat.CSV
 
 # ============= HELPER FUNCTIONS =============
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# bcrypt releases the GIL while hashing, so a small thread pool keeps ~250 ms
+# hashes off the event loop; beyond PASSWORD_HASH_MAX_PENDING queued jobs
+# callers get a 429 instead of piling up behind the pool.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+password_jobs = {'pending': 0, 'rejected': 0}
+
+def _hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
+def _verify_password_sync(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str) -> str:
-    exp = datetime.now(timezone.utc) + timedelta(days=int(os.getenv('JWT_EXPIRATION_DAYS', 7)))
-    payload = {'user_id': user_id, 'exp': exp}
+password_job_seconds = metrics.Histogram(
+    'password_job_duration_seconds', "bcrypt hash/verify time including the wait for a worker", ('operation',)
+)
+
+async def _run_password_job(operation: str, fn, *args):
+    if password_jobs['pending'] >= PASSWORD_HASH_MAX_PENDING:
+        password_jobs['rejected'] += 1
+        raise HTTPException(status_code=429, detail="Too many sign-ins in progress, retry shortly", headers={'Retry-After': '1'})
+    password_jobs['pending'] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        password_jobs['pending'] -= 1
+        password_job_seconds.observe(time.perf_counter() - started, operation)
+
+async def hash_password(password: str) -> str:
+    return await _run_password_job('hash', _hash_password_sync, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await _run_password_job('verify', _verify_password_sync, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a hash was made with a different cost than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+async def rehash_password(user_id: str, password: str, old_hash: str) -> None:
+    new_hash = await hash_password(password)
+    # Only replace the hash that was verified, in case the password changed meanwhile
+    await db.users.update_one({'id': user_id, 'password_hash': old_hash}, {'$set': {'password_hash': new_hash}})
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire ttl seconds after they were stored"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def set(self, key, value) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, key) -> None:
+        self._entries.pop(key, None)
+    
+    def stats(self) -> dict:
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 60))
+# Authenticated principals by user id, so most requests skip the users lookup
+principal_cache = TTLCache(int(os.getenv('AUTH_CACHE_SIZE', 10000)), AUTH_CACHE_TTL)
+# Lifetime of an access token carrying claims, and so how long a role change or deletion takes to apply
+ACCESS_TOKEN_SECONDS = int(os.getenv('ACCESS_TOKEN_SECONDS', 300))
+REFRESH_TOKEN_SCOPE = 'refresh'
+auth_counters = {'claims': 0, 'db_lookups': 0}
+
+def token_claims_enabled() -> bool:
+    return os.getenv('AUTH_TOKEN_CLAIMS', 'false').lower() == 'true'
+
+def invalidate_user(user_id: str) -> None:
+    """Drop a user's cached principal after a role change, deletion or password reset.
+
+    Only this worker's cache is cleared; other workers' cached principals
+    expire within AUTH_CACHE_TTL. Access tokens carrying claims expire within
+    ACCESS_TOKEN_SECONDS, and /auth/refresh reads the user again.
+    """
+    principal_cache.invalidate(user_id)
+
+STREAM_TOKEN_SECONDS = int(os.getenv('STREAM_TOKEN_SECONDS', 60))
+STREAM_TOKEN_SCOPE = 'alert_stream'
+
+def create_stream_token(user: User) -> str:
+    """Short-lived token that only opens event streams; EventSource has to put it in the URL"""
+    now = datetime.now(timezone.utc)
+    payload = {'user_id': user.id, 'scope': STREAM_TOKEN_SCOPE, 'iat': now, 'exp': now + timedelta(seconds=STREAM_TOKEN_SECONDS)}
+    return jwt.encode(payload, os.getenv('JWT_SECRET'), algorithm=os.getenv('JWT_ALGORITHM'))
+
+def create_token(user: User) -> str:
+    """Access token; with claims it is short-lived and renewed through /auth/refresh"""
+    now = datetime.now(timezone.utc)
+    payload = {'user_id': user.id, 'iat': now}
+    if token_claims_enabled():
+        payload.update({'exp': now + timedelta(seconds=ACCESS_TOKEN_SECONDS),
+                        'email': user.email, 'name': user.name, 'role': user.role.value})
+    else:
+        payload['exp'] = now + timedelta(days=int(os.getenv('JWT_EXPIRATION_DAYS', 7)))
+    return jwt.encode(payload, os.getenv('JWT_SECRET'), algorithm=os.getenv('JWT_ALGORITHM'))
+
+def create_refresh_token(user: User) -> str:
+    """Long-lived token that is only good for minting access tokens"""
+    now = datetime.now(timezone.utc)
+    exp = now + timedelta(days=int(os.getenv('JWT_EXPIRATION_DAYS', 7)))
+    payload = {'user_id': user.id, 'scope': REFRESH_TOKEN_SCOPE, 'iat': now, 'exp': exp}
     return jwt.encode(payload, os.getenv('JWT_SECRET'), algorithm=os.getenv('JWT_ALGORITHM'))
 
+def _principal_from_claims(payload: dict) -> Optional[User]:
+    # Claims are at most ACCESS_TOKEN_SECONDS old, as the token expires with them
+    if not token_claims_enabled() or 'role' not in payload:
+        return None
+    return User.model_construct(
+        id=payload['user_id'],
+        email=payload['email'],
+        name=payload['name'],
+        role=UserRole(payload['role']),
+        password_hash=''
+    )
+
 async def get_current_user(authorization: Optional[str] = Header(None)) -> User:
     token = None
     if authorization and authorization.startswith('Bearer '):
         token = authorization.replace('Bearer ', '')
-    
+    return await authenticate_token(token)
+
+async def get_stream_user(authorization: Optional[str] = Header(None), token: Optional[str] = None) -> User:
+    """EventSource cannot send headers, so streaming endpoints also accept a stream token as ?token="""
+    if authorization and authorization.startswith('Bearer '):
+        return await authenticate_token(authorization.replace('Bearer ', ''))
+    return await authenticate_token(token, scope=STREAM_TOKEN_SCOPE)
+
+async def authenticate_token(token: Optional[str], scope: Optional[str] = None) -> User:
+    """Resolve a token to its user; scoped tokens are only accepted where that scope is asked for"""
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
     try:
         payload = jwt.decode(token, os.getenv('JWT_SECRET'), algorithms=[os.getenv('JWT_ALGORITHM')])
+        if payload.get('scope') != scope:
+            raise HTTPException(status_code=401, detail="Invalid token")
         user_id = payload.get('user_id')
+        user = principal_cache.get(user_id)
+        if user:
+            return user
+        user = _principal_from_claims(payload)
+        if user:
+            auth_counters['claims'] += 1
+            return user
+        auth_counters['db_lookups'] += 1
         user_doc = await db.users.find_one({'id': user_id}, {'_id': 0})
         if not user_doc:
             raise HTTPException(status_code=401, detail="User not found")
-        return User(**user_doc)
+        user = User(**user_doc)
+        principal_cache.set(user_id, user)
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-async def send_alert_email(to_email: str, subject: str, message: str):
+def require_admin(current_user: User) -> None:
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin role required")
+
+def _alert_rules(now: datetime) -> list:
+    """Inventory conditions that raise an alert, one aggregation per rule"""
+    expiry_horizon = now + timedelta(days=EXPIRY_WARNING_DAYS)
+    return [
+        {
+            'alert_type': AlertType.EXPIRY_WARNING,
+            'title': "Batch Expiring Soon",
+            'message': "{product_name} (Batch: {batch_number}) expires soon",
+            'severity': "medium",
+            'match': {'expiry_date': {'$lte': expiry_horizon, '$gte': now}},
+        },
+        {
+            'alert_type': AlertType.EXPIRED_BATCH,
+            'title': "Batch Expired",
+            'message': "{product_name} (Batch: {batch_number}) has expired",
+            'severity': "high",
+            'match': {'expiry_date': {'$lt': now}, 'current_stock': {'$gt': 0}},
+        },
+        {
+            'alert_type': AlertType.LOW_STOCK,
+            'title': "Low Stock Alert",
+            'message': "Low stock for {product_name} (Batch: {batch_number})",
+            'severity': "high",
+            # Kept current by every write path (see DASHBOARD STATS), and indexed
+            'match': {'low_stock': True},
+        },
+    ]
+
+def _alert_candidates_pipeline(match: dict, alert_type: AlertType) -> list:
+    """Group matching inventory rows per batch and drop batches that already carry an open alert of this type"""
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': '$batch_id',
+            'batch_number': {'$first': '$batch_number'},
+            'product_name': {'$first': '$product_name'},
+        }},
+        # One probe of the batch_id_alert_type_resolved index per batch; resolved alerts are never fetched
+        {'$lookup': {
+            'from': 'alerts',
+            'let': {'batch_id': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$batch_id', '$$batch_id']}, 'alert_type': alert_type.value, 'resolved': False}},
+                {'$limit': 1},
+                {'$project': {'_id': 1}},
+            ],
+            'as': 'existing',
+        }},
+        {'$match': {'existing': []}},
+        {'$project': {'existing': 0}},
+    ]
+
+@metrics.track_task('alert_sweep')
+async def check_and_create_alerts() -> dict:
+    """Background task to check inventory and create alerts.
+
+    Each rule is resolved with a single server-side aggregation that already
+    excludes batches holding an open alert of the same type, and all new alerts
+    are written with one unordered bulk upsert keyed on (batch_id, alert_type)
+    among open alerts. Open alerts whose condition no longer holds are then
+    resolved. Returns the alerts created and resolved per type and the time
+    spent per phase; a failed sweep raises.
+    """
+    report = {'created': {}, 'resolved': {}, 'timings': {}}
     try:
-        mail = Mail(
-            from_email=os.getenv('SENDER_EMAIL'),
-            to_emails=to_email,
-            subject=subject,
-            html_content=f"<html><body><h2>Hospital Inventory Alert</h2><p>{message}</p></body></html>"
+        now = datetime.now(timezone.utc)
+        operations = []
+        operation_alerts = []
+        for rule in _alert_rules(now):
+            started = time.perf_counter()
+            pipeline = _alert_candidates_pipeline(rule['match'], rule['alert_type'])
+            async for candidate in db.inventory.aggregate(pipeline, allowDiskUse=True):
+                alert = Alert(
+                    alert_type=rule['alert_type'],
+                    title=rule['title'],
+                    message=rule['message'].format(**candidate),
+                    batch_id=candidate['_id'],
+                    batch_number=candidate['batch_number'],
+                    severity=rule['severity']
+                )
+                alert_dict = alert.model_dump(exclude={'batch_id', 'alert_type', 'resolved'})
+                operations.append(UpdateOne(
+                    {'batch_id': alert.batch_id, 'alert_type': alert.alert_type, 'resolved': False},
+                    {'$setOnInsert': alert_dict},
+                    upsert=True
+                ))
+                operation_alerts.append(alert)
+            report['created'][rule['alert_type'].value] = 0
+            report['timings'][rule['alert_type'].value] = round(time.perf_counter() - started, 4)
+        
+        started = time.perf_counter()
+        if operations:
+            try:
+                result = await db.alerts.bulk_write(operations, ordered=False)
+                upserted = result.upserted_ids
+            except BulkWriteError as e:
+                # A concurrent sweep inserted some of the same (batch_id, alert_type) pairs first
+                upserted = {u['index']: u['_id'] for u in e.details.get('upserted', [])}
+            for index in upserted:
+                alert = operation_alerts[index]
+                report['created'][alert.alert_type.value] += 1
+                publish_alert(alert.model_dump())
+            if upserted:
+                await bump_versions('alerts')
+            await bump_stats({'unread_alerts': len(upserted)})
+        report['timings']['write'] = round(time.perf_counter() - started, 4)
+        
+        started = time.perf_counter()
+        report['resolved'] = await resolve_cleared_alerts(now)
+        report['timings']['resolve'] = round(time.perf_counter() - started, 4)
+        
+        logger.info(f"Alert check completed: created={report['created']} resolved={report['resolved']} timings={report['timings']}")
+    except Exception as e:
+        # Raised so the scheduler run and the task metrics record the failure
+        logger.error(f"Error in alert check: {str(e)}")
+        raise
+    return report
+
+# ============= ALERT LIFECYCLE =============
+# An alert is open until its condition clears: the sweep resolves stock and
+# expiry alerts whose batch no longer matches the rule, and a passing quality
+# report resolves the batch's quality alert. Resolved alerts older than
+# ALERT_RETENTION_DAYS are moved to alerts_archive in batches, which keeps
+# the hot collection down to open and recent alerts. Alerts written before
+# resolution tracking are marked open once with
+# `manage.py backfill-alert-resolution`.
+ALERT_RETENTION_DAYS = int(os.getenv('ALERT_RETENTION_DAYS', 30))
+ALERT_ARCHIVE_TTL_DAYS = int(os.getenv('ALERT_ARCHIVE_TTL_DAYS', 0))
+ALERT_ARCHIVE_BATCH_SIZE = 1000
+
+async def resolve_alerts(query: dict) -> int:
+    """Resolve the open alerts matching query; unread ones are marked read as they need no action"""
+    now = datetime.now(timezone.utc)
+    unread = await db.alerts.update_many(
+        {**query, 'resolved': False, 'is_read': False},
+        {'$set': {'resolved': True, 'resolved_at': now, 'is_read': True}}
+    )
+    read = await db.alerts.update_many({**query, 'resolved': False}, {'$set': {'resolved': True, 'resolved_at': now}})
+    if unread.modified_count or read.modified_count:
+        await bump_versions('alerts')
+    await bump_stats({'unread_alerts': -unread.modified_count})
+    return unread.modified_count + read.modified_count
+
+async def resolve_cleared_alerts(now: datetime) -> dict:
+    """Resolve open sweep alerts whose batch no longer has any inventory row matching the rule"""
+    resolved = {}
+    for rule in _alert_rules(now):
+        alert_type = rule['alert_type']
+        open_batches = [
+            alert['batch_id'] async for alert in db.alerts.find(
+                {'resolved': False, 'alert_type': alert_type, 'batch_id': {'$type': 'string'}}, {'_id': 0, 'batch_id': 1}
+            )
+        ]
+        resolved[alert_type.value] = 0
+        for start in range(0, len(open_batches), ALERT_ARCHIVE_BATCH_SIZE):
+            chunk = open_batches[start:start + ALERT_ARCHIVE_BATCH_SIZE]
+            matching = set(await db.inventory.distinct('batch_id', {**rule['match'], 'batch_id': {'$in': chunk}}))
+            cleared = [batch_id for batch_id in chunk if batch_id not in matching]
+            if cleared:
+                resolved[alert_type.value] += await resolve_alerts({'alert_type': alert_type, 'batch_id': {'$in': cleared}})
+    return resolved
+
+async def backfill_alert_resolution() -> int:
+    """Mark alerts written before resolution tracking as open, so the partial unique index covers them"""
+    result = await db.alerts.update_many({'resolved': {'$exists': False}}, {'$set': {'resolved': False}})
+    if result.modified_count:
+        await bump_versions('alerts')
+    return result.modified_count
+
+async def archive_resolved_alerts(older_than_days: int = ALERT_RETENTION_DAYS, batch_size: int = ALERT_ARCHIVE_BATCH_SIZE) -> int:
+    """Move resolved alerts older than the retention window to alerts_archive; returns the number moved.
+
+    Each batch is copied before it is deleted and keeps its _id, so a run
+    interrupted between the two steps is completed by the next one.
+    """
+    now = datetime.now(timezone.utc)
+    query = {'resolved': True, 'resolved_at': {'$lt': now - timedelta(days=older_than_days)}}
+    archived = 0
+    while True:
+        docs = await db.alerts.find(query).sort('resolved_at', ASCENDING).limit(batch_size).to_list(batch_size)
+        if not docs:
+            break
+        for doc in docs:
+            doc['archived_at'] = now
+        try:
+            await db.alerts_archive.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        await db.alerts.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        archived += len(docs)
+    if archived:
+        await bump_versions('alerts')
+        logger.info(f"Archived {archived} resolved alerts")
+    return archived
+
+# ============= EMAIL OUTBOX =============
+# Alert emails are queued in the email_outbox collection and delivered by a
+# background worker. Recipients of one alert are grouped into messages of up
+# to EMAIL_BATCH_SIZE personalizations (SendGrid accepts 1000 per request),
+# and failed sends are retried with exponential backoff. Sent and abandoned
+# messages are removed by TTL indexes after EMAIL_RETENTION_DAYS.
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', 1000))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 6))
+EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', 30))
+EMAIL_POLL_SECONDS = float(os.getenv('EMAIL_POLL_SECONDS', 10))
+EMAIL_LEASE_SECONDS = 120
+EMAIL_RETENTION_DAYS = int(os.getenv('EMAIL_RETENTION_DAYS', 14))
+
+class OutboxStatus(str, Enum):
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+class EmailDeliveryError(Exception):
+    pass
+
+class SendGridTransport:
+    """Sends one multi-personalization message per call over a pooled HTTP client"""
+    def __init__(self):
+        self.url = os.getenv('SENDGRID_API_URL', 'https://api.sendgrid.com/v3/mail/send')
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            headers={'Authorization': f"Bearer {os.getenv('SENDGRID_API_KEY')}"}
         )
-        sg = SendGridAPIClient(os.getenv('SENDGRID_API_KEY'))
-        response = sg.send(mail)
-        logger.info(f"Email sent to {to_email}: {response.status_code}")
-        return True
+    
+    async def send(self, recipients: List[str], subject: str, html_content: str) -> None:
+        payload = {
+            'personalizations': [{'to': [{'email': email}]} for email in recipients],
+            'from': {'email': os.getenv('SENDER_EMAIL')},
+            'subject': subject,
+            'content': [{'type': 'text/html', 'value': html_content}],
+        }
+        try:
+            response = await self.client.post(self.url, json=payload)
+        except httpx.HTTPError as e:
+            raise EmailDeliveryError(str(e))
+        if response.status_code >= 300:
+            raise EmailDeliveryError(f"SendGrid returned {response.status_code}: {response.text[:200]}")
+    
+    async def close(self) -> None:
+        await self.client.aclose()
+
+class StubTransport:
+    """In-memory transport for local runs and tests; fail_next makes the next sends fail"""
+    def __init__(self):
+        self.sent = []
+        self.fail_next = 0
+    
+    async def send(self, recipients: List[str], subject: str, html_content: str) -> None:
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise EmailDeliveryError("Stub transport failure")
+        self.sent.append({'recipients': list(recipients), 'subject': subject, 'html': html_content})
+    
+    async def close(self) -> None:
+        pass
+
+def create_email_transport():
+    if os.getenv('EMAIL_TRANSPORT', 'sendgrid') == 'stub':
+        return StubTransport()
+    return SendGridTransport()
+
+email_transport = None
+outbox_wakeup = asyncio.Event()
+
+def alert_email_html(message: str) -> str:
+    return f"<html><body><h2>Hospital Inventory Alert</h2><p>{html.escape(message)}</p></body></html>"
+
+async def enqueue_alert_email(alert_id: str, subject: str, message: str, recipients: List[str]) -> int:
+    """Queue an alert for every recipient; returns the number of outbox messages created"""
+    if not recipients:
+        return 0
+    now = datetime.now(timezone.utc)
+    messages = [
+        {
+            'id': str(uuid.uuid4()),
+            'alert_id': alert_id,
+            'subject': subject,
+            'html': alert_email_html(message),
+            'recipients': recipients[start:start + EMAIL_BATCH_SIZE],
+            'status': OutboxStatus.PENDING,
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now,
+        }
+        for start in range(0, len(recipients), EMAIL_BATCH_SIZE)
+    ]
+    await db.email_outbox.insert_many(messages)
+    outbox_wakeup.set()
+    return len(messages)
+
+async def _claim_outbox_message() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    return await db.email_outbox.find_one_and_update(
+        {'$or': [
+            {'status': OutboxStatus.PENDING, 'next_attempt_at': {'$lte': now}},
+            # A worker died mid-send; its lease has run out
+            {'status': OutboxStatus.SENDING, 'locked_until': {'$lte': now}},
+        ]},
+        {'$set': {'status': OutboxStatus.SENDING, 'locked_until': now + timedelta(seconds=EMAIL_LEASE_SECONDS)}},
+        sort=[('next_attempt_at', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def deliver_outbox_message(message: dict) -> bool:
+    """Send one claimed message and record the outcome; returns True once delivered"""
+    try:
+        async with metrics.track_task('email_send'):
+            await email_transport.send(message['recipients'], message['subject'], message['html'])
     except Exception as e:
-        logger.error(f"Failed to send email: {str(e)}")
+        attempts = message.get('attempts', 0) + 1
+        if attempts >= EMAIL_MAX_ATTEMPTS:
+            update = {'status': OutboxStatus.FAILED, 'failed_at': datetime.now(timezone.utc)}
+            logger.error(f"Giving up on email {message['id']} after {attempts} attempts: {str(e)}")
+        else:
+            delay = EMAIL_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+            update = {'status': OutboxStatus.PENDING, 'next_attempt_at': datetime.now(timezone.utc) + timedelta(seconds=delay)}
+            logger.warning(f"Email {message['id']} failed (attempt {attempts}), retrying in {delay:.0f}s: {str(e)}")
+        await db.email_outbox.update_one(
+            {'id': message['id']},
+            {'$set': {**update, 'attempts': attempts, 'last_error': str(e)}, '$unset': {'locked_until': ''}}
+        )
         return False
+    
+    await db.email_outbox.update_one(
+        {'id': message['id']},
+        {'$set': {'status': OutboxStatus.SENT, 'sent_at': datetime.now(timezone.utc)},
+         '$inc': {'attempts': 1}, '$unset': {'locked_until': ''}}
+    )
+    logger.info(f"Email {message['id']} sent to {len(message['recipients'])} recipients")
+    remaining = await db.email_outbox.count_documents({'alert_id': message['alert_id'], 'status': {'$ne': OutboxStatus.SENT}}, limit=1)
+    if not remaining:
+        await db.alerts.update_one({'id': message['alert_id']}, {'$set': {'email_sent': True}})
+        await bump_versions('alerts')
+    return True
+
+async def drain_email_outbox() -> int:
+    """Deliver every message that is due; returns how many were attempted"""
+    attempted = 0
+    while True:
+        message = await _claim_outbox_message()
+        if not message:
+            return attempted
+        await deliver_outbox_message(message)
+        attempted += 1
+
+async def run_email_outbox_worker() -> None:
+    while True:
+        try:
+            outbox_wakeup.clear()
+            await drain_email_outbox()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Email outbox worker error: {str(e)}")
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=EMAIL_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# ============= ALERT STREAM =============
+# New alerts are fanned out to /api/alerts/stream subscribers by an in-process
+# broker. Each subscriber owns a bounded queue; one that falls
+# ALERT_STREAM_QUEUE_SIZE events behind is disconnected and catches up from
+# the alerts collection when it reconnects with its Last-Event-ID. A client
+# that missed more than ALERT_STREAM_REPLAY_LIMIT alerts gets a reset event
+# instead and reloads the list. The broker's source is ALERT_STREAM_SOURCE:
+# - local: alerts are published by the process that wrote them, so this is
+#   only complete for a single API process;
+# - changestream: a MongoDB change stream, in commit order (replica sets only);
+# - poll: every process tails the alerts collection each
+#   ALERT_STREAM_POLL_SECONDS;
+# - auto (the default with the scheduler): changestream on a replica set or
+#   sharded cluster, poll otherwise, so the sweep alerts written by whichever
+#   process won the scheduler tick reach every process.
+# created_at is set when an alert is built, not when it is committed, and
+# comes from the writer's clock, so alerts do not arrive in created_at order.
+# Polls and Last-Event-ID replays therefore re-read the last
+# ALERT_STREAM_LOOKBACK_SECONDS behind their position and drop ids already
+# delivered (the client drops replayed duplicates by id).
+ALERT_STREAM_SOURCE = os.getenv('ALERT_STREAM_SOURCE', 'auto' if os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true' else 'local')
+ALERT_STREAM_POLL_SECONDS = float(os.getenv('ALERT_STREAM_POLL_SECONDS', 2))
+ALERT_STREAM_LOOKBACK_SECONDS = float(os.getenv('ALERT_STREAM_LOOKBACK_SECONDS', 30))
+ALERT_STREAM_QUEUE_SIZE = int(os.getenv('ALERT_STREAM_QUEUE_SIZE', 256))
+ALERT_STREAM_HEARTBEAT_SECONDS = float(os.getenv('ALERT_STREAM_HEARTBEAT_SECONDS', 15))
+ALERT_STREAM_REPLAY_LIMIT = int(os.getenv('ALERT_STREAM_REPLAY_LIMIT', 1000))
+ALERT_STREAM_RETRY_MS = 3000
+
+class AlertBroker:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+        self.evicted = 0
+    
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        return queue
+    
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+    
+    def publish(self, alert: dict) -> None:
+        self.published += 1
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(alert)
+            except asyncio.QueueFull:
+                # Slow consumer: discard its backlog and close its stream
+                self.subscribers.discard(queue)
+                self.evicted += 1
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+    
+    def stats(self) -> dict:
+        return {'subscribers': len(self.subscribers), 'published': self.published, 'evicted': self.evicted}
+
+alert_broker = AlertBroker(ALERT_STREAM_QUEUE_SIZE)
+
+def publish_alert(alert: dict) -> None:
+    if ALERT_STREAM_SOURCE == 'local':
+        alert_broker.publish(alert)
+
+def alert_event_key(alert: dict) -> tuple:
+    """Stream position of an alert: creation time in milliseconds, then id"""
+    created_at = alert['created_at']
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return int(created_at.timestamp() * 1000), alert['id']
+
+def parse_event_id(event_id: Optional[str]) -> Optional[tuple]:
+    try:
+        millis, alert_id = event_id.split('-', 1)
+        return int(millis), alert_id
+    except (AttributeError, ValueError):
+        return None
+
+def alerts_since(position: tuple) -> dict:
+    """Query for alerts that may have been committed after a stream position"""
+    since = datetime.fromtimestamp(position[0] / 1000, tz=timezone.utc)
+    return {'created_at': {'$gte': since - timedelta(seconds=ALERT_STREAM_LOOKBACK_SECONDS)}}
+
+async def resolve_alert_stream_source() -> str:
+    """The source ALERT_STREAM_SOURCE=auto stands for on this deployment"""
+    try:
+        hello = await db.command('hello')
+    except Exception as e:
+        # Polling works on any deployment; the API starts without a reachable database too
+        logger.warning(f"Could not detect the deployment type, polling for alerts: {str(e)}")
+        return 'poll'
+    return 'changestream' if hello.get('setName') or hello.get('msg') == 'isdbgrid' else 'poll'
+
+async def newest_alert_position() -> Optional[tuple]:
+    newest = await db.alerts.find({}, {'_id': 0, 'id': 1, 'created_at': 1}).sort(
+        [('created_at', DESCENDING), ('id', DESCENDING)]
+    ).to_list(1)
+    return alert_event_key(newest[0]) if newest else None
+
+def format_alert_event(alert: dict) -> str:
+    millis, alert_id = alert_event_key(alert)
+    return f"id: {millis}-{alert_id}\nevent: alert\ndata: {json.dumps(alert, default=_json_default)}\n\n"
+
+def format_reset_event(position: Optional[tuple]) -> str:
+    event_id = f"id: {position[0]}-{position[1]}\n" if position else ''
+    return f"{event_id}event: reset\ndata: {{}}\n\n"
+
+async def alert_event_stream(last_event_id: Optional[str]):
+    # Subscribe before replaying so nothing inserted meanwhile is missed;
+    # live events already sent by the replay are skipped by id.
+    queue = alert_broker.subscribe()
+    replayed = set()
+    try:
+        yield f"retry: {ALERT_STREAM_RETRY_MS}\n\n"
+        position = parse_event_id(last_event_id)
+        if position:
+            missed = await db.alerts.find(alerts_since(position), {'_id': 0}).sort(
+                [('created_at', ASCENDING), ('id', ASCENDING)]
+            ).to_list(ALERT_STREAM_REPLAY_LIMIT + 1)
+            if len(missed) > ALERT_STREAM_REPLAY_LIMIT:
+                # Too far behind to replay: resume from the newest alert and let the client reload
+                yield format_reset_event(await newest_alert_position())
+            else:
+                for alert in missed:
+                    replayed.add(alert['id'])
+                    yield format_alert_event(alert)
+        while True:
+            try:
+                alert = await asyncio.wait_for(queue.get(), timeout=ALERT_STREAM_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if alert is None:
+                break
+            if alert['id'] in replayed:
+                continue
+            yield format_alert_event(alert)
+    finally:
+        alert_broker.unsubscribe(queue)
+
+async def run_alert_change_stream() -> None:
+    resume_token = None
+    while True:
+        try:
+            async with db.alerts.watch([{'$match': {'operationType': 'insert'}}], resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    alert = change['fullDocument']
+                    alert.pop('_id', None)
+                    alert_broker.publish(alert)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Alert change stream error: {str(e)}")
+            await asyncio.sleep(ALERT_STREAM_RETRY_MS / 1000)
+
+class AlertPoller:
+    """Tails the alerts collection, publishing each alert once however late it was committed"""
+    def __init__(self, lookback_seconds: float):
+        self.lookback = timedelta(seconds=lookback_seconds)
+        # Ids already published, by creation time, back to lookback before the newest
+        self.seen = {}
+        self.newest = None
+    
+    async def poll(self, publish: bool = True) -> int:
+        """Publish the alerts not seen yet; with publish=False only remember them. Returns the number published."""
+        query = {'created_at': {'$gte': self.newest - self.lookback}} if self.newest else {}
+        published = 0
+        async for alert in db.alerts.find(query, {'_id': 0}).sort([('created_at', ASCENDING), ('id', ASCENDING)]):
+            if alert['id'] in self.seen:
+                continue
+            created_at = alert['created_at']
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            self.seen[alert['id']] = created_at
+            self.newest = max(self.newest or created_at, created_at)
+            if publish:
+                alert_broker.publish(alert)
+                published += 1
+        if self.newest:
+            horizon = self.newest - self.lookback
+            self.seen = {alert_id: created_at for alert_id, created_at in self.seen.items() if created_at >= horizon}
+        return published
+    
+    async def prime(self) -> None:
+        """Start from the newest alert without publishing the history before it"""
+        position = await newest_alert_position()
+        if position:
+            self.newest = datetime.fromtimestamp(position[0] / 1000, tz=timezone.utc)
+            await self.poll(publish=False)
+
+async def run_alert_poller() -> None:
+    poller = AlertPoller(ALERT_STREAM_LOOKBACK_SECONDS)
+    primed = False
+    while True:
+        try:
+            if not primed:
+                await poller.prime()
+                primed = True
+            await asyncio.sleep(ALERT_STREAM_POLL_SECONDS)
+            await poller.poll()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Alert poll error: {str(e)}")
+            await asyncio.sleep(ALERT_STREAM_RETRY_MS / 1000)
+
+# ============= SCHEDULER =============
+# Periodic jobs are scheduled in every API process, but exactly one process
+# runs each tick. Ticks are numbered from the epoch, and a process runs tick N
+# only if it is the one that moves the job's lease document to N. The unique
+# index on job turns a lost race into a DuplicateKeyError. The winner holds
+# the lease until the run finishes and renews it meanwhile. A tick that fires
+# while the previous run still holds the lease is skipped and recorded as an
+# overlap. A lease whose owner died lapses after SCHEDULER_LEASE_SECONDS.
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 60))
+SCHEDULER_RUN_RETENTION_DAYS = int(os.getenv('SCHEDULER_RUN_RETENTION_DAYS', 7))
+# 0 disables a job
+ALERT_SWEEP_INTERVAL_SECONDS = int(os.getenv('ALERT_SWEEP_INTERVAL_SECONDS', 300))
+ALERT_ARCHIVE_INTERVAL_SECONDS = int(os.getenv('ALERT_ARCHIVE_INTERVAL_SECONDS', 86400))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+SCHEDULED_JOBS = {
+    'alert_sweep': (ALERT_SWEEP_INTERVAL_SECONDS, check_and_create_alerts),
+    'alert_archive': (ALERT_ARCHIVE_INTERVAL_SECONDS, archive_resolved_alerts),
+}
+
+async def claim_tick(job: str, tick: int, now: datetime) -> Optional[dict]:
+    """Take the job's lease for this tick; returns the previous lease, or None when another run holds it"""
+    try:
+        previous = await db.scheduler_leases.find_one_and_update(
+            {'job': job, 'tick': {'$lt': tick}, '$or': [{'running': False}, {'lease_expires_at': {'$lte': now}}]},
+            {'$set': {
+                'tick': tick,
+                'owner': WORKER_ID,
+                'running': True,
+                'started_at': now,
+                'lease_expires_at': now + timedelta(seconds=SCHEDULER_LEASE_SECONDS),
+            }},
+            projection={'_id': 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        return None
+    return previous or {}
+
+async def record_overlap(job: str, tick: int) -> Optional[dict]:
+    """Count a tick skipped because the previous run is still going; only the first process to see it counts it"""
+    return await db.scheduler_leases.find_one_and_update(
+        {'job': job, 'running': True, 'tick': {'$lt': tick}, 'overlapped_tick': {'$ne': tick}},
+        {'$set': {'overlapped_tick': tick}, '$inc': {'overlaps': 1}},
+        projection={'_id': 0, 'tick': 1, 'owner': 1, 'started_at': 1}
+    )
+
+async def _renew_lease(job: str, tick: int) -> None:
+    while True:
+        await asyncio.sleep(SCHEDULER_LEASE_SECONDS / 3)
+        result = await db.scheduler_leases.update_one(
+            {'job': job, 'tick': tick, 'owner': WORKER_ID},
+            {'$set': {'lease_expires_at': datetime.now(timezone.utc) + timedelta(seconds=SCHEDULER_LEASE_SECONDS)}}
+        )
+        if not result.matched_count:
+            logger.warning(f"Scheduler lost the {job} lease for tick {tick}")
+            return
+
+async def run_scheduled_tick(job: str, fn, tick: int) -> Optional[str]:
+    """Run one tick of a job if this process wins it; returns the recorded outcome, None if another process ran it"""
+    now = datetime.now(timezone.utc)
+    previous = await claim_tick(job, tick, now)
+    run = {'id': str(uuid.uuid4()), 'job': job, 'tick': tick, 'owner': WORKER_ID, 'started_at': now}
+    if previous is None:
+        holder = await record_overlap(job, tick)
+        if not holder:
+            return None
+        logger.warning(f"Scheduler skipped {job} tick {tick}: tick {holder['tick']} on {holder['owner']} is still running")
+        metrics.SCHEDULER_TICKS.inc(job, 'overlap')
+        await db.scheduler_runs.insert_one({**run, 'outcome': 'overlap', 'running_tick': holder['tick'], 'running_owner': holder['owner']})
+        return 'overlap'
+    if previous.get('running'):
+        logger.warning(f"Scheduler took over the lapsed {job} lease of {previous['owner']} (tick {previous['tick']})")
+    
+    renewer = asyncio.create_task(_renew_lease(job, tick))
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        run['result'] = await fn()
+    except asyncio.CancelledError:
+        outcome = 'cancelled'
+        raise
+    except Exception as e:
+        outcome = 'failed'
+        run['error'] = str(e)
+        logger.error(f"Scheduled job {job} failed: {str(e)}")
+    finally:
+        renewer.cancel()
+        duration = time.perf_counter() - started
+        finished = datetime.now(timezone.utc)
+        metrics.SCHEDULER_TICKS.inc(job, outcome)
+        metrics.SCHEDULER_TICK_SECONDS.observe(duration, job)
+        await db.scheduler_leases.update_one(
+            {'job': job, 'tick': tick, 'owner': WORKER_ID},
+            {'$set': {'running': False, 'finished_at': finished, 'last_duration_s': round(duration, 3), 'last_outcome': outcome}}
+        )
+        await db.scheduler_runs.insert_one({**run, 'outcome': outcome, 'finished_at': finished, 'duration_s': round(duration, 3)})
+    return outcome
+
+async def _scheduled_tick(job: str, fn, tick: int) -> None:
+    try:
+        await run_scheduled_tick(job, fn, tick)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Scheduler error in {job} tick {tick}: {str(e)}")
+
+async def run_scheduler(job: str, interval: int, fn) -> None:
+    """Fire a tick at every multiple of interval; runs go in tasks so a slow run shows up as an overlap"""
+    running = set()
+    try:
+        while True:
+            tick = int(time.time() // interval) + 1
+            await asyncio.sleep(max(0.0, tick * interval - time.time()))
+            task = asyncio.create_task(_scheduled_tick(job, fn, tick))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+# ============= DASHBOARD STATS =============
+# Materialized counters behind /api/dashboard/stats, kept current by every write path
+STATS_ID = 'global'
+
+def is_low_stock(current_stock: int, initial_stock: int) -> bool:
+    return current_stock < initial_stock * LOW_STOCK_RATIO
+
+def expiry_bucket(expiry_date: datetime) -> str:
+    """Day bucket (UTC) an inventory row is counted under for the expiring-soon figure"""
+    if expiry_date.tzinfo is not None:
+        expiry_date = expiry_date.astimezone(timezone.utc)
+    return expiry_date.date().isoformat()
+
+async def bump_stats(deltas: dict) -> None:
+    """Apply counter deltas to the stats document in one atomic $inc; version tags the result for ETags"""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if deltas:
+        await db.dashboard_stats.update_one({'_id': STATS_ID}, {'$inc': {**deltas, 'version': 1}}, upsert=True)
+
+@metrics.track_task('stats_rebuild')
+async def rebuild_dashboard_stats() -> dict:
+    """Recompute every counter from the collections and replace the stats document.
+
+    This is the recovery/reconcile path and scans whole collections; it also
+    backfills the per-row low_stock flag the incremental path relies on.
+    """
+    low_stock_expr = {'$lt': ['$current_stock', {'$multiply': ['$initial_stock', LOW_STOCK_RATIO]}]}
+    await db.inventory.update_many({'$expr': low_stock_expr}, {'$set': {'low_stock': True}})
+    await db.inventory.update_many({'$expr': {'$not': [low_stock_expr]}}, {'$set': {'low_stock': False}})
+    
+    today = datetime.now(timezone.utc).date().isoformat()
+    expiry_by_day = {}
+    async for bucket in db.inventory.aggregate([
+        {'$group': {
+            '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': {'$toDate': '$expiry_date'}}},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'_id': {'$gte': today}}},
+    ]):
+        expiry_by_day[bucket['_id']] = bucket['count']
+    
+    stats = {
+        '_id': STATS_ID,
+        'total_batches': await db.batches.count_documents({}),
+        'total_inventory': await db.inventory.count_documents({}),
+        'total_manufacturers': await db.manufacturers.count_documents({}),
+        'unread_alerts': await db.alerts.count_documents({'is_read': False}),
+        'low_stock_count': await db.inventory.count_documents({'low_stock': True}),
+        'quality_issues': await db.batches.count_documents({'quality_status': QualityStatus.FAILED}),
+        'expiry_by_day': expiry_by_day,
+        'rebuilt_at': datetime.now(timezone.utc),
+    }
+    await db.dashboard_stats.replace_one({'_id': STATS_ID}, stats, upsert=True)
+    logger.info("Dashboard stats rebuilt")
+    return stats
+
+# ============= COLLECTION VERSIONS =============
+# Every write bumps a version counter for each collection it changes, after
+# the write itself. List and stats responses carry an ETag built from the
+# versions they were read at, so a client polling with If-None-Match gets a
+# 304 for one counter read. Unchanged pages are served from an in-process
+# cache keyed on URL and tag, without touching the collection. The epoch is
+# drawn when a counter is first created, so tags issued before the versions
+# collection was dropped never match again.
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 30))
+# Larger bodies (a full 1000-row page is typically well under this) are not cached
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 1024 * 1024))
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+async def bump_versions(*collections: str) -> None:
+    await db.collection_versions.bulk_write([
+        UpdateOne({'_id': name}, {'$inc': {'version': 1}, '$setOnInsert': {'epoch': uuid.uuid4().hex[:8]}}, upsert=True)
+        for name in collections
+    ], ordered=False)
+
+async def collection_etag(collection: str) -> str:
+    doc = await read_db.collection_versions.find_one({'_id': collection})
+    return f'"{doc["epoch"]}-{doc["version"]}"' if doc else '"0"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+async def conditional_response(etag: str, url: str, if_none_match: Optional[str], render) -> Response:
+    """304 when the client already holds etag, else the body cached for (url, etag).
+
+    render is awaited on a cache miss and returns (body, extra headers).
+    """
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    entry = response_cache.get((url, etag))
+    if entry is None:
+        entry = await render()
+        if len(entry[0]) <= RESPONSE_CACHE_MAX_BYTES:
+            response_cache.set((url, etag), entry)
+    body, extra_headers = entry
+    return Response(body, media_type='application/json', headers={**headers, **extra_headers})
+
+# ============= STOCK MOVEMENTS =============
+# Stock changes are single conditional updates: the filter guards against
+# going negative and an update pipeline recomputes current_stock and the
+# low_stock flag together, so concurrent movements never lose updates.
+# Every applied movement is appended to the stock_movements ledger.
+def _stock_filter(inventory_id: str, quantity_change: int) -> dict:
+    query = {'id': inventory_id}
+    if quantity_change < 0:
+        query['current_stock'] = {'$gte': -quantity_change}
+    return query
+
+def _stock_pipeline(quantity_change: int, now: datetime, marker: Optional[str] = None) -> list:
+    flags = {'low_stock': {'$lt': ['$current_stock', {'$multiply': ['$initial_stock', LOW_STOCK_RATIO]}]}}
+    if marker:
+        # Appends {k: marker, v: stock after this update}, so a bulk_write
+        # caller can tell which lines applied and what each one resulted in
+        flags['_pending_movements'] = {'$concatArrays': [
+            {'$ifNull': ['$_pending_movements', []]},
+            {'$objectToArray': {marker: '$current_stock'}},
+        ]}
+    return [
+        {'$set': {'current_stock': {'$add': ['$current_stock', quantity_change]}, 'last_updated': now}},
+        {'$set': flags},
+    ]
+
+def movement_reason(quantity_change: int, reason: Optional[MovementReason]) -> MovementReason:
+    if reason:
+        return reason
+    return MovementReason.DISPENSE if quantity_change < 0 else MovementReason.RESTOCK
+
+def build_movement(inventory: dict, quantity_change: int, resulting_stock: int, reason: MovementReason,
+                   reference: Optional[str], user: User) -> StockMovement:
+    return StockMovement(
+        inventory_id=inventory['id'],
+        batch_id=inventory['batch_id'],
+        batch_number=inventory['batch_number'],
+        product_name=inventory['product_name'],
+        location=inventory['location'],
+        quantity_change=quantity_change,
+        resulting_stock=resulting_stock,
+        reason=reason,
+        reference=reference,
+        performed_by=user.id
+    )
+
+async def record_stock_movements(movements: List[StockMovement]) -> None:
+    """Append to the ledger; every stock change lands here, so it also bumps the inventory version"""
+    if movements:
+        await db.stock_movements.insert_many([movement.model_dump() for movement in movements])
+        await bump_versions('inventory', 'stock_movements')
+        await update_consumption_rollups(movements)
+
+async def change_stock(inventory_id: str, quantity_change: int, guard: Optional[dict] = None) -> Optional[dict]:
+    """Conditionally apply a stock change; returns the updated row, or None when the filter did not match"""
+    query = _stock_filter(inventory_id, quantity_change)
+    if guard:
+        query.update(guard)
+    inventory = await db.inventory.find_one_and_update(
+        query,
+        _stock_pipeline(quantity_change, datetime.now(timezone.utc)),
+        projection={'_id': 0, 'id': 1, 'batch_id': 1, 'batch_number': 1, 'product_name': 1, 'location': 1,
+                    'expiry_date': 1, 'current_stock': 1, 'initial_stock': 1, 'low_stock': 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if inventory:
+        was_low = is_low_stock(inventory['current_stock'] - quantity_change, inventory['initial_stock'])
+        await bump_stats({'low_stock_count': int(inventory['low_stock']) - int(was_low)})
+    return inventory
+
+async def apply_stock_movement(inventory_id: str, quantity_change: int, reason: Optional[MovementReason],
+                               reference: Optional[str], user: User) -> StockMovement:
+    """Atomically apply one movement and append it to the ledger"""
+    inventory = await change_stock(inventory_id, quantity_change)
+    if not inventory:
+        if not await db.inventory.find_one({'id': inventory_id}, {'_id': 1}):
+            raise HTTPException(status_code=404, detail="Inventory not found")
+        raise HTTPException(status_code=400, detail="Insufficient stock")
+    
+    movement = build_movement(inventory, quantity_change, inventory['current_stock'],
+                              movement_reason(quantity_change, reason), reference, user)
+    await record_stock_movements([movement])
+    return movement
+
+async def apply_stock_movements(lines: List[StockMovementLine], user: User) -> List[dict]:
+    """Apply many movements with one ordered bulk_write and report the outcome of each line.
+
+    Lines for the same inventory row apply in request order. Each line's
+    resulting stock is the value its own update recorded next to its marker,
+    so movements landing on the same rows concurrently do not skew it.
+    """
+    now = datetime.now(timezone.utc)
+    markers = [str(uuid.uuid4()) for _ in lines]
+    inventory_ids = list({line.inventory_id for line in lines})
+    try:
+        await db.inventory.bulk_write([
+            UpdateOne(_stock_filter(line.inventory_id, line.quantity_change), _stock_pipeline(line.quantity_change, now, marker))
+            for line, marker in zip(lines, markers)
+        ], ordered=True)
+        rows = {
+            row['id']: row
+            async for row in db.inventory.find(
+                {'id': {'$in': inventory_ids}},
+                {'_id': 0, 'id': 1, 'batch_id': 1, 'batch_number': 1, 'product_name': 1, 'location': 1,
+                 'initial_stock': 1, '_pending_movements': 1}
+            )
+        }
+    finally:
+        await db.inventory.update_many(
+            {'id': {'$in': inventory_ids}}, {'$pull': {'_pending_movements': {'k': {'$in': markers}}}}
+        )
+    
+    results = []
+    low_stock_delta = 0
+    recorded = {entry['k']: entry['v'] for row in rows.values() for entry in row.get('_pending_movements', [])}
+    for line, marker in zip(lines, markers):
+        row = rows.get(line.inventory_id)
+        if not row:
+            results.append({'inventory_id': line.inventory_id, 'applied': False, 'error': "Inventory not found"})
+        elif marker not in recorded:
+            results.append({'inventory_id': line.inventory_id, 'applied': False, 'error': "Insufficient stock"})
+        else:
+            stock = recorded[marker]
+            results.append({'inventory_id': line.inventory_id, 'applied': True, 'new_stock': stock})
+            low_stock_delta += (int(is_low_stock(stock, row['initial_stock']))
+                                - int(is_low_stock(stock - line.quantity_change, row['initial_stock'])))
+    await bump_stats({'low_stock_count': low_stock_delta})
+    
+    movements = []
+    for line, result in zip(lines, results):
+        if result['applied']:
+            movement = build_movement(rows[line.inventory_id], line.quantity_change, result['new_stock'],
+                                      movement_reason(line.quantity_change, line.reason), line.reference, user)
+            result['movement_id'] = movement.id
+            movements.append(movement)
+    await record_stock_movements(movements)
+    return results
+
+# ============= CONSUMPTION ROLLUPS =============
+# Every ledger write is folded into hourly and daily buckets per
+# (product, location) and per product across locations (location '*'), so
+# trend and forecast queries read a handful of small documents instead of
+# the movement history. Buckets are plain documents updated with $inc
+# upserts; hourly buckets expire after ROLLUP_HOURLY_RETENTION_DAYS.
+ROLLUP_HOURLY_RETENTION_DAYS = int(os.getenv('ROLLUP_HOURLY_RETENTION_DAYS', 90))
+ALL_LOCATIONS = '*'
+
+def rollup_bucket(moment: datetime, granularity: RollupGranularity) -> datetime:
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    moment = moment.replace(minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+    return moment.replace(hour=0) if granularity == RollupGranularity.DAY else moment
+
+def _rollup_increments(movements) -> dict:
+    """Sum movements per bucket key: consumed counts dispensed and allocated units"""
+    buckets = {}
+    for movement in movements:
+        change = movement['quantity_change']
+        reason = movement['reason']
+        if reason in (MovementReason.DISPENSE, MovementReason.ALLOCATION) and change < 0:
+            field = 'consumed'
+            change = -change
+        elif reason == MovementReason.RESTOCK:
+            field = 'restocked'
+        else:
+            field = 'adjusted'
+        for granularity in RollupGranularity:
+            bucket = rollup_bucket(movement['created_at'], granularity)
+            for location in (movement['location'], ALL_LOCATIONS):
+                totals = buckets.setdefault((granularity.value, movement['product_name'], location, bucket),
+                                            {'consumed': 0, 'restocked': 0, 'adjusted': 0, 'movements': 0})
+                totals[field] += change
+                totals['movements'] += 1
+    return buckets
+
+async def _write_rollups(buckets: dict) -> None:
+    operations = []
+    for (granularity, product_name, location, bucket), totals in buckets.items():
+        on_insert = {}
+        if granularity == RollupGranularity.HOUR:
+            on_insert['expires_at'] = bucket + timedelta(days=ROLLUP_HOURLY_RETENTION_DAYS)
+        update = {'$inc': totals}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        operations.append(UpdateOne(
+            {'granularity': granularity, 'product_name': product_name, 'location': location, 'bucket': bucket},
+            update,
+            upsert=True
+        ))
+    if operations:
+        await db.consumption_rollups.bulk_write(operations, ordered=False)
 
-async def check_and_create_alerts():
-    """Background task to check inventory and create alerts"""
+async def update_consumption_rollups(movements: List[StockMovement]) -> None:
+    await _write_rollups(_rollup_increments(movement.model_dump() for movement in movements))
+
+async def rebuild_consumption_rollups(batch_size: int = 5000) -> int:
+    """Replay the whole stock_movements ledger into fresh rollups; returns the movements read"""
+    await db.consumption_rollups.delete_many({})
+    replayed = 0
+    chunk = []
+    async for movement in db.stock_movements.find(
+        {}, {'_id': 0, 'product_name': 1, 'location': 1, 'quantity_change': 1, 'reason': 1, 'created_at': 1},
+        batch_size=batch_size
+    ):
+        chunk.append(movement)
+        if len(chunk) >= batch_size:
+            await _write_rollups(_rollup_increments(chunk))
+            replayed += len(chunk)
+            chunk = []
+    if chunk:
+        await _write_rollups(_rollup_increments(chunk))
+        replayed += len(chunk)
+    return replayed
+
+async def on_hand_stock(product_names: List[str], location: str, now: datetime) -> dict:
+    """Non-expired units per product, optionally at one location"""
+    match = {'product_name': {'$in': product_names}, 'expiry_date': {'$gt': now}}
+    if location != ALL_LOCATIONS:
+        match['location'] = location
+    return {
+        row['_id']: row['units']
+        async for row in read_db.inventory.aggregate([
+            {'$match': match},
+            {'$group': {'_id': '$product_name', 'units': {'$sum': '$current_stock'}}},
+        ])
+    }
+
+def supply_forecast(product_name: str, consumed: int, window_days: int, on_hand: int, now: datetime) -> dict:
+    daily_rate = consumed / window_days
+    days_of_supply = on_hand / daily_rate if daily_rate else None
+    return {
+        "product_name": product_name,
+        "consumed": consumed,
+        "daily_rate": round(daily_rate, 3),
+        "on_hand": on_hand,
+        "days_of_supply": round(days_of_supply, 1) if days_of_supply is not None else None,
+        "projected_stockout_date": (now + timedelta(days=days_of_supply)).date().isoformat() if days_of_supply is not None else None,
+    }
+
+# ============= ALLOCATION =============
+# First-expiry-first-out dispensing. Candidate rows are read in expiry order
+# from the (product_name, expiry_date, id) index, preferred locations first,
+# and each is reserved with the same conditional update as a stock movement;
+# the guard re-checks expiry and QC status so a row failing QC mid-allocation
+# is skipped. An allocation that cannot be filled is rolled back unless
+# partial allocation was requested.
+def allocatable_filter(now: datetime) -> dict:
+    return {'expiry_date': {'$gt': now}, 'quality_status': QualityStatus.PASSED}
+
+async def backfill_inventory_quality_status(batch_size: int = 1000) -> int:
+    """Copy each batch's quality_status onto its inventory rows; returns the rows changed"""
+    async def copy(status: str, batch_ids: list) -> int:
+        result = await db.inventory.update_many(
+            {'batch_id': {'$in': batch_ids}, 'quality_status': {'$ne': status}},
+            {'$set': {'quality_status': status}}
+        )
+        return result.modified_count
+    
+    updated = 0
+    pending = {}
+    async for batch in db.batches.find({}, {'_id': 0, 'id': 1, 'quality_status': 1}):
+        batch_ids = pending.setdefault(batch.get('quality_status', QualityStatus.PENDING), [])
+        batch_ids.append(batch['id'])
+        if len(batch_ids) >= batch_size:
+            updated += await copy(batch.get('quality_status', QualityStatus.PENDING), batch_ids)
+            batch_ids.clear()
+    for status, batch_ids in pending.items():
+        if batch_ids:
+            updated += await copy(status, batch_ids)
+    if updated:
+        await bump_versions('inventory')
+    return updated
+
+async def _allocation_candidates(input: AllocationInput, now: datetime):
+    query = {'product_name': input.product_name, 'current_stock': {'$gt': 0}, **allocatable_filter(now)}
+    projection = {'_id': 0, 'id': 1, 'batch_id': 1, 'batch_number': 1, 'location': 1, 'expiry_date': 1, 'current_stock': 1}
+    passes = [{'location': location} for location in input.preferred_locations]
+    if not input.only_preferred:
+        passes.append({'location': {'$nin': input.preferred_locations}} if input.preferred_locations else {})
+    for location in passes:
+        async for row in db.inventory.find({**query, **location}, projection).sort([('expiry_date', ASCENDING), ('id', ASCENDING)]):
+            yield row
+
+async def allocate(input: AllocationInput, user: User, reference: Optional[str] = None) -> dict:
+    """Plan and, unless dry_run, reserve an allocation; the ledger records one movement per row"""
+    now = datetime.now(timezone.utc)
+    guard = allocatable_filter(now)
+    reference = input.reference or reference
+    remaining = input.quantity
+    allocations = []
+    reserved = []
+    async for row in _allocation_candidates(input, now):
+        if remaining <= 0:
+            break
+        take = min(row['current_stock'], remaining)
+        inventory = None
+        while take > 0 and not input.dry_run:
+            inventory = await change_stock(row['id'], -take, guard)
+            if inventory:
+                break
+            # Another request took some of this row meanwhile; retry with what is left
+            fresh = await db.inventory.find_one({'id': row['id'], **guard}, {'_id': 0, 'current_stock': 1})
+            take = min(fresh['current_stock'], remaining) if fresh else 0
+        if take <= 0:
+            continue
+        remaining -= take
+        allocations.append({
+            'inventory_id': row['id'],
+            'batch_id': row['batch_id'],
+            'batch_number': row['batch_number'],
+            'location': row['location'],
+            'expiry_date': row['expiry_date'],
+            'quantity': take,
+            'remaining_stock': inventory['current_stock'] if inventory else row['current_stock'] - take,
+        })
+        if inventory:
+            reserved.append((inventory, take))
+    
+    allocated = input.quantity - remaining
+    result = {
+        'product_name': input.product_name,
+        'requested': input.quantity,
+        'allocated': allocated,
+        'fulfilled': remaining == 0,
+        'dry_run': input.dry_run,
+        'allocations': allocations,
+    }
+    if remaining and not input.allow_partial:
+        for inventory, take in reserved:
+            await change_stock(inventory['id'], take)
+        if reserved:
+            await bump_versions('inventory')
+        result['allocations'] = []
+        result['error'] = f"Only {allocated} of {input.quantity} units can be allocated"
+        return result
+    
+    movements = [
+        build_movement(inventory, -take, inventory['current_stock'], MovementReason.ALLOCATION, reference, user)
+        for inventory, take in reserved
+    ]
+    for allocation, movement in zip(allocations, movements):
+        allocation['movement_id'] = movement.id
+    await record_stock_movements(movements)
+    return result
+
+# ============= SEARCH =============
+# Typeahead over the identifying fields of each searchable collection. Every
+# document stores _search: the normalized (case- and accent-folded,
+# alphanumeric-only) value of each field from every word onwards, so
+# "Amoxicillin 500 mg" is found by "amox", "500m" and "500 mg". An anchored
+# regex on the multikey _search index reads only the matching key range, in
+# key order, so exact and shortest matches come first. When no prefix
+# matches, the text index is tried for stemmed whole-word matches.
+SEARCH_FIELDS = {
+    'batches': ('batch_number', 'product_name', 'manufacturer_name'),
+    'manufacturers': ('name', 'license_number', 'contact_email'),
+    'inventory': ('product_name', 'batch_number', 'location'),
+}
+SEARCH_MAX_WORDS = 8
+SEARCH_MAX_RESULTS = 50
+# Prefix candidates read per requested result, for ranking across fields
+SEARCH_CANDIDATE_FACTOR = 4
+_SEARCH_WORD = re.compile(r'[^\W_]+')
+
+def search_words(value) -> list:
+    folded = unicodedata.normalize('NFKD', str(value)).casefold()
+    return _SEARCH_WORD.findall(''.join(c for c in folded if not unicodedata.combining(c)))
+
+def search_key(value) -> str:
+    return ''.join(search_words(value))
+
+def search_keys(doc: dict, fields: tuple) -> list:
+    keys = []
+    for field in fields:
+        words = search_words(doc.get(field) or '')[:SEARCH_MAX_WORDS]
+        keys.extend(''.join(words[i:]) for i in range(len(words)))
+    return sorted(set(keys))
+
+def add_search_keys(collection: str, doc: dict) -> dict:
+    """Set the _search keys on a document about to be written; returns it"""
+    doc['_search'] = search_keys(doc, SEARCH_FIELDS[collection])
+    return doc
+
+def rank_match(doc: dict, fields: tuple, key: str) -> tuple:
+    """(score, field) of the best match: 3 exact, 2 whole-value prefix, 1 word prefix, 0 text-only"""
+    best = (0, None)
+    for field in fields:
+        words = search_words(doc.get(field) or '')
+        value = ''.join(words)
+        if value == key:
+            score = 3
+        elif value.startswith(key):
+            score = 2
+        elif any(''.join(words[i:]).startswith(key) for i in range(1, len(words))):
+            score = 1
+        else:
+            continue
+        if score > best[0]:
+            best = (score, field)
+    return best
+
+async def search_collection(collection: str, q: str, limit: int) -> list:
+    key = search_key(q)
+    if not key:
+        return []
+    fields = SEARCH_FIELDS[collection]
+    projection = {**HIDDEN_FIELDS, '_search': 0}
+    docs = await read_db[collection].find(
+        {'_search': {'$regex': f"^{re.escape(key)}"}}, projection
+    ).limit(limit * SEARCH_CANDIDATE_FACTOR).to_list(None)
+    if not docs:
+        docs = await read_db[collection].find(
+            {'$text': {'$search': q}}, {**projection, '_score': {'$meta': 'textScore'}}
+        ).sort([('_score', {'$meta': 'textScore'})]).limit(limit).to_list(None)
+    
+    results = []
+    for doc in docs:
+        text_score = doc.pop('_score', 0)
+        score, field = rank_match(doc, fields, key)
+        results.append({
+            'type': collection,
+            'score': score,
+            'matched_field': field,
+            'item': doc,
+            '_order': (-score, -text_score, fields.index(field) if field else len(fields), len(str(doc.get(field, ''))) if field else 0),
+        })
+    results.sort(key=lambda r: r['_order'])
+    return results[:limit]
+
+async def search(q: str, collections: List[str], limit: int) -> list:
+    grouped = await asyncio.gather(*(search_collection(collection, q, limit) for collection in collections))
+    results = sorted((r for group in grouped for r in group), key=lambda r: r['_order'])[:limit]
+    for r in results:
+        del r['_order']
+    return results
+
+async def backfill_search_keys(batch_size: int = 1000) -> dict:
+    """Set _search on every document that lacks it; returns the documents updated per collection"""
+    updated = {}
+    for collection, fields in SEARCH_FIELDS.items():
+        updated[collection] = 0
+        writes = []
+        projection = {'_id': 0, 'id': 1, **{field: 1 for field in fields}}
+        async for doc in db[collection].find({'_search': {'$exists': False}}, projection):
+            writes.append(UpdateOne({'id': doc['id']}, {'$set': {'_search': search_keys(doc, fields)}}))
+            if len(writes) >= batch_size:
+                updated[collection] += (await db[collection].bulk_write(writes, ordered=False)).modified_count
+                writes = []
+        if writes:
+            updated[collection] += (await db[collection].bulk_write(writes, ordered=False)).modified_count
+    return updated
+
+# ============= BULK IMPORT =============
+# Imports stream the request body line by line, validate each row with the
+# same input model as the single-record endpoint, and write in insert_many
+# chunks. CSV input is one record per line, with a header row. Lines longer
+# than IMPORT_MAX_LINE_BYTES are dropped as they arrive and reported as row
+# errors, like lines that are not valid UTF-8.
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 1000))
+IMPORT_MAX_LINE_BYTES = int(os.getenv('IMPORT_MAX_LINE_BYTES', 1024 * 1024))
+IMPORT_MAX_ERRORS = 1000
+
+def _decode_line(line: bytes) -> tuple:
+    if len(line) > IMPORT_MAX_LINE_BYTES:
+        return None, f"Line exceeds {IMPORT_MAX_LINE_BYTES} bytes"
     try:
-        # Check for expiring batches (within 30 days)
-        thirty_days_from_now = datetime.now(timezone.utc) + timedelta(days=30)
-        expiring_batches = await db.inventory.find({
-            'expiry_date': {'$lte': thirty_days_from_now.isoformat(), '$gte': datetime.now(timezone.utc).isoformat()}
-        }).to_list(1000)
+        return line.decode('utf-8-sig').rstrip('\r'), None
+    except UnicodeDecodeError as e:
+        return None, f"Invalid UTF-8 at byte {e.start}"
+
+async def _iter_lines(stream):
+    """Yield (line, error) for every line of the body; error is set instead of line for a bad line"""
+    buffer = b''
+    overflow = False
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if overflow:
+                # The tail of a line whose head was already dropped
+                overflow = False
+                yield None, f"Line exceeds {IMPORT_MAX_LINE_BYTES} bytes"
+            else:
+                yield _decode_line(line)
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            overflow = True
+            buffer = b''
+    if overflow:
+        yield None, f"Line exceeds {IMPORT_MAX_LINE_BYTES} bytes"
+    elif buffer:
+        yield _decode_line(buffer)
+
+async def _iter_records(lines, fmt: str):
+    """Yield (row_number, record, error) for every non-blank data line"""
+    header = None
+    row_number = 0
+    async for line, error in lines:
+        if error:
+            if fmt == 'csv' and header is None:
+                raise HTTPException(status_code=400, detail=f"Invalid CSV header: {error}")
+            row_number += 1
+            yield row_number, None, error
+            continue
+        if not line.strip():
+            continue
+        if fmt == 'csv':
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            row_number += 1
+            # Empty cells fall back to the model defaults
+            yield row_number, {name: value for name, value in zip(header, values) if value != ''}, None
+        else:
+            row_number += 1
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row_number, None, f"Invalid JSON: {str(e)}"
+                continue
+            if not isinstance(record, dict):
+                yield row_number, None, "Expected a JSON object"
+                continue
+            yield row_number, record, None
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in error.errors())
+
+class BulkImport:
+    """Accumulates validated rows of one kind and writes them chunk by chunk"""
+    INPUT_MODELS = {
+        ImportKind.MANUFACTURERS: ManufacturerInput,
+        ImportKind.BATCHES: BatchInput,
+        ImportKind.INVENTORY: InventoryInput,
+    }
+    
+    def __init__(self, kind: ImportKind):
+        self.kind = kind
+        self.pending = []
+        self.manufacturers = None
+        self.batches = {}
+        self.report = {'kind': kind.value, 'rows': 0, 'inserted': 0, 'failed': 0, 'errors': [], 'errors_truncated': False}
+    
+    def error(self, row: int, message: str) -> None:
+        self.report['failed'] += 1
+        if len(self.report['errors']) < IMPORT_MAX_ERRORS:
+            self.report['errors'].append({'row': row, 'error': message})
+        else:
+            self.report['errors_truncated'] = True
+    
+    async def add(self, row: int, record: dict) -> None:
+        self.report['rows'] += 1
+        try:
+            self.pending.append((row, self.INPUT_MODELS[self.kind](**record)))
+        except ValidationError as e:
+            self.error(row, _validation_message(e))
+            return
+        if len(self.pending) >= IMPORT_CHUNK_SIZE:
+            await self.flush()
+    
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        chunk, self.pending = self.pending, []
+        if self.kind == ImportKind.MANUFACTURERS:
+            rows = [(row, Manufacturer(**item.model_dump())) for row, item in chunk]
+        elif self.kind == ImportKind.BATCHES:
+            rows = await self._resolve_batches(chunk)
+        else:
+            rows = await self._resolve_inventory(chunk)
+        if not rows:
+            return
         
-        for inv in expiring_batches:
-            existing_alert = await db.alerts.find_one({
-                'batch_id': inv['batch_id'],
-                'alert_type': AlertType.EXPIRY_WARNING
-            })
-            if not existing_alert:
-                alert = Alert(
-                    alert_type=AlertType.EXPIRY_WARNING,
-                    title="Batch Expiring Soon",
-                    message=f"{inv['product_name']} (Batch: {inv['batch_number']}) expires soon",
-                    batch_id=inv['batch_id'],
-                    batch_number=inv['batch_number'],
-                    severity="medium"
-                )
-                alert_dict = alert.model_dump()
-                alert_dict['created_at'] = alert_dict['created_at'].isoformat()
-                await db.alerts.insert_one(alert_dict)
+        docs = [add_search_keys(self.kind.value, model.model_dump()) for _, model in rows]
+        if self.kind == ImportKind.INVENTORY:
+            for doc in docs:
+                doc['low_stock'] = is_low_stock(doc['current_stock'], doc['initial_stock'])
+        failed = set()
+        try:
+            await db[self.kind.value].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get('writeErrors', []):
+                failed.add(write_error['index'])
+                self.error(rows[write_error['index']][0], write_error.get('errmsg', "Write failed"))
+        inserted = [doc for index, doc in enumerate(docs) if index not in failed]
+        self.report['inserted'] += len(inserted)
+        await self._after_insert(inserted)
+    
+    async def _resolve_batches(self, chunk: list) -> list:
+        if self.manufacturers is None:
+            # Built once per import; manufacturer lists are small
+            self.manufacturers = {
+                m['id']: m['name'] async for m in db.manufacturers.find({}, {'_id': 0, 'id': 1, 'name': 1})
+            }
+        rows = []
+        for row, item in chunk:
+            name = self.manufacturers.get(item.manufacturer_id)
+            if name is None:
+                self.error(row, "Manufacturer not found")
+                continue
+            rows.append((row, Batch(**item.model_dump(), manufacturer_name=name, status=BatchStatus.IN_PRODUCTION)))
+        return rows
+    
+    async def _resolve_inventory(self, chunk: list) -> list:
+        # Batches are looked up once per distinct id across the whole import
+        missing = {item.batch_id for _, item in chunk} - self.batches.keys()
+        if missing:
+            async for batch in db.batches.find(
+                {'id': {'$in': list(missing)}},
+                {'_id': 0, 'id': 1, 'batch_number': 1, 'product_name': 1, 'expiry_date': 1, 'quality_status': 1}
+            ):
+                self.batches[batch['id']] = batch
+            for batch_id in missing - self.batches.keys():
+                self.batches[batch_id] = None
+        rows = []
+        for row, item in chunk:
+            batch = self.batches.get(item.batch_id)
+            if batch is None:
+                self.error(row, "Batch not found")
+                continue
+            rows.append((row, Inventory(
+                batch_id=item.batch_id,
+                batch_number=batch['batch_number'],
+                product_name=batch['product_name'],
+                current_stock=item.initial_stock,
+                initial_stock=item.initial_stock,
+                expiry_date=batch['expiry_date'],
+                location=item.location,
+                quality_status=batch.get('quality_status', QualityStatus.PENDING)
+            )))
+        return rows
+    
+    async def _after_insert(self, docs: list) -> None:
+        if not docs:
+            return
+        if self.kind == ImportKind.MANUFACTURERS:
+            await bump_stats({'total_manufacturers': len(docs)})
+            if self.manufacturers is not None:
+                self.manufacturers.update({doc['id']: doc['name'] for doc in docs})
+        elif self.kind == ImportKind.BATCHES:
+            await bump_stats({'total_batches': len(docs)})
+        else:
+            deltas = {'total_inventory': len(docs), 'low_stock_count': sum(1 for doc in docs if doc['low_stock'])}
+            for doc in docs:
+                key = f"expiry_by_day.{expiry_bucket(doc['expiry_date'])}"
+                deltas[key] = deltas.get(key, 0) + 1
+            await bump_stats(deltas)
+            await db.batches.update_many(
+                {'id': {'$in': list({doc['batch_id'] for doc in docs})}},
+                {'$set': {'status': BatchStatus.IN_STOCK}}
+            )
+        await bump_versions(*([self.kind.value, 'batches'] if self.kind == ImportKind.INVENTORY else [self.kind.value]))
+
+@metrics.track_task('bulk_import')
+async def run_import(kind: ImportKind, stream, fmt: str) -> dict:
+    started = time.perf_counter()
+    importer = BulkImport(kind)
+    async for row, record, error in _iter_records(_iter_lines(stream), fmt):
+        if error:
+            importer.report['rows'] += 1
+            importer.error(row, error)
+        else:
+            await importer.add(row, record)
+    await importer.flush()
+    
+    elapsed = time.perf_counter() - started
+    report = importer.report
+    report['errors'].sort(key=lambda e: e['row'])
+    report['elapsed_s'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['rows'] / elapsed, 1) if elapsed > 0 else None
+    logger.info(f"Imported {report['inserted']}/{report['rows']} {kind.value} rows in {elapsed:.2f}s ({report['rows_per_second']} rows/s)")
+    return report
+
+# ============= TRACEABILITY =============
+RECALL_MAX_BATCHES = int(os.getenv('RECALL_MAX_BATCHES', 10000))
+
+def traceability_pipeline(match: dict, limit: Optional[int] = None) -> list:
+    """Batch plus every inventory location, its quality history and manufacturer in one aggregation.
+
+    limit caps the batches before they are joined.
+    """
+    return [
+        {'$match': match},
+        *([{'$limit': limit}] if limit else []),
+        {'$lookup': {'from': 'inventory', 'localField': 'id', 'foreignField': 'batch_id', 'as': 'inventory'}},
+        {'$lookup': {'from': 'quality_reports', 'localField': 'id', 'foreignField': 'batch_id', 'as': 'quality_reports'}},
+        {'$lookup': {'from': 'manufacturers', 'localField': 'manufacturer_id', 'foreignField': 'id', 'as': 'manufacturer'}},
+        {'$project': {
+            '_id': 0, '_search': 0,
+            'inventory._id': 0, 'inventory.low_stock': 0, 'inventory._pending_movements': 0, 'inventory._search': 0,
+            'quality_reports._id': 0,
+            'manufacturer._id': 0, 'manufacturer._search': 0,
+        }},
+    ]
+
+def split_traceability(doc: dict) -> dict:
+    inventory = doc.pop('inventory')
+    quality_reports = sorted(doc.pop('quality_reports'), key=lambda r: r['test_date'], reverse=True)
+    manufacturer = doc.pop('manufacturer')
+    return {
+        "batch": doc,
+        "inventory": inventory,
+        "quality_reports": quality_reports,
+        "manufacturer": manufacturer[0] if manufacturer else None
+    }
+
+# ============= LIST QUERIES =============
+# Keyset pagination shared by every list endpoint: results are ordered by
+# (sort_field, id) and the X-Next-Cursor header carries the position after
+# the last returned row.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+NDJSON_CHUNK_SIZE = 500
+# Internal bookkeeping fields that never leave the API
+HIDDEN_FIELDS = {'_id': 0, 'low_stock': 0, '_pending_movements': 0, '_search': 0}
+# Public model of each listed collection; ?fields= may only name its fields
+LIST_MODELS = {
+    'manufacturers': Manufacturer,
+    'batches': Batch,
+    'inventory': Inventory,
+    'stock_movements': StockMovement,
+    'quality_reports': QualityReport,
+    'alerts': Alert,
+}
+LIST_ADAPTERS = {collection: TypeAdapter(List[model]) for collection, model in LIST_MODELS.items()}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        # Same form Pydantic emits for response models: UTC as 'Z'
+        if value.utcoffset() == timedelta(0):
+            return value.replace(tzinfo=None).isoformat() + 'Z'
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_json(value) -> bytes:
+    """Encode raw documents without model validation, with orjson when installed"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default, option=orjson.OPT_UTC_Z)
+    return json.dumps(value, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+def field_projection(collection: str, fields: Optional[str], sort_field: str) -> dict:
+    """Mongo projection for ?fields=; id and the sort field are kept for the cursor"""
+    if not fields:
+        return HIDDEN_FIELDS
+    requested = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown = requested - set(LIST_MODELS[collection].model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return {'_id': 0, 'id': 1, sort_field: 1, **{name: 1 for name in requested}}
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    value = doc.get(sort_field)
+    payload = {
+        'v': value.isoformat() if isinstance(value, datetime) else value,
+        'dt': isinstance(value, datetime),
+        'id': doc['id'],
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        value = datetime.fromisoformat(payload['v']) if payload['dt'] else payload['v']
+        return value, payload['id']
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def date_range(field: str, date_from: Optional[datetime], date_to: Optional[datetime]) -> dict:
+    bounds = {}
+    if date_from:
+        bounds['$gte'] = date_from
+    if date_to:
+        bounds['$lte'] = date_to
+    return {field: bounds} if bounds else {}
+
+def _paged_query(query: dict, sort_field: str, direction: int, cursor: Optional[str]) -> dict:
+    if not cursor:
+        return query
+    value, last_id = decode_cursor(cursor)
+    op = '$gt' if direction == ASCENDING else '$lt'
+    after = {'$or': [{sort_field: {op: value}}, {sort_field: value, 'id': {op: last_id}}]}
+    return {'$and': [query, after]} if query else after
+
+async def list_page(collection: str, query: dict, sort_field: str, direction: int,
+                    limit: int, cursor: Optional[str], response: Response, projection: dict = HIDDEN_FIELDS) -> list:
+    """Fetch one page and set X-Next-Cursor when more rows follow"""
+    docs = await read_db[collection].find(
+        _paged_query(query, sort_field, direction, cursor), projection
+    ).sort([(sort_field, direction), ('id', direction)]).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers['X-Next-Cursor'] = encode_cursor(docs[-1], sort_field)
+    return docs
+
+def stream_ndjson(collection: str, query: dict, sort_field: str, direction: int,
+                  limit: Optional[int], cursor: Optional[str], projection: dict = HIDDEN_FIELDS) -> StreamingResponse:
+    """Stream matching documents straight from the Motor cursor, one JSON object per line"""
+    # Decoded before the response starts, so a bad cursor is still a 400
+    paged = _paged_query(query, sort_field, direction, cursor)
+
+    async def lines():
+        find = read_db[collection].find(paged, projection, batch_size=NDJSON_CHUNK_SIZE).sort(
+            [(sort_field, direction), ('id', direction)]
+        )
+        if limit:
+            find = find.limit(limit)
+        chunk = []
+        async for doc in find:
+            chunk.append(dumps_json(doc))
+            if len(chunk) >= NDJSON_CHUNK_SIZE:
+                yield b'\n'.join(chunk) + b'\n'
+                chunk = []
+        if chunk:
+            yield b'\n'.join(chunk) + b'\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+async def list_response(collection: str, query: dict, sort_field: str, direction: int, page: dict, response: Response):
+    """Dispatch a list request to the paged JSON path, the raw fast path or the NDJSON stream.
+
+    The default path validates every row against the endpoint's response model.
+    With ?fast=true or ?fields= the stored documents are encoded directly,
+    skipping validation. The values are the same, but fields keep their
+    stored order, and model defaults are absent from documents written
+    before those fields existed.
+    JSON pages are tagged with the collection version and cached (see
+    COLLECTION VERSIONS); NDJSON streams are not.
+    """
+    projection = field_projection(collection, page['fields'], sort_field)
+    if page['format'] == 'ndjson':
+        return stream_ndjson(collection, query, sort_field, direction, page['limit'], page['cursor'], projection)
+    
+    async def render():
+        docs = await list_page(collection, query, sort_field, direction, page['limit'] or DEFAULT_PAGE_SIZE, page['cursor'], response, projection)
+        if page['fast'] or page['fields']:
+            body = dumps_json(docs)
+        else:
+            # The validation and encoding FastAPI would apply for response_model
+            adapter = LIST_ADAPTERS[collection]
+            body = adapter.dump_json(adapter.validate_python(docs))
+        return body, {'X-Next-Cursor': response.headers['X-Next-Cursor']} if 'X-Next-Cursor' in response.headers else {}
+    
+    return await conditional_response(await collection_etag(collection), page['url'], page['if_none_match'], render)
+
+def request_key(request: Request) -> str:
+    """Path plus sorted query string, so parameter order does not split the response cache"""
+    return f"{request.url.path}?{urlencode(sorted(request.query_params.multi_items()))}"
+
+def page_params(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size (JSON defaults to 1000, NDJSON to unlimited)"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor value from the previous page"),
+    format: str = Query('json', pattern='^(json|ndjson)$', description="ndjson streams every matching row"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return; id and the sort field are always included"),
+    fast: bool = Query(False, description="Encode stored documents directly instead of validating each row"),
+) -> dict:
+    return {
+        'limit': limit, 'cursor': cursor, 'format': format, 'fields': fields, 'fast': fast,
+        'url': request_key(request), 'if_none_match': request.headers.get('if-none-match'),
+    }
+
+# ============= DATE MIGRATION =============
+# Fields that older releases stored as ISO-8601 strings
+DATE_FIELDS = {
+    'users': ['created_at'],
+    'user_sessions': ['expires_at', 'created_at'],
+    'manufacturers': ['created_at'],
+    'batches': ['production_date', 'expiry_date', 'created_at'],
+    'inventory': ['expiry_date', 'last_updated'],
+    'quality_reports': ['test_date', 'created_at'],
+    'alerts': ['created_at'],
+}
+
+def parse_legacy_date(value: str) -> Optional[datetime]:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+async def migrate_dates_to_bson(batch_size: int = 1000, restart: bool = False, progress=None) -> dict:
+    """Convert string date fields to BSON datetimes in place, batch by batch.
+
+    Progress is checkpointed per collection in the migrations collection, so
+    an interrupted run resumes after the last converted _id. Each document is
+    only rewritten if its string values are unchanged, which makes the
+    migration safe to run while the API is serving writes.
+    """
+    summary = {}
+    for collection, fields in DATE_FIELDS.items():
+        checkpoint_id = f"bson_dates:{collection}"
+        if restart:
+            await db.migrations.delete_one({'_id': checkpoint_id})
+        checkpoint = await db.migrations.find_one({'_id': checkpoint_id}) or {}
+        if checkpoint.get('done'):
+            summary[collection] = {'converted': checkpoint.get('converted', 0), 'skipped': checkpoint.get('skipped', 0)}
+            continue
         
-        # Check for low stock (less than 10% of initial stock)
-        low_stock_items = await db.inventory.find({}).to_list(1000)
-        for inv in low_stock_items:
-            if inv['current_stock'] < inv['initial_stock'] * 0.1:
-                existing_alert = await db.alerts.find_one({
-                    'batch_id': inv['batch_id'],
-                    'alert_type': AlertType.LOW_STOCK
-                })
-                if not existing_alert:
-                    alert = Alert(
-                        alert_type=AlertType.LOW_STOCK,
-                        title="Low Stock Alert",
-                        message=f"Low stock for {inv['product_name']} (Batch: {inv['batch_number']})",
-                        batch_id=inv['batch_id'],
-                        batch_number=inv['batch_number'],
-                        severity="high"
-                    )
-                    alert_dict = alert.model_dump()
-                    alert_dict['created_at'] = alert_dict['created_at'].isoformat()
-                    await db.alerts.insert_one(alert_dict)
+        pending = {'$or': [{field: {'$type': 'string'}} for field in fields]}
+        if checkpoint.get('last_id') is not None:
+            pending = {'$and': [pending, {'_id': {'$gt': checkpoint['last_id']}}]}
+        total = await db[collection].count_documents(pending)
+        converted = checkpoint.get('converted', 0)
+        skipped = checkpoint.get('skipped', 0)
+        processed = 0
         
-        logger.info("Alert check completed")
-    except Exception as e:
-        logger.error(f"Error in alert check: {str(e)}")
+        while True:
+            docs = await db[collection].find(pending, {field: 1 for field in fields}).sort('_id', ASCENDING).limit(batch_size).to_list(batch_size)
+            if not docs:
+                break
+            operations = []
+            for doc in docs:
+                original = {field: doc[field] for field in fields if isinstance(doc.get(field), str)}
+                parsed = {field: parse_legacy_date(value) for field, value in original.items()}
+                if any(value is None for value in parsed.values()):
+                    logger.warning(f"Unparseable date in {collection} {doc['_id']}: {original}")
+                    skipped += 1
+                    continue
+                operations.append(UpdateOne({'_id': doc['_id'], **original}, {'$set': parsed}))
+            if operations:
+                result = await db[collection].bulk_write(operations, ordered=False)
+                converted += result.modified_count
+            processed += len(docs)
+            last_id = docs[-1]['_id']
+            pending = {'$and': [{'$or': [{field: {'$type': 'string'}} for field in fields]}, {'_id': {'$gt': last_id}}]}
+            await db.migrations.update_one(
+                {'_id': checkpoint_id},
+                {'$set': {'last_id': last_id, 'converted': converted, 'skipped': skipped, 'updated_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            if progress:
+                progress(collection, processed, total)
+        
+        await db.migrations.update_one(
+            {'_id': checkpoint_id},
+            {'$set': {'done': True, 'converted': converted, 'skipped': skipped, 'updated_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        summary[collection] = {'converted': converted, 'skipped': skipped}
+        logger.info(f"Date migration for {collection} completed: {converted} converted, {skipped} skipped")
+    converted_collections = [collection for collection, counts in summary.items() if counts['converted']]
+    if converted_collections:
+        await bump_versions(*converted_collections)
+    return summary
+
+# ============= EXPORTS =============
+# Report exports run as background jobs. The aggregation is read in chunks
+# of EXPORT_CHUNK_SIZE documents. Each chunk is encoded and gzip-compressed
+# in a worker thread and appended to a file in EXPORT_DIR, so neither the
+# event loop nor memory holds the full result. Files live on the local disk
+# of the process that ran the job and are removed after EXPORT_RETENTION_HOURS.
+EXPORT_DIR = Path(os.getenv('EXPORT_DIR', ROOT_DIR / 'exports'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+EXPORT_MAX_CONCURRENT = int(os.getenv('EXPORT_MAX_CONCURRENT', 2))
+EXPORT_RETENTION_HOURS = int(os.getenv('EXPORT_RETENTION_HOURS', 72))
+# A running job whose progress has not moved for this long is marked failed
+EXPORT_STALL_SECONDS = int(os.getenv('EXPORT_STALL_SECONDS', 300))
+EXPORT_READ_SIZE = 256 * 1024
+
+class ExportStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+# Sort order of each exportable collection, the same as its list endpoint
+EXPORT_SORT_FIELDS = {
+    'manufacturers': 'created_at',
+    'batches': 'created_at',
+    'inventory': 'expiry_date',
+    'stock_movements': 'created_at',
+    'quality_reports': 'created_at',
+    'alerts': 'created_at',
+}
+EXPORT_REPORTS = {
+    'expiry': {
+        'collection': 'inventory',
+        'match': {'current_stock': {'$gt': 0}},
+        'date_field': 'expiry_date',
+        'fields': ['product_name', 'batch_number', 'location', 'current_stock', 'expiry_date', 'quality_status'],
+    },
+    'quality_failures': {
+        'collection': 'quality_reports',
+        'match': {'result': QualityStatus.FAILED.value},
+        'date_field': 'test_date',
+        'fields': ['batch_number', 'product_name', 'test_date', 'test_type', 'notes', 'tested_by'],
+    },
+    'stock_on_hand': {
+        'collection': 'inventory',
+        'match': {'current_stock': {'$gt': 0}},
+        'date_field': 'expiry_date',
+        'group': [
+            {'$group': {
+                '_id': {'product_name': '$product_name', 'location': '$location'},
+                'units': {'$sum': '$current_stock'},
+                'rows': {'$sum': 1},
+                'earliest_expiry': {'$min': '$expiry_date'},
+            }},
+            {'$sort': {'_id.product_name': 1, '_id.location': 1}},
+            {'$project': {'_id': 0, 'product_name': '$_id.product_name', 'location': '$_id.location',
+                          'units': 1, 'rows': 1, 'earliest_expiry': 1}},
+        ],
+        'fields': ['product_name', 'location', 'units', 'rows', 'earliest_expiry'],
+    },
+}
+
+export_slots = asyncio.Semaphore(EXPORT_MAX_CONCURRENT)
+export_tasks = set()
+
+def _model_date_fields(collection: str) -> set:
+    return {name for name, field in LIST_MODELS[collection].model_fields.items() if field.annotation in (datetime, Optional[datetime])}
+
+def resolve_export(input: ExportInput) -> dict:
+    """Validate a report definition and build its aggregation; raises 400 on unknown names"""
+    if input.report:
+        preset = EXPORT_REPORTS.get(input.report)
+        if preset is None:
+            raise HTTPException(status_code=400, detail=f"Unknown report: {input.report}")
+        collection = preset['collection']
+        match = dict(preset['match'])
+        date_field = input.date_field or preset['date_field']
+        fields = preset['fields']
+    elif input.collection in EXPORT_SORT_FIELDS:
+        collection = input.collection
+        match = {}
+        date_field = input.date_field or EXPORT_SORT_FIELDS[collection]
+        fields = input.fields or [name for name in LIST_MODELS[collection].model_fields]
+        unknown = set(fields) - set(LIST_MODELS[collection].model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    else:
+        raise HTTPException(status_code=400, detail=f"Provide a report ({', '.join(EXPORT_REPORTS)}) or a collection ({', '.join(EXPORT_SORT_FIELDS)})")
+    
+    unknown = set(input.filters) - set(LIST_MODELS[collection].model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown filter fields: {', '.join(sorted(unknown))}")
+    for field, value in input.filters.items():
+        values = value if isinstance(value, list) else [value]
+        if not all(isinstance(v, (str, int, float, bool)) for v in values):
+            raise HTTPException(status_code=400, detail=f"Filter {field} must be a value or a list of values")
+        match[field] = {'$in': value} if isinstance(value, list) else value
+    if (input.date_from or input.date_to) and date_field not in _model_date_fields(collection):
+        raise HTTPException(status_code=400, detail=f"{date_field} is not a date field of {collection}")
+    match.update(date_range(date_field, input.date_from, input.date_to))
+    
+    sort_field = EXPORT_SORT_FIELDS[collection]
+    pipeline = [{'$match': match}, {'$sort': {sort_field: 1, 'id': 1}}]
+    if input.report and 'group' in EXPORT_REPORTS[input.report]:
+        pipeline += EXPORT_REPORTS[input.report]['group']
+    else:
+        pipeline.append({'$project': {'_id': 0, **{field: 1 for field in fields}}})
+    return {'collection': collection, 'match': match, 'pipeline': pipeline, 'fields': fields}
+
+def _export_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return _json_default(value)
+    if isinstance(value, (list, dict)):
+        return dumps_json(value).decode('utf-8')
+    return value
+
+class ExportWriter:
+    """Appends rows to a gzip file as CSV or NDJSON; every method blocks and runs in a worker thread"""
+    def __init__(self, path: Path, fmt: ExportFormat, fields: List[str]):
+        self.fields = fields
+        self.file = gzip.open(path, 'wb')
+        self.text = None
+        if fmt == ExportFormat.CSV:
+            self.text = io.TextIOWrapper(self.file, encoding='utf-8', newline='')
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(fields)
+    
+    def write(self, docs: list) -> None:
+        if self.text is not None:
+            self.csv.writerows([_export_cell(doc.get(field)) for field in self.fields] for doc in docs)
+        else:
+            self.file.write(b'\n'.join(dumps_json({field: doc.get(field) for field in self.fields}) for doc in docs) + b'\n')
+    
+    def close(self) -> None:
+        (self.text or self.file).close()
+
+def export_path(job: dict) -> Path:
+    return EXPORT_DIR / f"{job['id']}.{job['format']}.gz"
+
+def purge_export_files() -> int:
+    """Delete local export files past the retention window; blocking"""
+    if not EXPORT_DIR.exists():
+        return 0
+    cutoff = time.time() - EXPORT_RETENTION_HOURS * 3600
+    removed = 0
+    for path in EXPORT_DIR.iterdir():
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+async def _export_heartbeat(job_id: str) -> None:
+    # Keeps updated_at fresh while the server is still computing the first batch (e.g. a $group)
+    while True:
+        await asyncio.sleep(EXPORT_STALL_SECONDS / 3)
+        await db.export_jobs.update_one({'id': job_id}, {'$set': {'updated_at': datetime.now(timezone.utc)}})
+
+async def fail_stalled_exports() -> None:
+    """Mark running jobs whose process stopped updating them as failed"""
+    now = datetime.now(timezone.utc)
+    await db.export_jobs.update_many(
+        {'status': ExportStatus.RUNNING, 'updated_at': {'$lt': now - timedelta(seconds=EXPORT_STALL_SECONDS)}},
+        {'$set': {'status': ExportStatus.FAILED, 'error': "Export worker stopped", 'finished_at': now}}
+    )
+
+@metrics.track_task('export')
+async def run_export(job: dict, export: dict) -> None:
+    async with export_slots:
+        now = datetime.now(timezone.utc)
+        await db.export_jobs.update_one({'id': job['id']}, {'$set': {'status': ExportStatus.RUNNING, 'started_at': now, 'updated_at': now}})
+        path = export_path(job)
+        partial = path.with_name(path.name + '.part')
+        heartbeat = asyncio.create_task(_export_heartbeat(job['id']))
+        rows = 0
+        writer = None
+        try:
+            await asyncio.to_thread(EXPORT_DIR.mkdir, parents=True, exist_ok=True)
+            writer = await asyncio.to_thread(ExportWriter, partial, ExportFormat(job['format']), export['fields'])
+            chunk = []
+            cursor = read_db[export['collection']].aggregate(export['pipeline'], allowDiskUse=True, batchSize=EXPORT_CHUNK_SIZE)
+            async for doc in cursor:
+                chunk.append(doc)
+                if len(chunk) >= EXPORT_CHUNK_SIZE:
+                    await asyncio.to_thread(writer.write, chunk)
+                    rows += len(chunk)
+                    chunk = []
+                    await db.export_jobs.update_one({'id': job['id']}, {'$set': {'rows': rows, 'updated_at': datetime.now(timezone.utc)}})
+            if chunk:
+                await asyncio.to_thread(writer.write, chunk)
+                rows += len(chunk)
+            await asyncio.to_thread(writer.close)
+            writer = None
+            await asyncio.to_thread(os.replace, partial, path)
+            size = (await asyncio.to_thread(path.stat)).st_size
+            finished = datetime.now(timezone.utc)
+            await db.export_jobs.update_one({'id': job['id']}, {'$set': {
+                'status': ExportStatus.COMPLETED, 'rows': rows, 'bytes': size, 'updated_at': finished, 'finished_at': finished
+            }})
+            logger.info(f"Export {job['id']} completed: {rows} rows, {size} bytes in {(finished - now).total_seconds():.1f}s")
+        except BaseException as e:
+            error = "Interrupted by shutdown" if isinstance(e, asyncio.CancelledError) else str(e)
+            logger.error(f"Export {job['id']} failed: {error}")
+            if writer is not None:
+                await asyncio.to_thread(writer.close)
+            await asyncio.to_thread(partial.unlink, missing_ok=True)
+            await db.export_jobs.update_one({'id': job['id']}, {'$set': {
+                'status': ExportStatus.FAILED, 'error': error, 'rows': rows, 'finished_at': datetime.now(timezone.utc)
+            }})
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            heartbeat.cancel()
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """(start, end) of a single 'bytes=' range; None for a syntax or multi-range request, which is served whole.
+
+    Raises 416 when the range lies past the end of the file.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), int(last) if last else size - 1
+    except ValueError:
+        return None
+    if first and last and start > end:
+        # last-pos before first-pos makes the spec invalid, so it is ignored like a syntax error
+        return None
+    end = min(end, size - 1)
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={'Content-Range': f"bytes */{size}"})
+    return start, end
+
+async def read_file_range(path: Path, start: int, end: int):
+    f = await asyncio.to_thread(open, path, 'rb')
+    try:
+        await asyncio.to_thread(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = await asyncio.to_thread(f.read, min(EXPORT_READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        await asyncio.to_thread(f.close)
+
+# ============= INDEXES =============
+# Every collection the API filters or sorts on, with the fields it filters on
+INDEXES = {
+    'users': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('email', ASCENDING)], name='email_unique', unique=True),
+        IndexModel([('role', ASCENDING)], name='role'),
+    ],
+    'manufacturers': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('created_at', ASCENDING), ('id', ASCENDING)], name='created_at_id'),
+        IndexModel([('_search', ASCENDING)], name='search_keys'),
+        IndexModel([('name', TEXT), ('license_number', TEXT)], name='search_text', weights={'license_number': 5}),
+    ],
+    'batches': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('quality_status', ASCENDING), ('created_at', ASCENDING), ('id', ASCENDING)], name='quality_status'),
+        IndexModel([('created_at', ASCENDING), ('id', ASCENDING)], name='created_at_id'),
+        IndexModel([('status', ASCENDING), ('created_at', ASCENDING), ('id', ASCENDING)], name='status_created_at_id'),
+        IndexModel([('product_name', ASCENDING), ('created_at', ASCENDING), ('id', ASCENDING)], name='product_name_created_at_id'),
+        IndexModel([('manufacturer_id', ASCENDING), ('created_at', ASCENDING), ('id', ASCENDING)], name='manufacturer_id_created_at_id'),
+        IndexModel([('batch_number', ASCENDING)], name='batch_number'),
+        IndexModel([('_search', ASCENDING)], name='search_keys'),
+        IndexModel([('batch_number', TEXT), ('product_name', TEXT), ('manufacturer_name', TEXT)], name='search_text',
+                   weights={'batch_number': 10, 'product_name': 5}),
+    ],
+    'inventory': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('batch_id', ASCENDING)], name='batch_id'),
+        IndexModel([('expiry_date', ASCENDING), ('id', ASCENDING)], name='expiry_date'),
+        IndexModel([('location', ASCENDING), ('expiry_date', ASCENDING), ('id', ASCENDING)], name='location_expiry_date_id'),
+        IndexModel([('product_name', ASCENDING), ('expiry_date', ASCENDING), ('id', ASCENDING)], name='product_name_expiry_date_id'),
+        IndexModel([('low_stock', ASCENDING)], name='low_stock'),
+        IndexModel([('_search', ASCENDING)], name='search_keys'),
+        IndexModel([('product_name', TEXT), ('batch_number', TEXT), ('location', TEXT)], name='search_text',
+                   weights={'product_name': 5, 'batch_number': 5}),
+    ],
+    'quality_reports': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('batch_id', ASCENDING)], name='batch_id'),
+        IndexModel([('created_at', ASCENDING), ('id', ASCENDING)], name='created_at_id'),
+        IndexModel([('result', ASCENDING), ('created_at', ASCENDING), ('id', ASCENDING)], name='result_created_at_id'),
+    ],
+    'stock_movements': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('inventory_id', ASCENDING), ('created_at', DESCENDING), ('id', DESCENDING)], name='inventory_id_created_at_id'),
+    ],
+    'consumption_rollups': [
+        IndexModel(
+            [('granularity', ASCENDING), ('product_name', ASCENDING), ('location', ASCENDING), ('bucket', ASCENDING)],
+            name='granularity_product_name_location_bucket_unique',
+            unique=True
+        ),
+        IndexModel([('granularity', ASCENDING), ('location', ASCENDING), ('bucket', ASCENDING)], name='granularity_location_bucket'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'email_outbox': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('status', ASCENDING), ('next_attempt_at', ASCENDING)], name='status_next_attempt_at'),
+        IndexModel([('alert_id', ASCENDING), ('status', ASCENDING)], name='alert_id_status'),
+        IndexModel([('sent_at', ASCENDING)], name='sent_at_ttl', expireAfterSeconds=EMAIL_RETENTION_DAYS * 86400),
+        IndexModel([('failed_at', ASCENDING)], name='failed_at_ttl', expireAfterSeconds=EMAIL_RETENTION_DAYS * 86400),
+    ],
+    'alerts': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        # At most one open alert per (batch, type); resolved alerts fall out of the index
+        IndexModel(
+            [('batch_id', ASCENDING), ('alert_type', ASCENDING)],
+            name='batch_id_alert_type_unique',
+            unique=True,
+            partialFilterExpression={'batch_id': {'$type': 'string'}, 'resolved': False}
+        ),
+        IndexModel([('resolved', ASCENDING), ('alert_type', ASCENDING), ('batch_id', ASCENDING)], name='resolved_alert_type_batch_id'),
+        # The sweep's per-batch open-alert lookup, which neither index above can serve
+        IndexModel([('batch_id', ASCENDING), ('alert_type', ASCENDING), ('resolved', ASCENDING)], name='batch_id_alert_type_resolved'),
+        IndexModel([('resolved', ASCENDING), ('created_at', DESCENDING), ('id', DESCENDING)], name='resolved_created_at_id'),
+        IndexModel([('resolved_at', ASCENDING)], name='resolved_at', partialFilterExpression={'resolved': True}),
+        IndexModel([('created_at', DESCENDING), ('id', DESCENDING)], name='created_at'),
+        IndexModel([('is_read', ASCENDING), ('created_at', DESCENDING), ('id', DESCENDING)], name='is_read'),
+    ],
+    'export_jobs': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('created_by', ASCENDING), ('created_at', DESCENDING)], name='created_by_created_at'),
+        IndexModel([('created_at', DESCENDING)], name='created_at'),
+        IndexModel([('status', ASCENDING), ('updated_at', ASCENDING)], name='status_updated_at'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0),
+    ],
+    'scheduler_leases': [
+        IndexModel([('job', ASCENDING)], name='job_unique', unique=True),
+    ],
+    'scheduler_runs': [
+        IndexModel([('job', ASCENDING), ('started_at', DESCENDING)], name='job_started_at'),
+        IndexModel([('started_at', ASCENDING)], name='started_at_ttl', expireAfterSeconds=SCHEDULER_RUN_RETENTION_DAYS * 86400),
+    ],
+    'alerts_archive': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('batch_id', ASCENDING)], name='batch_id'),
+        IndexModel([('created_at', DESCENDING), ('id', DESCENDING)], name='created_at'),
+    ] + ([
+        IndexModel([('archived_at', ASCENDING)], name='archived_at_ttl', expireAfterSeconds=ALERT_ARCHIVE_TTL_DAYS * 86400)
+    ] if ALERT_ARCHIVE_TTL_DAYS else []),
+}
+
+def _query_plans() -> list:
+    """The filter/sort of every query an endpoint issues, used by check_query_plans"""
+    now = datetime.now(timezone.utc)
+    sweep = []
+    for rule in _alert_rules(now):
+        alert_type = rule['alert_type'].value
+        sweep += [
+            (f"alert sweep {alert_type}", 'inventory', rule['match'], None),
+            (f"alert resolution {alert_type} distinct", 'inventory', {**rule['match'], 'batch_id': {'$in': ['']}}, None),
+        ]
+    return sweep + [
+        ('get_current_user', 'users', {'id': ''}, None),
+        ('register/login', 'users', {'email': ''}, None),
+        ('create_quality_report staff emails', 'users', {'role': UserRole.STAFF.value}, None),
+        ('create_batch manufacturer', 'manufacturers', {'id': ''}, None),
+        ('create_inventory/create_quality_report batch', 'batches', {'id': ''}, None),
+        ('update_stock', 'inventory', {'id': ''}, None),
+        ('allocation candidates', 'inventory', {'product_name': '', 'location': '', **allocatable_filter(now)},
+         [('expiry_date', ASCENDING), ('id', ASCENDING)]),
+        ('get_stock_movements', 'stock_movements', {'inventory_id': ''}, [('created_at', DESCENDING), ('id', DESCENDING)]),
+        ('get_consumption', 'consumption_rollups', {'granularity': RollupGranularity.DAY.value, 'product_name': '', 'location': ALL_LOCATIONS,
+                                                    'bucket': {'$gte': now}}, [('bucket', ASCENDING)]),
+        ('consumption forecast', 'consumption_rollups', {'granularity': RollupGranularity.DAY.value, 'location': ALL_LOCATIONS,
+                                                         'bucket': {'$gte': now}}, None),
+        ('on-hand stock', 'inventory', {'product_name': {'$in': ['']}, 'expiry_date': {'$gt': now}}, None),
+        ('get_manufacturers', 'manufacturers', {}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_batches', 'batches', {}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_batches by status', 'batches', {'status': BatchStatus.IN_STOCK.value}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_batches by quality', 'batches', {'quality_status': QualityStatus.FAILED.value}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_batches by product', 'batches', {'product_name': ''}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_inventory', 'inventory', {}, [('expiry_date', ASCENDING), ('id', ASCENDING)]),
+        ('get_inventory by location', 'inventory', {'location': ''}, [('expiry_date', ASCENDING), ('id', ASCENDING)]),
+        ('get_inventory by product', 'inventory', {'product_name': ''}, [('expiry_date', ASCENDING), ('id', ASCENDING)]),
+        ('get_quality_reports', 'quality_reports', {}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_quality_reports by result', 'quality_reports', {'result': QualityStatus.FAILED.value}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('get_alerts', 'alerts', {}, [('created_at', DESCENDING), ('id', DESCENDING)]),
+        ('get_alerts unread', 'alerts', {'is_read': False}, [('created_at', DESCENDING), ('id', DESCENDING)]),
+        ('mark_alert_read', 'alerts', {'id': ''}, None),
+        ('alert stream replay', 'alerts', {'created_at': {'$gt': now}}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('alert dedupe', 'alerts', {'batch_id': '', 'alert_type': AlertType.LOW_STOCK.value, 'resolved': False}, None),
+        ('get_alerts open', 'alerts', {'resolved': False}, [('created_at', DESCENDING), ('id', DESCENDING)]),
+        ('acknowledge by batch', 'alerts', {'is_read': False, 'batch_id': ''}, None),
+        ('alert resolution', 'alerts', {'resolved': False, 'alert_type': AlertType.LOW_STOCK.value, 'batch_id': {'$type': 'string'}}, None),
+        ('alert archive', 'alerts', {'resolved': True, 'resolved_at': {'$lt': now}}, [('resolved_at', ASCENDING)]),
+        # The sweep's $lookup probe; $expr equality cannot use the partial unique index
+        ('alert sweep open-alert lookup', 'alerts',
+         {'$expr': {'$eq': ['$batch_id', '']}, 'alert_type': AlertType.LOW_STOCK.value, 'resolved': False}, None),
+        ('get_batches by manufacturer', 'batches', {'manufacturer_id': ''}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+        ('recall by batch numbers', 'batches', {'batch_number': {'$in': ['']}}, None),
+        ('traceability inventory', 'inventory', {'batch_id': ''}, None),
+        ('traceability quality reports', 'quality_reports', {'batch_id': ''}, None),
+        ('search manufacturers', 'manufacturers', {'_search': {'$regex': '^a'}}, None),
+        ('search batches', 'batches', {'_search': {'$regex': '^a'}}, None),
+        ('search inventory', 'inventory', {'_search': {'$regex': '^a'}}, None),
+        ('scheduler claim', 'scheduler_leases', {'job': '', 'tick': {'$lt': 0}}, None),
+        ('get_scheduler runs', 'scheduler_runs', {'job': ''}, [('started_at', DESCENDING)]),
+        ('get_exports', 'export_jobs', {'created_by': ''}, [('created_at', DESCENDING)]),
+        ('stalled exports', 'export_jobs', {'status': 'running', 'updated_at': {'$lt': now}}, None),
+        ('expiry export', 'inventory', {'current_stock': {'$gt': 0}, 'expiry_date': {'$lte': now}},
+         [('expiry_date', ASCENDING), ('id', ASCENDING)]),
+        ('quality failures export', 'quality_reports', {'result': QualityStatus.FAILED.value}, [('created_at', ASCENDING), ('id', ASCENDING)]),
+    ]
+
+def _pipeline_plans() -> list:
+    """The aggregations a periodic job runs, used by check_query_plans"""
+    now = datetime.now(timezone.utc)
+    return [
+        (f"alert sweep {rule['alert_type'].value} aggregation", 'inventory',
+         _alert_candidates_pipeline(rule['match'], rule['alert_type']))
+        for rule in _alert_rules(now)
+    ]
+
+async def ensure_indexes(rebuild: bool = False) -> list:
+    """Create every declared index; safe to run on each startup.
+
+    An existing index whose key or options differ from the declaration is
+    only reported, as every worker runs this at startup. With rebuild
+    (`manage.py ensure-indexes`) a changed TTL is applied in place with
+    collMod and any other conflicting index is dropped and rebuilt.
+    Returns the names of the conflicting indexes.
+    """
+    conflicts = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            name = f"{collection}.{index.document['name']}"
+            try:
+                await db[collection].create_indexes([index])
+                continue
+            except OperationFailure as e:
+                # 85: IndexOptionsConflict, 86: IndexKeySpecsConflict
+                if e.code not in (85, 86):
+                    logger.error(f"Failed to create index {name}: {str(e)}")
+                    continue
+            conflicts.append(name)
+            if not rebuild:
+                logger.warning(f"Index {name} differs from its declaration; run `manage.py ensure-indexes` to rebuild it")
+                continue
+            try:
+                await _rebuild_index(collection, index)
+            except OperationFailure as e:
+                logger.error(f"Failed to rebuild index {name}: {str(e)}")
+    logger.info("Index bootstrap completed")
+    return conflicts
+
+async def _rebuild_index(collection: str, index: IndexModel) -> None:
+    declared = index.document
+    key = dict(declared['key'])
+    async for existing in db[collection].list_indexes():
+        if existing['name'] != declared['name'] and dict(existing['key']) != key:
+            continue
+        same_except_ttl = (
+            existing['name'] == declared['name'] and dict(existing['key']) == key
+            and 'expireAfterSeconds' in existing and 'expireAfterSeconds' in declared
+            and {k: v for k, v in existing.items() if k not in ('v', 'ns', 'expireAfterSeconds')}
+            == {k: v for k, v in declared.items() if k != 'expireAfterSeconds'}
+        )
+        if same_except_ttl:
+            logger.warning(f"Changing the TTL of index {collection}.{existing['name']} to {declared['expireAfterSeconds']}s")
+            await db.command({'collMod': collection, 'index': {'name': existing['name'], 'expireAfterSeconds': declared['expireAfterSeconds']}})
+            return
+        logger.warning(f"Rebuilding index {collection}.{existing['name']} with new options")
+        try:
+            await db[collection].drop_index(existing['name'])
+        except OperationFailure as e:
+            # 27: IndexNotFound, dropped meanwhile by another run
+            if e.code != 27:
+                raise
+    await db[collection].create_indexes([index])
+
+def _plan_stages(plan) -> set:
+    stages = set()
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            stages |= _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= _plan_stages(value)
+    return stages
+
+def _winning_plans(explain) -> list:
+    """Every winningPlan in an explain, including those of aggregation stages"""
+    plans = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                plans.append(value)
+            elif key != 'rejectedPlans':
+                plans += _winning_plans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            plans += _winning_plans(value)
+    return plans
+
+def _lookup_collection_scans(explain) -> int:
+    """Collection scans $lookup stages reported in executionStats"""
+    scans = 0
+    if isinstance(explain, dict):
+        if isinstance(explain.get('collectionScans'), int):
+            scans += explain['collectionScans']
+        for value in explain.values():
+            scans += _lookup_collection_scans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            scans += _lookup_collection_scans(value)
+    return scans
+
+async def check_query_plans() -> list:
+    """Explain every endpoint query and job aggregation and return the ones that fall back to a collection scan"""
+    offenders = []
+    for name, collection, query, sort in _query_plans():
+        find = {'find': collection, 'filter': query, 'limit': 1}
+        if sort:
+            find['sort'] = dict(sort)
+        explain = await db.command({'explain': find, 'verbosity': 'queryPlanner'})
+        stages = _plan_stages(explain['queryPlanner']['winningPlan'])
+        if 'COLLSCAN' in stages:
+            offenders.append({'query': name, 'collection': collection, 'filter': query, 'stages': sorted(stages)})
+    for name, collection, pipeline in _pipeline_plans():
+        # executionStats, as $lookup only reports the scans its inner queries made once they ran
+        explain = await db.command({
+            'explain': {'aggregate': collection, 'pipeline': pipeline, 'cursor': {}},
+            'verbosity': 'executionStats'
+        })
+        stages = set().union(*map(_plan_stages, _winning_plans(explain)))
+        if 'COLLSCAN' in stages or _lookup_collection_scans(explain):
+            offenders.append({'query': name, 'collection': collection, 'filter': pipeline, 'stages': sorted(stages)})
+    return offenders
 
 # ============= AUTH ENDPOINTS =============
 @api_router.post("/auth/register")
@@ -290,57 +2838,139 @@ async def register(input: RegisterInput):
     user = User(
         email=input.email,
         name=input.name,
-        password_hash=hash_password(input.password),
+        password_hash=await hash_password(input.password),
         role=input.role
     )
     
-    user_dict = user.model_dump()
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
-    await db.users.insert_one(user_dict)
+    await db.users.insert_one(user.model_dump())
     
-    token = create_token(user.id)
-    return {"token": token, "user": {"id": user.id, "email": user.email, "name": user.name, "role": user.role}}
+    token = create_token(user)
+    return {"token": token, "refresh_token": create_refresh_token(user),
+            "user": {"id": user.id, "email": user.email, "name": user.name, "role": user.role}}
 
 @api_router.post("/auth/login")
-async def login(input: LoginInput):
+async def login(input: LoginInput, background_tasks: BackgroundTasks):
     user_doc = await db.users.find_one({'email': input.email}, {'_id': 0})
-    if not user_doc or not verify_password(input.password, user_doc['password_hash']):
+    if not user_doc or not await verify_password(input.password, user_doc['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if password_needs_rehash(user_doc['password_hash']):
+        background_tasks.add_task(rehash_password, user_doc['id'], input.password, user_doc['password_hash'])
+    
     user = User(**user_doc)
-    token = create_token(user.id)
-    return {"token": token, "user": {"id": user.id, "email": user.email, "name": user.name, "role": user.role}}
+    token = create_token(user)
+    return {"token": token, "refresh_token": create_refresh_token(user),
+            "user": {"id": user.id, "email": user.email, "name": user.name, "role": user.role}}
+
+@api_router.post("/auth/refresh")
+async def refresh_token(input: RefreshInput):
+    """New access token for a refresh token, built from the user as stored now"""
+    try:
+        payload = jwt.decode(input.refresh_token, os.getenv('JWT_SECRET'), algorithms=[os.getenv('JWT_ALGORITHM')])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload.get('scope') != REFRESH_TOKEN_SCOPE:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user_doc = await db.users.find_one({'id': payload.get('user_id')}, {'_id': 0})
+    if not user_doc:
+        raise HTTPException(status_code=401, detail="User not found")
+    user = User(**user_doc)
+    principal_cache.set(user.id, user)
+    return {"token": create_token(user)}
 
 @api_router.get("/auth/me")
 async def get_me(current_user: User = Depends(get_current_user)):
     return {"id": current_user.id, "email": current_user.email, "name": current_user.name, "role": current_user.role}
 
+@api_router.get("/auth/cache-stats")
+async def get_auth_cache_stats(current_user: User = Depends(get_current_user)):
+    return {**principal_cache.stats(), **auth_counters, 'token_claims': token_claims_enabled(), 'password_jobs': password_jobs}
+
+# ============= USER ENDPOINTS =============
+@api_router.put("/users/{user_id}")
+async def update_user(user_id: str, input: UserUpdateInput, current_user: User = Depends(get_current_user)):
+    require_admin(current_user)
+    changes = input.model_dump(exclude_none=True)
+    if not changes:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+    
+    result = await db.users.update_one({'id': user_id}, {'$set': changes})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user_id)
+    return {"message": "User updated"}
+
+@api_router.put("/users/{user_id}/password")
+async def reset_password(user_id: str, input: PasswordResetInput, current_user: User = Depends(get_current_user)):
+    if current_user.id != user_id:
+        require_admin(current_user)
+    else:
+        user_doc = await db.users.find_one({'id': user_id}, {'_id': 0, 'password_hash': 1})
+        if not user_doc:
+            raise HTTPException(status_code=404, detail="User not found")
+        if not input.current_password or not await verify_password(input.current_password, user_doc['password_hash']):
+            raise HTTPException(status_code=403, detail="Current password is incorrect")
+    
+    result = await db.users.update_one({'id': user_id}, {'$set': {'password_hash': await hash_password(input.password)}})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user_id)
+    return {"message": "Password reset"}
+
+@api_router.delete("/users/{user_id}")
+async def delete_user(user_id: str, current_user: User = Depends(get_current_user)):
+    require_admin(current_user)
+    result = await db.users.delete_one({'id': user_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user_id)
+    return {"message": "User deleted"}
+
 # ============= MANUFACTURER ENDPOINTS =============
 @api_router.get("/manufacturers", response_model=List[Manufacturer])
-async def get_manufacturers(current_user: User = Depends(get_current_user)):
-    manufacturers = await db.manufacturers.find({}, {'_id': 0}).to_list(1000)
-    for m in manufacturers:
-        if isinstance(m.get('created_at'), str):
-            m['created_at'] = datetime.fromisoformat(m['created_at'])
-    return manufacturers
+async def get_manufacturers(
+    response: Response,
+    date_from: Optional[datetime] = Query(None, description="Created on or after"),
+    date_to: Optional[datetime] = Query(None, description="Created on or before"),
+    page: dict = Depends(page_params),
+    current_user: User = Depends(get_current_user)
+):
+    query = date_range('created_at', date_from, date_to)
+    return await list_response('manufacturers', query, 'created_at', ASCENDING, page, response)
 
 @api_router.post("/manufacturers", response_model=Manufacturer)
 async def create_manufacturer(input: ManufacturerInput, current_user: User = Depends(get_current_user)):
     manufacturer = Manufacturer(**input.model_dump())
-    m_dict = manufacturer.model_dump()
-    m_dict['created_at'] = m_dict['created_at'].isoformat()
-    await db.manufacturers.insert_one(m_dict)
+    await db.manufacturers.insert_one(add_search_keys('manufacturers', manufacturer.model_dump()))
+    await bump_versions('manufacturers')
+    await bump_stats({'total_manufacturers': 1})
     return manufacturer
 
 # ============= BATCH ENDPOINTS =============
 @api_router.get("/batches", response_model=List[Batch])
-async def get_batches(current_user: User = Depends(get_current_user)):
-    batches = await db.batches.find({}, {'_id': 0}).to_list(1000)
-    for b in batches:
-        for field in ['created_at', 'production_date', 'expiry_date']:
-            if isinstance(b.get(field), str):
-                b[field] = datetime.fromisoformat(b[field])
-    return batches
+async def get_batches(
+    response: Response,
+    status: Optional[BatchStatus] = None,
+    quality_status: Optional[QualityStatus] = None,
+    product: Optional[str] = Query(None, description="Exact product name"),
+    manufacturer_id: Optional[str] = None,
+    date_from: Optional[datetime] = Query(None, description="Created on or after"),
+    date_to: Optional[datetime] = Query(None, description="Created on or before"),
+    page: dict = Depends(page_params),
+    current_user: User = Depends(get_current_user)
+):
+    query = date_range('created_at', date_from, date_to)
+    if status:
+        query['status'] = status
+    if quality_status:
+        query['quality_status'] = quality_status
+    if product:
+        query['product_name'] = product
+    if manufacturer_id:
+        query['manufacturer_id'] = manufacturer_id
+    return await list_response('batches', query, 'created_at', ASCENDING, page, response)
 
 @api_router.post("/batches", response_model=Batch)
 async def create_batch(input: BatchInput, current_user: User = Depends(get_current_user)):
@@ -354,22 +2984,31 @@ async def create_batch(input: BatchInput, current_user: User = Depends(get_curre
         status=BatchStatus.IN_PRODUCTION
     )
     
-    batch_dict = batch.model_dump()
-    for field in ['created_at', 'production_date', 'expiry_date']:
-        batch_dict[field] = batch_dict[field].isoformat()
-    
-    await db.batches.insert_one(batch_dict)
+    await db.batches.insert_one(add_search_keys('batches', batch.model_dump()))
+    await bump_versions('batches')
+    await bump_stats({'total_batches': 1})
     return batch
 
 # ============= INVENTORY ENDPOINTS =============
 @api_router.get("/inventory", response_model=List[Inventory])
-async def get_inventory(current_user: User = Depends(get_current_user)):
-    inventory = await db.inventory.find({}, {'_id': 0}).to_list(1000)
-    for inv in inventory:
-        for field in ['last_updated', 'expiry_date']:
-            if isinstance(inv.get(field), str):
-                inv[field] = datetime.fromisoformat(inv[field])
-    return inventory
+async def get_inventory(
+    response: Response,
+    location: Optional[str] = None,
+    product: Optional[str] = Query(None, description="Exact product name"),
+    batch_id: Optional[str] = None,
+    date_from: Optional[datetime] = Query(None, description="Expiring on or after"),
+    date_to: Optional[datetime] = Query(None, description="Expiring on or before"),
+    page: dict = Depends(page_params),
+    current_user: User = Depends(get_current_user)
+):
+    query = date_range('expiry_date', date_from, date_to)
+    if location:
+        query['location'] = location
+    if product:
+        query['product_name'] = product
+    if batch_id:
+        query['batch_id'] = batch_id
+    return await list_response('inventory', query, 'expiry_date', ASCENDING, page, response)
 
 @api_router.post("/inventory", response_model=Inventory)
 async def create_inventory(input: InventoryInput, current_user: User = Depends(get_current_user)):
@@ -383,49 +3022,223 @@ async def create_inventory(input: InventoryInput, current_user: User = Depends(g
         product_name=batch['product_name'],
         current_stock=input.initial_stock,
         initial_stock=input.initial_stock,
-        expiry_date=datetime.fromisoformat(batch['expiry_date']) if isinstance(batch['expiry_date'], str) else batch['expiry_date'],
-        location=input.location
+        expiry_date=batch['expiry_date'],
+        location=input.location,
+        quality_status=batch.get('quality_status', QualityStatus.PENDING)
     )
     
-    inv_dict = inventory.model_dump()
-    inv_dict['last_updated'] = inv_dict['last_updated'].isoformat()
-    inv_dict['expiry_date'] = inv_dict['expiry_date'].isoformat()
+    inv_dict = add_search_keys('inventory', inventory.model_dump())
+    inv_dict['low_stock'] = is_low_stock(inventory.current_stock, inventory.initial_stock)
     await db.inventory.insert_one(inv_dict)
+    await bump_stats({
+        'total_inventory': 1,
+        'low_stock_count': int(inv_dict['low_stock']),
+        f"expiry_by_day.{expiry_bucket(inventory.expiry_date)}": 1
+    })
     
     # Update batch status
     await db.batches.update_one({'id': input.batch_id}, {'$set': {'status': BatchStatus.IN_STOCK}})
+    await bump_versions('inventory', 'batches')
     
     return inventory
 
 @api_router.put("/inventory/{inventory_id}/stock")
 async def update_stock(inventory_id: str, input: StockUpdateInput, current_user: User = Depends(get_current_user)):
-    inventory = await db.inventory.find_one({'id': inventory_id}, {'_id': 0})
-    if not inventory:
-        raise HTTPException(status_code=404, detail="Inventory not found")
-    
-    new_stock = inventory['current_stock'] + input.quantity_change
-    if new_stock < 0:
-        raise HTTPException(status_code=400, detail="Insufficient stock")
-    
-    await db.inventory.update_one(
-        {'id': inventory_id},
-        {'$set': {'current_stock': new_stock, 'last_updated': datetime.now(timezone.utc).isoformat()}}
-    )
+    movement = await apply_stock_movement(inventory_id, input.quantity_change, input.reason, input.reference, current_user)
+    return {"message": "Stock updated", "new_stock": movement.resulting_stock, "movement_id": movement.id}
+
+@api_router.post("/inventory/movements")
+async def bulk_stock_movements(input: StockMovementBatchInput, current_user: User = Depends(get_current_user)):
+    results = await apply_stock_movements(input.movements, current_user)
+    applied = sum(1 for result in results if result['applied'])
+    return {"applied": applied, "rejected": len(results) - applied, "results": results}
+
+@api_router.get("/inventory/{inventory_id}/movements", response_model=List[StockMovement])
+async def get_stock_movements(inventory_id: str, response: Response, page: dict = Depends(page_params),
+                              current_user: User = Depends(get_current_user)):
+    return await list_response('stock_movements', {'inventory_id': inventory_id}, 'created_at', DESCENDING, page, response)
+
+# ============= ALLOCATION ENDPOINTS =============
+@api_router.post("/allocations")
+async def create_allocation(input: AllocationInput, current_user: User = Depends(get_current_user)):
+    result = await allocate(input, current_user)
+    if not result['fulfilled'] and not input.allow_partial:
+        raise HTTPException(status_code=409, detail=result['error'])
+    return result
+
+@api_router.post("/allocations/bulk")
+async def create_allocations(input: AllocationBatchInput, current_user: User = Depends(get_current_user)):
+    """Allocate every line of a ward order; each line succeeds or rolls back on its own"""
+    results = [await allocate(line, current_user, input.reference) for line in input.lines]
+    fulfilled = sum(1 for result in results if result['fulfilled'])
+    return {"fulfilled": fulfilled, "unfulfilled": len(results) - fulfilled, "results": results}
+
+# ============= CONSUMPTION ENDPOINTS =============
+@api_router.get("/consumption")
+async def get_consumption(
+    product: str,
+    location: str = ALL_LOCATIONS,
+    granularity: RollupGranularity = RollupGranularity.DAY,
+    date_from: Optional[datetime] = Query(None, description="Buckets starting on or after"),
+    date_to: Optional[datetime] = Query(None, description="Buckets starting on or before"),
+    current_user: User = Depends(get_current_user)
+):
+    """Consumption time series for a product, from the rollup buckets"""
+    if not date_from:
+        date_from = datetime.now(timezone.utc) - (timedelta(days=2) if granularity == RollupGranularity.HOUR else timedelta(days=30))
+    query = {'granularity': granularity, 'product_name': product, 'location': location, **date_range('bucket', date_from, date_to)}
+    buckets = await read_db.consumption_rollups.find(
+        query, {'_id': 0, 'bucket': 1, 'consumed': 1, 'restocked': 1, 'adjusted': 1, 'movements': 1}
+    ).sort('bucket', ASCENDING).to_list(None)
+    return Response(dumps_json(buckets), media_type='application/json')
+
+@api_router.get("/consumption/forecast")
+async def get_consumption_forecast(
+    product: Optional[str] = Query(None, description="Every product consumed in the window when omitted"),
+    location: str = ALL_LOCATIONS,
+    window_days: int = Query(28, ge=1, le=365, description="Days of history the rate is averaged over"),
+    current_user: User = Depends(get_current_user)
+):
+    """Consumption rate, days of supply and projected stock-out date per product"""
+    now = datetime.now(timezone.utc)
+    match = {
+        'granularity': RollupGranularity.DAY,
+        'location': location,
+        'bucket': {'$gte': rollup_bucket(now, RollupGranularity.DAY) - timedelta(days=window_days - 1)},
+    }
+    if product:
+        match['product_name'] = product
+    consumed = {
+        row['_id']: row['consumed']
+        async for row in read_db.consumption_rollups.aggregate([
+            {'$match': match},
+            {'$group': {'_id': '$product_name', 'consumed': {'$sum': '$consumed'}}},
+        ])
+    }
+    if product:
+        consumed.setdefault(product, 0)
+    on_hand = await on_hand_stock(list(consumed), location, now)
+    forecasts = [
+        supply_forecast(product_name, units, window_days, on_hand.get(product_name, 0), now)
+        for product_name, units in consumed.items()
+    ]
+    # Soonest stock-out first; products with no consumption last
+    forecasts.sort(key=lambda forecast: (forecast['days_of_supply'] is None, forecast['days_of_supply'] or 0))
+    return {"location": location, "window_days": window_days, "products": forecasts}
+
+# ============= IMPORT ENDPOINTS =============
+@api_router.post("/import/{kind}")
+async def bulk_import(
+    kind: ImportKind,
+    request: Request,
+    format: Optional[str] = Query(None, pattern='^(csv|ndjson)$', description="Defaults from the Content-Type header"),
+    current_user: User = Depends(get_current_user)
+):
+    fmt = format or ('csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson')
+    return await run_import(kind, request.stream(), fmt)
+
+# ============= EXPORT ENDPOINTS =============
+async def get_export_job(export_id: str, current_user: User) -> dict:
+    await fail_stalled_exports()
+    job = await db.export_jobs.find_one({'id': export_id}, {'_id': 0})
+    if not job or (job['created_by'] != current_user.id and current_user.role != UserRole.ADMIN):
+        raise HTTPException(status_code=404, detail="Export not found")
+    return job
+
+@api_router.post("/exports", status_code=202)
+async def create_export(input: ExportInput, current_user: User = Depends(get_current_user)):
+    export = resolve_export(input)
+    await asyncio.to_thread(purge_export_files)
+    now = datetime.now(timezone.utc)
+    job = {
+        'id': str(uuid.uuid4()),
+        'status': ExportStatus.QUEUED,
+        'report': input.report,
+        'collection': export['collection'],
+        'format': input.format.value,
+        'definition': input.model_dump(mode='json', exclude_none=True),
+        'fields': export['fields'],
+        # Input rows, not output rows, for grouped reports
+        'total_estimate': await read_db[export['collection']].count_documents(export['match']),
+        'rows': 0,
+        'bytes': None,
+        'host': socket.gethostname(),
+        'worker': WORKER_ID,
+        'created_by': current_user.id,
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': now + timedelta(hours=EXPORT_RETENTION_HOURS),
+    }
+    await db.export_jobs.insert_one(dict(job))
+    task = asyncio.create_task(run_export(job, export))
+    export_tasks.add(task)
+    task.add_done_callback(export_tasks.discard)
+    return job
+
+@api_router.get("/exports")
+async def get_exports(limit: int = Query(50, ge=1, le=500), current_user: User = Depends(get_current_user)):
+    await fail_stalled_exports()
+    query = {} if current_user.role == UserRole.ADMIN else {'created_by': current_user.id}
+    return await db.export_jobs.find(query, {'_id': 0}).sort('created_at', DESCENDING).limit(limit).to_list(limit)
+
+@api_router.get("/exports/{export_id}")
+async def get_export(export_id: str, current_user: User = Depends(get_current_user)):
+    return await get_export_job(export_id, current_user)
+
+@api_router.get("/exports/{export_id}/download")
+async def download_export(
+    export_id: str,
+    range_header: Optional[str] = Header(None, alias='Range'),
+    current_user: User = Depends(get_current_user)
+):
+    """The gzip file as stored; a single byte range is answered with 206 so interrupted downloads can resume"""
+    job = await get_export_job(export_id, current_user)
+    if job['status'] != ExportStatus.COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Export is {job['status']}")
+    path = export_path(job)
+    if not await asyncio.to_thread(path.exists):
+        if job['host'] != socket.gethostname():
+            raise HTTPException(status_code=404, detail=f"Export file is stored on {job['host']}")
+        raise HTTPException(status_code=410, detail="Export file has expired")
     
-    return {"message": "Stock updated", "new_stock": new_stock}
+    size = job['bytes']
+    byte_range = parse_byte_range(range_header, size) if range_header else None
+    start, end = byte_range or (0, size - 1)
+    name = f"{job['report'] or job['collection']}-{job['created_at']:%Y%m%d-%H%M%S}.{job['format']}.gz"
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(end - start + 1),
+        'Content-Disposition': f'attachment; filename="{name}"',
+        'ETag': f'"{job["id"]}"',
+    }
+    if byte_range:
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(read_file_range(path, start, end), status_code=206 if byte_range else 200,
+                             media_type='application/gzip', headers=headers)
 
 # ============= QUALITY REPORT ENDPOINTS =============
 @api_router.get("/quality-reports", response_model=List[QualityReport])
-async def get_quality_reports(current_user: User = Depends(get_current_user)):
-    reports = await db.quality_reports.find({}, {'_id': 0}).to_list(1000)
-    for r in reports:
-        for field in ['test_date', 'created_at']:
-            if isinstance(r.get(field), str):
-                r[field] = datetime.fromisoformat(r[field])
-    return reports
+async def get_quality_reports(
+    response: Response,
+    result: Optional[QualityStatus] = None,
+    product: Optional[str] = Query(None, description="Exact product name"),
+    batch_id: Optional[str] = None,
+    date_from: Optional[datetime] = Query(None, description="Created on or after"),
+    date_to: Optional[datetime] = Query(None, description="Created on or before"),
+    page: dict = Depends(page_params),
+    current_user: User = Depends(get_current_user)
+):
+    query = date_range('created_at', date_from, date_to)
+    if result:
+        query['result'] = result
+    if product:
+        query['product_name'] = product
+    if batch_id:
+        query['batch_id'] = batch_id
+    return await list_response('quality_reports', query, 'created_at', ASCENDING, page, response)
 
 @api_router.post("/quality-reports", response_model=QualityReport)
-async def create_quality_report(input: QualityReportInput, background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
+async def create_quality_report(input: QualityReportInput, current_user: User = Depends(get_current_user)):
     batch = await db.batches.find_one({'id': input.batch_id}, {'_id': 0})
     if not batch:
         raise HTTPException(status_code=404, detail="Batch not found")
@@ -441,12 +3254,18 @@ async def create_quality_report(input: QualityReportInput, background_tasks: Bac
         tested_by=input.tested_by
     )
     
-    report_dict = report.model_dump()
-    for field in ['test_date', 'created_at']:
-        report_dict[field] = report_dict[field].isoformat()
-    
-    await db.quality_reports.insert_one(report_dict)
-    await db.batches.update_one({'id': input.batch_id}, {'$set': {'quality_status': input.result}})
+    await db.quality_reports.insert_one(report.model_dump())
+    previous = await db.batches.find_one_and_update(
+        {'id': input.batch_id},
+        {'$set': {'quality_status': input.result}},
+        projection={'_id': 0, 'quality_status': 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    was_failed = bool(previous) and previous.get('quality_status') == QualityStatus.FAILED
+    # Allocation only draws from rows whose batch passed QC
+    await db.inventory.update_many({'batch_id': input.batch_id}, {'$set': {'quality_status': input.result}})
+    await bump_versions('quality_reports', 'batches', 'inventory')
+    await bump_stats({'quality_issues': int(input.result == QualityStatus.FAILED) - int(was_failed)})
     
     # Create alert if quality test failed
     if input.result == QualityStatus.FAILED:
@@ -458,89 +3277,273 @@ async def create_quality_report(input: QualityReportInput, background_tasks: Bac
             batch_number=batch['batch_number'],
             severity="high"
         )
-        alert_dict = alert.model_dump()
-        alert_dict['created_at'] = alert_dict['created_at'].isoformat()
-        await db.alerts.insert_one(alert_dict)
-        
-        # Send email to staff
-        staff_users = await db.users.find({'role': UserRole.STAFF}, {'_id': 0}).to_list(1000)
-        for staff in staff_users:
-            background_tasks.add_task(send_alert_email, staff['email'], "Quality Issue Alert", alert.message)
+        alert_dict = alert.model_dump(exclude={'batch_id', 'alert_type', 'resolved'})
+        result = await db.alerts.update_one(
+            {'batch_id': alert.batch_id, 'alert_type': alert.alert_type, 'resolved': False},
+            {'$setOnInsert': alert_dict},
+            upsert=True
+        )
+        if result.upserted_id is not None:
+            await bump_versions('alerts')
+            await bump_stats({'unread_alerts': 1})
+            publish_alert(alert.model_dump())
+            
+            # Queue the email to staff; the outbox worker delivers it
+            staff_emails = [staff['email'] async for staff in db.users.find({'role': UserRole.STAFF}, {'_id': 0, 'email': 1})]
+            await enqueue_alert_email(alert.id, "Quality Issue Alert", alert.message, staff_emails)
+    else:
+        await resolve_alerts({'batch_id': input.batch_id, 'alert_type': AlertType.QUALITY_ISSUE})
     
     return report
 
 # ============= ALERT ENDPOINTS =============
 @api_router.get("/alerts", response_model=List[Alert])
-async def get_alerts(current_user: User = Depends(get_current_user)):
-    alerts = await db.alerts.find({}, {'_id': 0}).sort('created_at', -1).to_list(1000)
-    for a in alerts:
-        if isinstance(a.get('created_at'), str):
-            a['created_at'] = datetime.fromisoformat(a['created_at'])
-    return alerts
+async def get_alerts(
+    response: Response,
+    alert_type: Optional[AlertType] = None,
+    is_read: Optional[bool] = None,
+    resolved: Optional[bool] = None,
+    batch_id: Optional[str] = None,
+    date_from: Optional[datetime] = Query(None, description="Created on or after"),
+    date_to: Optional[datetime] = Query(None, description="Created on or before"),
+    page: dict = Depends(page_params),
+    current_user: User = Depends(get_current_user)
+):
+    query = date_range('created_at', date_from, date_to)
+    if alert_type:
+        query['alert_type'] = alert_type
+    if is_read is not None:
+        query['is_read'] = is_read
+    if resolved is not None:
+        query['resolved'] = resolved
+    if batch_id:
+        query['batch_id'] = batch_id
+    return await list_response('alerts', query, 'created_at', DESCENDING, page, response)
+
+@api_router.post("/alerts/stream-token")
+async def get_alert_stream_token(current_user: User = Depends(get_current_user)):
+    """A token for ?token= on /alerts/stream, which expires before it is worth stealing from a log"""
+    return {"token": create_stream_token(current_user), "expires_in": STREAM_TOKEN_SECONDS}
+
+@api_router.get("/alerts/stream")
+async def stream_alerts(
+    last_event_id: Optional[str] = Header(None),
+    last_event: Optional[str] = Query(None, description="Last-Event-ID for clients that reopen the stream themselves"),
+    current_user: User = Depends(get_stream_user)
+):
+    """Server-sent events for new alerts; reconnecting clients resume after Last-Event-ID"""
+    return StreamingResponse(
+        alert_event_stream(last_event_id or last_event),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @api_router.put("/alerts/{alert_id}/read")
 async def mark_alert_read(alert_id: str, current_user: User = Depends(get_current_user)):
-    await db.alerts.update_one({'id': alert_id}, {'$set': {'is_read': True}})
+    result = await db.alerts.update_one(
+        {'id': alert_id, 'is_read': False},
+        {'$set': {'is_read': True, 'acknowledged_by': current_user.id, 'acknowledged_at': datetime.now(timezone.utc)}}
+    )
+    if result.modified_count:
+        await bump_versions('alerts')
+    await bump_stats({'unread_alerts': -result.modified_count})
     return {"message": "Alert marked as read"}
 
+@api_router.post("/alerts/acknowledge")
+async def acknowledge_alerts(input: AlertAcknowledgeInput, current_user: User = Depends(get_current_user)):
+    """Mark unread alerts read by ids, by batch and/or by type in one update"""
+    query = {'is_read': False}
+    if input.ids:
+        query['id'] = {'$in': input.ids}
+    if input.batch_id:
+        query['batch_id'] = input.batch_id
+    if input.alert_type:
+        query['alert_type'] = input.alert_type
+    if len(query) == 1:
+        raise HTTPException(status_code=400, detail="Provide alert ids, a batch or an alert type")
+    result = await db.alerts.update_many(
+        query,
+        {'$set': {'is_read': True, 'acknowledged_by': current_user.id, 'acknowledged_at': datetime.now(timezone.utc)}}
+    )
+    if result.modified_count:
+        await bump_versions('alerts')
+    await bump_stats({'unread_alerts': -result.modified_count})
+    return {"acknowledged": result.modified_count}
+
+@api_router.post("/alerts/archive")
+async def archive_alerts(
+    older_than_days: int = Query(ALERT_RETENTION_DAYS, ge=0),
+    current_user: User = Depends(get_current_user)
+):
+    require_admin(current_user)
+    return {"archived": await archive_resolved_alerts(older_than_days)}
+
 @api_router.post("/alerts/check")
-async def trigger_alert_check(background_tasks: BackgroundTasks, current_user: User = Depends(get_current_user)):
+async def trigger_alert_check(background_tasks: BackgroundTasks, wait: bool = False, current_user: User = Depends(get_current_user)):
+    if wait:
+        report = await check_and_create_alerts()
+        return {"message": "Alert check completed", **report}
     background_tasks.add_task(check_and_create_alerts)
     return {"message": "Alert check triggered"}
 
+@api_router.get("/scheduler")
+async def get_scheduler_status(
+    job: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    current_user: User = Depends(get_current_user)
+):
+    require_admin(current_user)
+    runs_query = {'job': job} if job else {}
+    return {
+        "worker": WORKER_ID,
+        "enabled": SCHEDULER_ENABLED,
+        "jobs": {name: {"interval_seconds": interval} for name, (interval, _) in SCHEDULED_JOBS.items()},
+        "leases": await db.scheduler_leases.find({}, {'_id': 0}).to_list(None),
+        "runs": await db.scheduler_runs.find(runs_query, {'_id': 0}).sort('started_at', DESCENDING).limit(limit).to_list(limit),
+    }
+
+@api_router.get("/notifications/outbox")
+async def get_email_outbox_stats(current_user: User = Depends(get_current_user)):
+    counts = {status.value: 0 for status in OutboxStatus}
+    async for row in db.email_outbox.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+        counts[row['_id']] = row['count']
+    return counts
+
 # ============= DASHBOARD ENDPOINTS =============
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    total_batches = await db.batches.count_documents({})
-    total_inventory = await db.inventory.count_documents({})
-    total_manufacturers = await db.manufacturers.count_documents({})
-    unread_alerts = await db.alerts.count_documents({'is_read': False})
-    
-    # Expiring soon (within 30 days)
-    thirty_days_from_now = datetime.now(timezone.utc) + timedelta(days=30)
-    expiring_soon = await db.inventory.count_documents({
-        'expiry_date': {'$lte': thirty_days_from_now.isoformat(), '$gte': datetime.now(timezone.utc).isoformat()}
-    })
+async def get_dashboard_stats(request: Request, current_user: User = Depends(get_current_user)):
+    today = datetime.now(timezone.utc).date()
+    # Every counter change bumps version and a rebuild resets it under a new rebuilt_at;
+    # expiring_soon also moves with the date
+    tag = await read_db.dashboard_stats.find_one({'_id': STATS_ID}, {'_id': 0, 'version': 1, 'rebuilt_at': 1})
+    etag = None
+    if tag and 'rebuilt_at' in tag:
+        etag = f'"{int(tag["rebuilt_at"].timestamp() * 1000)}-{tag.get("version", 0)}-{today.isoformat()}"'
     
-    # Low stock count
-    all_inventory = await db.inventory.find({}, {'_id': 0}).to_list(1000)
-    low_stock_count = sum(1 for inv in all_inventory if inv['current_stock'] < inv['initial_stock'] * 0.1)
-    
-    # Quality issues
-    quality_issues = await db.batches.count_documents({'quality_status': QualityStatus.FAILED})
+    async def render():
+        stats = await db.dashboard_stats.find_one({'_id': STATS_ID})
+        if not stats or 'rebuilt_at' not in stats:
+            # Counters were never seeded from the existing data
+            stats = await rebuild_dashboard_stats()
+        
+        # Expiring soon (within the warning window), summed from the per-day expiry buckets
+        expiry_by_day = stats.get('expiry_by_day', {})
+        expiring_soon = sum(
+            expiry_by_day.get((today + timedelta(days=offset)).isoformat(), 0)
+            for offset in range(EXPIRY_WARNING_DAYS + 1)
+        )
+        
+        return dumps_json({
+            "total_batches": stats.get('total_batches', 0),
+            "total_inventory": stats.get('total_inventory', 0),
+            "total_manufacturers": stats.get('total_manufacturers', 0),
+            "unread_alerts": stats.get('unread_alerts', 0),
+            "expiring_soon": expiring_soon,
+            "low_stock_count": stats.get('low_stock_count', 0),
+            "quality_issues": stats.get('quality_issues', 0)
+        }), {}
     
-    return {
-        "total_batches": total_batches,
-        "total_inventory": total_inventory,
-        "total_manufacturers": total_manufacturers,
-        "unread_alerts": unread_alerts,
-        "expiring_soon": expiring_soon,
-        "low_stock_count": low_stock_count,
-        "quality_issues": quality_issues
-    }
+    if etag is None:
+        body, _ = await render()
+        return Response(body, media_type='application/json')
+    return await conditional_response(etag, request_key(request), request.headers.get('if-none-match'), render)
+
+@api_router.post("/dashboard/stats/rebuild")
+async def rebuild_stats(current_user: User = Depends(get_current_user)):
+    require_admin(current_user)
+    await rebuild_dashboard_stats()
+    return {"message": "Dashboard stats rebuilt"}
 
 @api_router.get("/dashboard/batch-traceability/{batch_id}")
 async def get_batch_traceability(batch_id: str, current_user: User = Depends(get_current_user)):
-    batch = await db.batches.find_one({'id': batch_id}, {'_id': 0})
-    if not batch:
+    docs = await read_db.batches.aggregate(traceability_pipeline({'id': batch_id})).to_list(1)
+    if not docs:
         raise HTTPException(status_code=404, detail="Batch not found")
+    return split_traceability(docs[0])
+
+# ============= RECALL ENDPOINTS =============
+@api_router.post("/recalls/trace")
+async def trace_recall(input: RecallInput, current_user: User = Depends(get_current_user)):
+    conditions = []
+    if input.manufacturer_id:
+        conditions.append({'manufacturer_id': input.manufacturer_id})
+    if input.product_name:
+        conditions.append({'product_name': input.product_name})
+    if input.batch_numbers:
+        conditions.append({'batch_number': {'$in': input.batch_numbers}})
+    if not conditions:
+        raise HTTPException(status_code=400, detail="Provide a manufacturer, product or batch numbers")
     
-    inventory = await db.inventory.find_one({'batch_id': batch_id}, {'_id': 0})
-    quality_reports = await db.quality_reports.find({'batch_id': batch_id}, {'_id': 0}).to_list(100)
-    manufacturer = await db.manufacturers.find_one({'id': batch['manufacturer_id']}, {'_id': 0})
+    match = conditions[0] if len(conditions) == 1 else {'$and': conditions}
+    # One batch past the cap tells a truncated trace from one that fits exactly
+    pipeline = traceability_pipeline(match, limit=RECALL_MAX_BATCHES + 1)
+    batches = []
+    units_by_location = {}
+    inventory_rows = 0
+    truncated = False
+    async for doc in read_db.batches.aggregate(pipeline, allowDiskUse=True):
+        if len(batches) == RECALL_MAX_BATCHES:
+            truncated = True
+            break
+        trace = split_traceability(doc)
+        for row in trace['inventory']:
+            inventory_rows += 1
+            units_by_location[row['location']] = units_by_location.get(row['location'], 0) + row['current_stock']
+        batches.append(trace)
     
+    found = {trace['batch']['batch_number'] for trace in batches}
     return {
-        "batch": batch,
-        "inventory": inventory,
-        "quality_reports": quality_reports,
-        "manufacturer": manufacturer
+        "summary": {
+            "batches": len(batches),
+            "inventory_rows": inventory_rows,
+            "units_on_hand": sum(units_by_location.values()),
+            "units_by_location": units_by_location,
+            "unmatched_batch_numbers": sorted(set(input.batch_numbers or []) - found) if not truncated else [],
+            "truncated": truncated,
+        },
+        "batches": batches
     }
 
+# ============= SEARCH ENDPOINTS =============
+@api_router.get("/search")
+async def search_records(
+    q: str = Query(..., min_length=1, max_length=100, description="Prefix of a product, batch number, manufacturer, licence or location"),
+    types: Optional[str] = Query(None, description=f"Comma-separated collections to search: {', '.join(SEARCH_FIELDS)}"),
+    limit: int = Query(10, ge=1, le=SEARCH_MAX_RESULTS),
+    current_user: User = Depends(get_current_user)
+):
+    collections = [name.strip() for name in types.split(',') if name.strip()] if types else list(SEARCH_FIELDS)
+    unknown = set(collections) - SEARCH_FIELDS.keys()
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown search types: {', '.join(sorted(unknown))}")
+    return Response(dumps_json({'query': q, 'results': await search(q, collections, limit)}), media_type='application/json')
+
 # ============= ROOT ENDPOINT =============
 @api_router.get("/")
 async def root():
     return {"message": "Hospital Inventory Tracking System API"}
 
+# ============= METRICS ENDPOINT =============
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+metrics.Gauge('auth_principal_cache', "Principal cache size and hit counters", ('stat',),
+              callback=lambda: {(key,): value for key, value in principal_cache.stats().items()})
+metrics.Gauge('auth_principal_resolutions', "Principals resolved from token claims or the users collection", ('source',),
+              callback=lambda: {(key,): value for key, value in auth_counters.items()})
+metrics.Gauge('password_jobs', "bcrypt jobs waiting or running, and rejected since start", ('state',),
+              callback=lambda: {(key,): value for key, value in password_jobs.items()})
+metrics.Gauge('response_cache', "Conditional GET response cache size and hit counters", ('stat',),
+              callback=lambda: {(key,): value for key, value in response_cache.stats().items()})
+metrics.Gauge('alert_stream', "Alert stream subscribers and delivery counters", ('stat',),
+              callback=lambda: {(key,): value for key, value in alert_broker.stats().items()})
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
 # Include router
 app.include_router(api_router)
 
@@ -551,8 +3554,45 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
+app.add_middleware(metrics.RequestMetricsMiddleware, slow_request_ms=SLOW_REQUEST_MS)
+
+background_workers = []
+
+async def startup():
+    global email_transport, ALERT_STREAM_SOURCE
+    if ALERT_STREAM_SOURCE == 'local' and SCHEDULER_ENABLED and int(os.getenv('WEB_CONCURRENCY', 1)) > 1:
+        # Sweep alerts would only reach the streams of the worker that ran the tick
+        raise RuntimeError("ALERT_STREAM_SOURCE=local needs a single worker while the scheduler is enabled; use poll or changestream")
+    connect_db()
+    if os.environ.get('AUTO_CREATE_INDEXES', 'true').lower() == 'true':
+        await ensure_indexes()
+    email_transport = create_email_transport()
+    if os.environ.get('EMAIL_OUTBOX_WORKER', 'true').lower() == 'true':
+        background_workers.append(asyncio.create_task(run_email_outbox_worker()))
+    if os.environ.get('METRICS_LOOP_LAG', 'true').lower() == 'true':
+        background_workers.append(asyncio.create_task(metrics.sample_event_loop_lag()))
+    if ALERT_STREAM_SOURCE == 'auto':
+        ALERT_STREAM_SOURCE = await resolve_alert_stream_source()
+        logger.info(f"Alert stream source: {ALERT_STREAM_SOURCE}")
+    if ALERT_STREAM_SOURCE == 'changestream':
+        background_workers.append(asyncio.create_task(run_alert_change_stream()))
+    elif ALERT_STREAM_SOURCE == 'poll':
+        background_workers.append(asyncio.create_task(run_alert_poller()))
+    if SCHEDULER_ENABLED:
+        for job, (interval, fn) in SCHEDULED_JOBS.items():
+            if interval > 0:
+                background_workers.append(asyncio.create_task(run_scheduler(job, interval, fn)))
+    logger.info(f"Worker {WORKER_ID} started")
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def shutdown():
+    # Running exports are marked failed as they are cancelled
+    for worker in background_workers + list(export_tasks):
+        worker.cancel()
+    await asyncio.gather(*background_workers, *export_tasks, return_exceptions=True)
+    background_workers.clear()
+    if email_transport:
+        await email_transport.close()
+    close_db()
+    password_executor.shutdown(wait=False)
@@ -0,0 +1,46 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test')
+os.environ.setdefault('JWT_SECRET', 'test-secret')
+os.environ.setdefault('JWT_ALGORITHM', 'HS256')
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+def _patch_find_and_modify(monkeypatch):
+    # mongomock re-reads a find_one_and_update result by the original filter,
+    # which no longer matches once the update changed a filtered field
+    # (e.g. the stock guard); re-read by _id as MongoDB does.
+    from mongomock.collection import Collection, ReturnDocument
+    find_and_modify = Collection._find_and_modify
+
+    def patched(self, query, projection=None, update=None, upsert=False, sort=None,
+                return_document=ReturnDocument.BEFORE, session=None, **kwargs):
+        old = self.find_one(query, projection={'_id': 1}, sort=sort)
+        if old:
+            query = {'_id': old['_id']}
+        return find_and_modify(self, query, projection, update, upsert, sort, return_document, session, **kwargs)
+
+    monkeypatch.setattr(Collection, '_find_and_modify', patched)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """A fresh in-memory database behind server.db and server.read_db"""
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    _patch_find_and_modify(monkeypatch)
+    db = mongomock_motor.AsyncMongoMockClient(tz_aware=True)['test']
+    monkeypatch.setattr(server, 'db', db)
+    monkeypatch.setattr(server, 'read_db', db)
+    return db
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = server.User(email='pharmacy@example.com', name='Pharmacy', password_hash='', role=server.UserRole.STAFF)
+
+
+async def add_inventory(database, location: str, stock: int, expires_in_days: int,
+                        quality_status: server.QualityStatus = server.QualityStatus.PASSED) -> str:
+    row = server.Inventory(
+        batch_id=f"batch-{location}-{expires_in_days}",
+        batch_number=f"B-{location}-{expires_in_days}",
+        product_name='Amoxicillin',
+        current_stock=stock,
+        initial_stock=stock,
+        expiry_date=datetime.now(timezone.utc) + timedelta(days=expires_in_days),
+        location=location,
+        quality_status=quality_status
+    ).model_dump()
+    row['low_stock'] = False
+    await database.inventory.insert_one(row)
+    return row['id']
+
+
+async def stock(database, inventory_id: str) -> int:
+    return (await database.inventory.find_one({'id': inventory_id}))['current_stock']
+
+
+def request(quantity: int, **options) -> server.AllocationInput:
+    return server.AllocationInput(product_name='Amoxicillin', quantity=quantity, **options)
+
+
+async def test_allocates_earliest_expiry_first_within_preferred_locations(database):
+    late_ward = await add_inventory(database, 'Ward', 10, 200)
+    early_ward = await add_inventory(database, 'Ward', 10, 100)
+    earliest_store = await add_inventory(database, 'Store', 10, 50)
+
+    result = await server.allocate(request(25, preferred_locations=['Ward']), USER)
+
+    assert result['fulfilled']
+    assert [(a['inventory_id'], a['quantity']) for a in result['allocations']] == [
+        (early_ward, 10), (late_ward, 10), (earliest_store, 5)
+    ]
+    assert await stock(database, earliest_store) == 5
+    assert await database.stock_movements.count_documents({'reason': server.MovementReason.ALLOCATION}) == 3
+
+
+async def test_unfillable_allocation_is_rolled_back(database):
+    first = await add_inventory(database, 'Ward', 4, 30)
+    second = await add_inventory(database, 'Store', 3, 60)
+
+    result = await server.allocate(request(10), USER)
+
+    assert not result['fulfilled']
+    assert result['allocations'] == []
+    assert result['error'] == "Only 7 of 10 units can be allocated"
+    assert [await stock(database, first), await stock(database, second)] == [4, 3]
+    assert await database.stock_movements.count_documents({}) == 0
+
+
+async def test_partial_allocation_keeps_what_it_reserved(database):
+    row = await add_inventory(database, 'Ward', 4, 30)
+
+    result = await server.allocate(request(10, allow_partial=True), USER)
+
+    assert not result['fulfilled']
+    assert result['allocated'] == 4
+    assert await stock(database, row) == 0
+    assert await database.stock_movements.count_documents({'inventory_id': row}) == 1
+
+
+async def test_skips_rows_failing_qc_or_expired(database):
+    await add_inventory(database, 'Ward', 10, 10, server.QualityStatus.FAILED)
+    await add_inventory(database, 'Ward', 10, -1)
+    usable = await add_inventory(database, 'Ward', 10, 90)
+
+    result = await server.allocate(request(5, dry_run=True), USER)
+
+    assert [a['inventory_id'] for a in result['allocations']] == [usable]
+    assert await stock(database, usable) == 10
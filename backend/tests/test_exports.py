@@ -0,0 +1,45 @@
+import pytest
+from fastapi import HTTPException
+
+import server
+
+SIZE = 100
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=10-19', (10, 19)),
+    ('bytes=0-0', (0, 0)),
+    ('bytes=90-', (90, 99)),
+    ('bytes=90-500', (90, 99)),
+    ('bytes=-5', (95, 99)),
+    ('bytes=-500', (0, 99)),
+    (' bytes = 10-19 ', (10, 19)),
+])
+def test_single_range(header, expected):
+    assert server.parse_byte_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'bytes=0-9,20-29',
+    'items=0-9',
+    'bytes=abc',
+    'bytes=-',
+    'bytes=5-x',
+    'bytes=19-10',
+    'garbage',
+])
+def test_unsupported_or_invalid_range_is_ignored(header):
+    assert server.parse_byte_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=100-', 'bytes=150-200', 'bytes=-0'])
+def test_unsatisfiable_range(header):
+    with pytest.raises(HTTPException) as error:
+        server.parse_byte_range(header, SIZE)
+    assert error.value.status_code == 416
+    assert error.value.headers == {'Content-Range': f"bytes */{SIZE}"}
+
+
+def test_any_range_of_an_empty_file_is_unsatisfiable():
+    with pytest.raises(HTTPException):
+        server.parse_byte_range('bytes=0-', 0)
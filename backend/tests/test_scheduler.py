@@ -0,0 +1,129 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo import ASCENDING
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+TICK = 1000
+
+
+@pytest.fixture
+async def leases(database):
+    await database.scheduler_leases.create_index([('job', ASCENDING)], unique=True)
+    return database.scheduler_leases
+
+
+def counting_job():
+    calls = []
+
+    async def job():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return {'done': True}
+
+    return job, calls
+
+
+async def test_one_worker_runs_each_tick(database, leases):
+    job, calls = counting_job()
+
+    outcomes = await asyncio.gather(*(server.run_scheduled_tick('sweep', job, TICK) for _ in range(3)))
+
+    assert sorted(outcomes, key=str) == [None, None, 'ok']
+    assert len(calls) == 1
+    lease = await leases.find_one({'job': 'sweep'})
+    assert (lease['tick'], lease['running'], lease['last_outcome']) == (TICK, False, 'ok')
+
+
+async def test_tick_while_previous_run_holds_the_lease_is_an_overlap(database, leases):
+    now = datetime.now(timezone.utc)
+    await leases.insert_one({'job': 'sweep', 'tick': TICK - 1, 'owner': 'other', 'running': True,
+                             'lease_expires_at': now + timedelta(seconds=30)})
+    job, calls = counting_job()
+
+    assert await server.run_scheduled_tick('sweep', job, TICK) == 'overlap'
+
+    assert calls == []
+    lease = await leases.find_one({'job': 'sweep'})
+    assert (lease['tick'], lease['overlaps']) == (TICK - 1, 1)
+    run = await database.scheduler_runs.find_one({'tick': TICK})
+    assert (run['outcome'], run['running_owner']) == ('overlap', 'other')
+
+
+async def test_lapsed_lease_is_taken_over(database, leases):
+    now = datetime.now(timezone.utc)
+    await leases.insert_one({'job': 'sweep', 'tick': TICK - 1, 'owner': 'dead', 'running': True,
+                             'lease_expires_at': now - timedelta(seconds=1)})
+    job, calls = counting_job()
+
+    assert await server.run_scheduled_tick('sweep', job, TICK) == 'ok'
+
+    assert len(calls) == 1
+    lease = await leases.find_one({'job': 'sweep'})
+    assert (lease['tick'], lease['owner'], lease['running']) == (TICK, server.WORKER_ID, False)
+
+
+async def test_failed_sweep_is_recorded_as_failed(database, leases, monkeypatch):
+    def failing_aggregate(self, *args, **kwargs):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(type(database.inventory), 'aggregate', failing_aggregate)
+
+    assert await server.run_scheduled_tick('alert_sweep', server.check_and_create_alerts, TICK) == 'failed'
+
+    run = await database.scheduler_runs.find_one({'tick': TICK})
+    assert (run['outcome'], run['error']) == ('failed', "connection reset")
+
+
+def alert(name: str, created_at: datetime) -> dict:
+    return server.Alert(alert_type=server.AlertType.LOW_STOCK, title=name, message=name, severity='low',
+                        created_at=created_at).model_dump()
+
+
+@pytest.fixture
+def subscriber():
+    queue = server.alert_broker.subscribe()
+    yield queue
+    server.alert_broker.unsubscribe(queue)
+
+
+def drain(queue) -> list:
+    titles = []
+    while not queue.empty():
+        titles.append(queue.get_nowait()['title'])
+    return titles
+
+
+async def test_poll_publishes_an_alert_committed_after_a_newer_one(database, subscriber):
+    now = datetime.now(timezone.utc)
+    await database.alerts.insert_one(alert('history', now - timedelta(minutes=5)))
+    poller = server.AlertPoller(lookback_seconds=30)
+    await poller.prime()
+    # The sweep builds its alert first, but another worker's QC alert is committed before it
+    sweep = alert('sweep', now)
+    await database.alerts.insert_one(alert('qc', now + timedelta(seconds=1)))
+
+    assert await poller.poll() == 1
+    await database.alerts.insert_one(sweep)
+    assert await poller.poll() == 1
+    assert await poller.poll() == 0
+
+    assert drain(subscriber) == ['qc', 'sweep']
+
+
+async def test_replay_includes_alerts_committed_late_behind_the_last_event(database):
+    now = datetime.now(timezone.utc)
+    qc = alert('qc', now + timedelta(seconds=1))
+    await database.alerts.insert_many([alert('old', now - timedelta(minutes=5)), qc, alert('sweep', now)])
+    millis, alert_id = server.alert_event_key(qc)
+
+    stream = server.alert_event_stream(f"{millis}-{alert_id}")
+    events = [await stream.__anext__() for _ in range(3)]
+    await stream.aclose()
+
+    assert [json.loads(event.split('data: ')[1])['title'] for event in events[1:]] == ['sweep', 'qc']
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = server.User(email='staff@example.com', name='Staff', password_hash='', role=server.UserRole.STAFF)
+
+
+async def add_inventory(database, current_stock: int, initial_stock: int = 100) -> str:
+    row = server.Inventory(
+        batch_id='batch-1',
+        batch_number='B1',
+        product_name='Saline',
+        current_stock=current_stock,
+        initial_stock=initial_stock,
+        expiry_date=datetime.now(timezone.utc) + timedelta(days=365),
+        location='Ward A'
+    ).model_dump()
+    row['low_stock'] = server.is_low_stock(current_stock, initial_stock)
+    await database.inventory.insert_one(row)
+    return row['id']
+
+
+def lines(inventory_id: str, *changes: int) -> list:
+    return [server.StockMovementLine(inventory_id=inventory_id, quantity_change=change) for change in changes]
+
+
+@pytest.fixture
+def interleaved_writes(database, monkeypatch):
+    """Yield to the event loop after every bulk_write, as a driver round-trip would"""
+    collection_class = type(database.inventory)
+    bulk_write = collection_class.bulk_write
+
+    async def yielding_bulk_write(self, *args, **kwargs):
+        result = await bulk_write(self, *args, **kwargs)
+        await asyncio.sleep(0)
+        return result
+
+    monkeypatch.setattr(collection_class, 'bulk_write', yielding_bulk_write)
+
+
+async def test_concurrent_batches_record_their_own_resulting_stock(database, interleaved_writes):
+    inventory_id = await add_inventory(database, 50)
+
+    first, second = await asyncio.gather(
+        server.apply_stock_movements(lines(inventory_id, -5, -5), USER),
+        server.apply_stock_movements(lines(inventory_id, -10), USER),
+    )
+
+    assert [result['new_stock'] for result in first] == [45, 40]
+    assert [result['new_stock'] for result in second] == [30]
+    ledger = await database.stock_movements.find({'inventory_id': inventory_id}).to_list(None)
+    assert sorted(movement['resulting_stock'] for movement in ledger) == [30, 40, 45]
+    row = await database.inventory.find_one({'id': inventory_id})
+    assert row['current_stock'] == 30
+    assert row['_pending_movements'] == []
+
+
+async def test_concurrent_batches_count_a_low_stock_crossing_once(database, interleaved_writes):
+    inventory_id = await add_inventory(database, 15)
+
+    await asyncio.gather(
+        server.apply_stock_movements(lines(inventory_id, -3), USER),
+        server.apply_stock_movements(lines(inventory_id, -4), USER),
+    )
+
+    stats = await database.dashboard_stats.find_one({'_id': server.STATS_ID})
+    assert stats['low_stock_count'] == 1
+
+
+async def test_rejected_lines_are_reported_and_leave_no_ledger_entry(database):
+    inventory_id = await add_inventory(database, 5)
+
+    results = await server.apply_stock_movements(lines(inventory_id, -3, -3, 2) + lines('missing', 1), USER)
+
+    assert [result['applied'] for result in results] == [True, False, True, False]
+    assert results[1]['error'] == "Insufficient stock"
+    assert results[3]['error'] == "Inventory not found"
+    assert [results[0]['new_stock'], results[2]['new_stock']] == [2, 4]
+    assert await database.stock_movements.count_documents({}) == 2
+
+
+async def test_markers_are_removed_when_the_read_back_fails(database, monkeypatch):
+    inventory_id = await add_inventory(database, 50)
+
+    def failing_find(self, *args, **kwargs):
+        raise RuntimeError("connection reset")
+
+    monkeypatch.setattr(type(database.inventory), 'find', failing_find)
+    with pytest.raises(RuntimeError):
+        await server.apply_stock_movements(lines(inventory_id, -1), USER)
+
+    row = await database.inventory.find_one({'id': inventory_id})
+    assert row['current_stock'] == 49
+    assert row['_pending_movements'] == []
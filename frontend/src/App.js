@@ -17,6 +17,26 @@ const API = `${BACKEND_URL}/api`;
 
 export { API };
 
+// Access tokens can be short-lived: on a 401, trade the refresh token for a new one and retry once
+axios.interceptors.response.use(undefined, async (error) => {
+  const config = error.config;
+  const refreshToken = localStorage.getItem('refresh_token');
+  if (error.response?.status !== 401 || !refreshToken || !config || config._retried || config.url === `${API}/auth/refresh`) {
+    throw error;
+  }
+  let res;
+  try {
+    res = await axios.post(`${API}/auth/refresh`, { refresh_token: refreshToken });
+  } catch (refreshError) {
+    localStorage.removeItem('refresh_token');
+    throw error;
+  }
+  localStorage.setItem('token', res.data.token);
+  config._retried = true;
+  config.headers.Authorization = `Bearer ${res.data.token}`;
+  return axios(config);
+});
+
 function App() {
   const [user, setUser] = useState(null);
   const [loading, setLoading] = useState(true);
@@ -33,6 +53,7 @@ function App() {
       })
       .catch(() => {
         localStorage.removeItem('token');
+        localStorage.removeItem('refresh_token');
         setLoading(false);
       });
     } else {
@@ -42,6 +63,7 @@ function App() {
 
   const handleLogout = () => {
     localStorage.removeItem('token');
+    localStorage.removeItem('refresh_token');
     setUser(null);
   };
 
@@ -14,6 +14,48 @@ export default function Alerts() {
 
   useEffect(() => {
     fetchAlerts();
+
+    // New alerts arrive over server-sent events. EventSource cannot send headers, so the
+    // stream opens with a short-lived stream token; once that has expired a dropped
+    // connection cannot reconnect by itself and is reopened here from the last event id.
+    let source = null;
+    let lastEventId = null;
+    let closed = false;
+
+    const openStream = async () => {
+      try {
+        const res = await axios.post(`${API}/alerts/stream-token`, {}, {
+          headers: { Authorization: `Bearer ${localStorage.getItem('token')}` }
+        });
+        if (closed) return;
+        const params = new URLSearchParams({ token: res.data.token });
+        if (lastEventId) params.set('last_event', lastEventId);
+        source = new EventSource(`${API}/alerts/stream?${params}`);
+        source.addEventListener('alert', (event) => {
+          lastEventId = event.lastEventId;
+          const alert = JSON.parse(event.data);
+          setAlerts((current) => current.some((a) => a.id === alert.id) ? current : [alert, ...current]);
+        });
+        source.addEventListener('reset', (event) => {
+          // Missed too many alerts to replay; reload the list instead
+          lastEventId = event.lastEventId || lastEventId;
+          fetchAlerts();
+        });
+        source.onerror = () => {
+          if (source.readyState === EventSource.CLOSED && !closed) {
+            setTimeout(openStream, 3000);
+          }
+        };
+      } catch (error) {
+        if (!closed) setTimeout(openStream, 3000);
+      }
+    };
+    openStream();
+
+    return () => {
+      closed = true;
+      if (source) source.close();
+    };
   }, []);
 
   const fetchAlerts = async () => {
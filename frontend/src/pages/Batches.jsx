@@ -10,10 +10,14 @@ import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '.
 import { Plus, Search } from 'lucide-react';
 import { toast } from 'sonner';
 
+const PAGE_SIZE = 100;
+
 export default function Batches() {
   const [batches, setBatches] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [manufacturers, setManufacturers] = useState([]);
   const [searchTerm, setSearchTerm] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
   const [dialogOpen, setDialogOpen] = useState(false);
   const [loading, setLoading] = useState(true);
   const [formData, setFormData] = useState({
@@ -28,16 +32,21 @@ export default function Batches() {
 
   useEffect(() => {
     fetchBatches();
-    fetchManufacturers();
   }, []);
 
-  const fetchBatches = async () => {
+  useEffect(() => {
+    if (dialogOpen) fetchManufacturers();
+  }, [dialogOpen]);
+
+  const fetchBatches = async (cursor) => {
     try {
       const token = localStorage.getItem('token');
       const res = await axios.get(`${API}/batches`, {
+        params: { limit: PAGE_SIZE, cursor },
         headers: { Authorization: `Bearer ${token}` }
       });
-      setBatches(res.data);
+      setBatches(cursor ? [...batches, ...res.data] : res.data);
+      setNextCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Failed to load batches');
     } finally {
@@ -49,6 +58,7 @@ export default function Batches() {
     try {
       const token = localStorage.getItem('token');
       const res = await axios.get(`${API}/manufacturers`, {
+        params: { fields: 'id,name' },
         headers: { Authorization: `Bearer ${token}` }
       });
       setManufacturers(res.data);
@@ -89,11 +99,32 @@ export default function Batches() {
     }
   };
 
-  const filteredBatches = batches.filter(batch =>
-    batch.batch_number.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    batch.product_name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    batch.manufacturer_name.toLowerCase().includes(searchTerm.toLowerCase())
-  );
+  useEffect(() => {
+    const term = searchTerm.trim();
+    if (!term) {
+      setSearchResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const res = await axios.get(`${API}/search`, {
+          params: { q: term, types: 'batches', limit: 50 },
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        if (!cancelled) setSearchResults(res.data.results.map(result => result.item));
+      } catch (error) {
+        console.error('Search failed');
+      }
+    }, 200);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchTerm, batches]);
+
+  const filteredBatches = searchResults ?? batches;
 
   if (loading) {
     return <div className="flex items-center justify-center h-full"><div className="text-emerald-600 text-xl">Loading batches...</div></div>;
@@ -274,6 +305,13 @@ export default function Batches() {
               </TableBody>
             </Table>
           </div>
+          {!searchResults && nextCursor && (
+            <div className="flex justify-center pt-4">
+              <Button variant="outline" onClick={() => fetchBatches(nextCursor)} data-testid="load-more-batches-button">
+                Load more
+              </Button>
+            </div>
+          )}
         </CardContent>
       </Card>
     </div>
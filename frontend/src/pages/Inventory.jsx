@@ -10,10 +10,16 @@ import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '.
 import { Plus, Search, TrendingDown, TrendingUp } from 'lucide-react';
 import { toast } from 'sonner';
 
+const PAGE_SIZE = 100;
+// Batches that can still receive stock
+const RECEIVABLE_STATUSES = ['in_production', 'in_transit'];
+
 export default function Inventory() {
   const [inventory, setInventory] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [batches, setBatches] = useState([]);
   const [searchTerm, setSearchTerm] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
   const [dialogOpen, setDialogOpen] = useState(false);
   const [updateDialogOpen, setUpdateDialogOpen] = useState(false);
   const [selectedInventory, setSelectedInventory] = useState(null);
@@ -27,16 +33,21 @@ export default function Inventory() {
 
   useEffect(() => {
     fetchInventory();
-    fetchBatches();
   }, []);
 
-  const fetchInventory = async () => {
+  useEffect(() => {
+    if (dialogOpen) fetchBatches();
+  }, [dialogOpen]);
+
+  const fetchInventory = async (cursor) => {
     try {
       const token = localStorage.getItem('token');
       const res = await axios.get(`${API}/inventory`, {
+        params: { limit: PAGE_SIZE, cursor },
         headers: { Authorization: `Bearer ${token}` }
       });
-      setInventory(res.data);
+      setInventory(cursor ? [...inventory, ...res.data] : res.data);
+      setNextCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Failed to load inventory');
     } finally {
@@ -47,10 +58,13 @@ export default function Inventory() {
   const fetchBatches = async () => {
     try {
       const token = localStorage.getItem('token');
-      const res = await axios.get(`${API}/batches`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      setBatches(res.data);
+      const responses = await Promise.all(RECEIVABLE_STATUSES.map(status =>
+        axios.get(`${API}/batches`, {
+          params: { status, fields: 'batch_number,product_name,status' },
+          headers: { Authorization: `Bearer ${token}` }
+        })
+      ));
+      setBatches(responses.flatMap(res => res.data));
     } catch (error) {
       console.error('Failed to load batches');
     }
@@ -103,11 +117,32 @@ export default function Inventory() {
     setUpdateDialogOpen(true);
   };
 
-  const filteredInventory = inventory.filter(item =>
-    item.product_name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    item.batch_number.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    item.location.toLowerCase().includes(searchTerm.toLowerCase())
-  );
+  useEffect(() => {
+    const term = searchTerm.trim();
+    if (!term) {
+      setSearchResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const res = await axios.get(`${API}/search`, {
+          params: { q: term, types: 'inventory', limit: 50 },
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        if (!cancelled) setSearchResults(res.data.results.map(result => result.item));
+      } catch (error) {
+        console.error('Search failed');
+      }
+    }, 200);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchTerm, inventory]);
+
+  const filteredInventory = searchResults ?? inventory;
 
   const getStockPercentage = (current, initial) => {
     return Math.round((current / initial) * 100);
@@ -147,7 +182,7 @@ export default function Inventory() {
                   required
                 >
                   <option value="">Select Batch</option>
-                  {batches.filter(b => b.status === 'in_production' || b.status === 'in_transit').map(b => (
+                  {batches.map(b => (
                     <option key={b.id} value={b.id}>
                       {b.batch_number} - {b.product_name}
                     </option>
@@ -266,6 +301,13 @@ export default function Inventory() {
               </TableBody>
             </Table>
           </div>
+          {!searchResults && nextCursor && (
+            <div className="flex justify-center pt-4">
+              <Button variant="outline" onClick={() => fetchInventory(nextCursor)} data-testid="load-more-inventory-button">
+                Load more
+              </Button>
+            </div>
+          )}
         </CardContent>
       </Card>
 
@@ -26,6 +26,7 @@ export default function Login({ setUser }) {
       const res = await axios.post(`${API}${endpoint}`, formData);
       
       localStorage.setItem('token', res.data.token);
+      localStorage.setItem('refresh_token', res.data.refresh_token);
       setUser(res.data.user);
       toast.success(isLogin ? 'Login successful!' : 'Registration successful!');
     } catch (error) {
@@ -10,9 +10,13 @@ import { Table, TableBody, TableCell, TableHead, TableHeader, TableRow } from '.
 import { Plus, Search, Building2, Phone, Mail } from 'lucide-react';
 import { toast } from 'sonner';
 
+const PAGE_SIZE = 100;
+
 export default function Manufacturers() {
   const [manufacturers, setManufacturers] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [searchTerm, setSearchTerm] = useState('');
+  const [searchResults, setSearchResults] = useState(null);
   const [dialogOpen, setDialogOpen] = useState(false);
   const [loading, setLoading] = useState(true);
   const [formData, setFormData] = useState({
@@ -27,13 +31,15 @@ export default function Manufacturers() {
     fetchManufacturers();
   }, []);
 
-  const fetchManufacturers = async () => {
+  const fetchManufacturers = async (cursor) => {
     try {
       const token = localStorage.getItem('token');
       const res = await axios.get(`${API}/manufacturers`, {
+        params: { limit: PAGE_SIZE, cursor },
         headers: { Authorization: `Bearer ${token}` }
       });
-      setManufacturers(res.data);
+      setManufacturers(cursor ? [...manufacturers, ...res.data] : res.data);
+      setNextCursor(res.headers['x-next-cursor'] || null);
     } catch (error) {
       toast.error('Failed to load manufacturers');
     } finally {
@@ -64,11 +70,32 @@ export default function Manufacturers() {
     }
   };
 
-  const filteredManufacturers = manufacturers.filter(mfr =>
-    mfr.name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    mfr.contact_email.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    mfr.license_number.toLowerCase().includes(searchTerm.toLowerCase())
-  );
+  useEffect(() => {
+    const term = searchTerm.trim();
+    if (!term) {
+      setSearchResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const res = await axios.get(`${API}/search`, {
+          params: { q: term, types: 'manufacturers', limit: 50 },
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        if (!cancelled) setSearchResults(res.data.results.map(result => result.item));
+      } catch (error) {
+        console.error('Search failed');
+      }
+    }, 200);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchTerm, manufacturers]);
+
+  const filteredManufacturers = searchResults ?? manufacturers;
 
   if (loading) {
     return <div className="flex items-center justify-center h-full"><div className="text-emerald-600 text-xl">Loading manufacturers...</div></div>;
@@ -204,6 +231,13 @@ export default function Manufacturers() {
               ))
             )}
           </div>
+          {!searchResults && nextCursor && (
+            <div className="flex justify-center pt-4">
+              <Button variant="outline" onClick={() => fetchManufacturers(nextCursor)} data-testid="load-more-manufacturers-button">
+                Load more
+              </Button>
+            </div>
+          )}
         </CardContent>
       </Card>
     </div>